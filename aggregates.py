@@ -0,0 +1,124 @@
+from queries import genres
+
+####################
+# Book Genre Reads #
+####################
+# Reads per (book, genre), where a genre is one of the crawled genre tags
+query_table_book_genre_reads = """
+CREATE TABLE IF NOT EXISTS book_genre_reads (
+    book_id BIGINT NOT NULL REFERENCES books (book_id) ON DELETE CASCADE,
+    genre TEXT NOT NULL,
+    reads BIGINT NOT NULL,
+    PRIMARY KEY (book_id, genre)
+    );
+"""
+
+######################
+# Genre Author Reads #
+######################
+# Reads per (genre, author), indexed for the top authors of a genre
+query_table_genre_author_reads = """
+CREATE TABLE IF NOT EXISTS genre_author_reads (
+    genre TEXT NOT NULL,
+    author_id BIGINT NOT NULL,
+    total_reads BIGINT NOT NULL,
+    PRIMARY KEY (genre, author_id)
+    );
+CREATE INDEX IF NOT EXISTS genre_author_reads_rank_idx ON genre_author_reads (genre, total_reads DESC);
+"""
+
+###########
+# Refresh #
+###########
+def create_aggregates(cur):
+    """Creates the aggregate tables, filling them from scratch while they are empty"""
+    cur.execute(query_table_book_genre_reads)
+    cur.execute(query_table_genre_author_reads)
+    cur.execute("SELECT EXISTS (SELECT 1 FROM book_genre_reads)")
+    if not cur.fetchone()[0]:
+        rebuild_aggregates(cur)
+
+def capture_changes(cur, staging_schema="staging"):
+    """Notes, before the merge, which books and (genre, author) pairs the load affects
+
+    That is every staged book plus the books of tags being renamed. Their current
+    (genre, author) pairs are kept so pairs the load removes are refreshed too.
+    """
+    cur.execute(f"""
+    CREATE TEMP TABLE affected_books ON COMMIT DROP AS
+    SELECT book_id FROM {staging_schema}.books
+    UNION
+    SELECT bt.book_id
+    FROM book_tags AS bt
+    JOIN tags AS t
+        ON bt.tag_id = t.tag_id
+    JOIN {staging_schema}.tags AS s
+        ON s.tag_id = t.tag_id
+    WHERE s.tag_name IS DISTINCT FROM t.tag_name
+    """)
+    cur.execute("CREATE TEMP TABLE affected_genre_authors (genre TEXT, author_id BIGINT) ON COMMIT DROP")
+    insert_genre_authors(cur)
+
+def capture_books(cur, book_ids):
+    """Notes book_ids as affected by an update that leaves their genres and authors as they are"""
+    cur.execute("CREATE TEMP TABLE affected_books (book_id BIGINT) ON COMMIT DROP")
+    cur.execute("INSERT INTO affected_books SELECT unnest(%s::BIGINT[])", (list(book_ids),))
+    cur.execute("CREATE TEMP TABLE affected_genre_authors (genre TEXT, author_id BIGINT) ON COMMIT DROP")
+    insert_genre_authors(cur)
+
+def insert_genre_authors(cur):
+    cur.execute("""
+    INSERT INTO affected_genre_authors (genre, author_id)
+    SELECT DISTINCT bgr.genre, ba.author_id
+    FROM book_genre_reads AS bgr
+    JOIN book_authors AS ba
+        ON bgr.book_id = ba.book_id
+    WHERE bgr.book_id IN (SELECT book_id FROM affected_books)
+    """)
+
+def refresh_aggregates(cur):
+    """Recomputes the aggregates of the books noted by capture_changes, after the merge"""
+    cur.execute("DELETE FROM book_genre_reads WHERE book_id IN (SELECT book_id FROM affected_books)")
+    cur.execute("""
+    INSERT INTO book_genre_reads (book_id, genre, reads)
+    SELECT
+        b.book_id,
+        t.tag_name                              AS genre,
+        SUM(COALESCE(b.users_read_count, 0))    AS reads
+    FROM books AS b
+    JOIN book_tags AS bt
+        ON b.book_id = bt.book_id
+    JOIN tags AS t
+        ON bt.tag_id = t.tag_id
+    WHERE t.tag_name = ANY(%s)
+      AND b.book_id IN (SELECT book_id FROM affected_books)
+    GROUP BY b.book_id, t.tag_name
+    """, (genres,))
+
+    # Pairs after the merge join the pairs from before it
+    insert_genre_authors(cur)
+    cur.execute("""
+    DELETE FROM genre_author_reads AS gar
+    USING affected_genre_authors AS aga
+    WHERE gar.genre = aga.genre AND gar.author_id = aga.author_id
+    """)
+    cur.execute("""
+    INSERT INTO genre_author_reads (genre, author_id, total_reads)
+    SELECT
+        bgr.genre,
+        ba.author_id,
+        SUM(bgr.reads)      AS total_reads
+    FROM book_genre_reads AS bgr
+    JOIN book_authors AS ba
+        ON bgr.book_id = ba.book_id
+    WHERE (bgr.genre, ba.author_id) IN (SELECT genre, author_id FROM affected_genre_authors)
+    GROUP BY bgr.genre, ba.author_id
+    """)
+
+def rebuild_aggregates(cur):
+    """Recomputes the aggregates of every book"""
+    cur.execute("TRUNCATE book_genre_reads, genre_author_reads")
+    cur.execute("CREATE TEMP TABLE affected_books ON COMMIT DROP AS SELECT book_id FROM books")
+    cur.execute("CREATE TEMP TABLE affected_genre_authors (genre TEXT, author_id BIGINT) ON COMMIT DROP")
+    refresh_aggregates(cur)
+    cur.execute("DROP TABLE affected_books, affected_genre_authors")
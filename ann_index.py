@@ -0,0 +1,146 @@
+import time
+import numpy as np
+from scipy import sparse
+
+from array_store import load_arrays, save_arrays
+from description_vectors import exact_search, normalize_rows, top_k_columns
+
+# Files of a saved index, one .npy array each
+ann_files = ["centroids", "offsets", "ids", "vectors"]
+
+# Lists probed per query unless given; more lists is higher recall and higher latency
+default_nprobe = 8
+
+###########
+# K-Means #
+###########
+def assign_lists(vectors, centroids, chunksize=65536):
+    """Index of the closest centroid of every vector"""
+    assignments = np.empty(len(vectors), dtype=np.int64)
+    for start in range(0, len(vectors), chunksize):
+        chunk = np.asarray(vectors[start:start + chunksize])
+        assignments[start:start + chunksize] = np.argmax(chunk @ centroids.T, axis=1)
+    return assignments
+
+def spherical_kmeans(vectors, nlist, iterations=10, sample_size=None, seed=0):
+    """Unit-length centroids of nlist clusters of unit vectors, fitted on a sample"""
+    rng = np.random.default_rng(seed)
+    n = len(vectors)
+    sample_size = min(n, sample_size or 64 * nlist)
+    sample = np.asarray(vectors[np.sort(rng.choice(n, sample_size, replace=False))], dtype=np.float32)
+    centroids = sample[rng.choice(sample_size, nlist, replace=False)]
+    for _ in range(iterations):
+        assignments = assign_lists(sample, centroids)
+        members = sparse.csr_matrix(
+            (np.ones(sample_size, dtype=np.float32), (assignments, np.arange(sample_size))),
+            shape=(nlist, sample_size)
+            )
+        sums = np.asarray(members @ sample)
+        # Empty clusters restart from a random sample vector
+        empty = np.bincount(assignments, minlength=nlist) == 0
+        sums[empty] = sample[rng.choice(sample_size, empty.sum())]
+        centroids = normalize_rows(sums).astype(np.float32)
+    return centroids
+
+#########
+# Index #
+#########
+class IvfIndex:
+    """Inverted-file index for approximate inner-product search over unit vectors
+
+    Vectors are grouped by their closest k-means centroid and stored contiguously
+    list by list, with offsets[i]:offsets[i + 1] the rows of list i. A query only
+    scores the vectors of its nprobe closest lists, which trades recall for latency.
+    """
+    def __init__(self, centroids, offsets, ids, vectors):
+        self.centroids = centroids
+        self.offsets = offsets
+        self.ids = ids
+        self.vectors = vectors
+
+    @classmethod
+    def build(cls, ids, vectors, nlist=None, iterations=10):
+        start = time.perf_counter()
+        n = len(ids)
+        # Around 2 * sqrt(n) lists keeps both the centroid scan and the lists small
+        nlist = max(1, min(n, nlist or int(2 * np.sqrt(n))))
+        centroids = spherical_kmeans(vectors, nlist, iterations) if n else np.zeros((0, 0), dtype=np.float32)
+        index = cls(centroids, np.zeros(nlist + 1, dtype=np.int64),
+                    np.zeros(0, dtype=np.int64), np.zeros((0, centroids.shape[1]), dtype=np.float32))
+        index = index.add(ids, vectors)
+        print(f"IVF index: {n} vectors, {nlist} lists in {time.perf_counter() - start:.2f}s")
+        return index
+
+    @classmethod
+    def load(cls, path, mmap=True):
+        return cls(*load_arrays(path, ann_files, mmap))
+
+    def save(self, path):
+        save_arrays(path, {name: getattr(self, name) for name in ann_files})
+
+    @property
+    def nlist(self):
+        return len(self.offsets) - 1
+
+    def add(self, ids, vectors):
+        """Index with vectors inserted into their closest lists, replacing ids already indexed
+
+        The centroids are kept, so books ingested later are added without retraining.
+        Returns a new index.
+        """
+        ids = np.asarray(ids, dtype=np.int64)
+        vectors = np.asarray(vectors, dtype=np.float32)
+        lists = np.repeat(np.arange(self.nlist), np.diff(self.offsets))
+        keep = ~np.isin(self.ids, ids)
+        all_lists = np.concatenate([lists[keep], assign_lists(vectors, self.centroids)])
+        all_ids = np.concatenate([np.asarray(self.ids)[keep], ids])
+        all_vectors = np.concatenate([np.asarray(self.vectors)[keep], vectors])
+
+        order = np.argsort(all_lists, kind="stable")
+        offsets = np.zeros(self.nlist + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum(np.bincount(all_lists, minlength=self.nlist))
+        return IvfIndex(self.centroids, offsets, all_ids[order], all_vectors[order])
+
+    def search(self, queries, k=10, nprobe=None):
+        """Approximate top k (ids, scores) per query, -1 ids where fewer were found"""
+        queries = np.asarray(queries, dtype=np.float32)
+        nprobe = min(nprobe or default_nprobe, self.nlist)
+        ids = np.full((len(queries), k), -1, dtype=np.int64)
+        scores = np.full((len(queries), k), -np.inf, dtype=np.float32)
+        if len(self.ids) == 0:
+            return ids, scores
+
+        centroid_scores = queries @ self.centroids.T
+        probes = np.argpartition(-centroid_scores, nprobe - 1, axis=1)[:, :nprobe]
+        for q, lists in enumerate(probes):
+            rows = np.concatenate([np.arange(self.offsets[i], self.offsets[i + 1]) for i in lists])
+            if len(rows) == 0:
+                continue
+            row_scores = np.asarray(self.vectors[rows]) @ queries[q]
+            top_ids, top_scores = top_k_columns(np.asarray(self.ids[rows])[None], row_scores[None], k)
+            ids[q, :top_ids.shape[1]] = top_ids[0]
+            scores[q, :top_scores.shape[1]] = top_scores[0]
+        return ids, scores
+
+#############
+# Benchmark #
+#############
+def recall_at_k(index, ids, vectors, queries, k=10, nprobes=(1, 2, 4, 8, 16, 32)):
+    """Recall@k and latency of the index against exact search for each nprobe"""
+    start = time.perf_counter()
+    exact_ids, _ = exact_search(ids, vectors, queries, k)
+    exact_ms = (time.perf_counter() - start) * 1000 / len(queries)
+
+    results = []
+    for nprobe in nprobes:
+        if nprobe > index.nlist:
+            break
+        start = time.perf_counter()
+        found, _ = index.search(queries, k, nprobe)
+        ms = (time.perf_counter() - start) * 1000 / len(queries)
+        hits = sum(len(set(a) & set(b)) for a, b in zip(found.tolist(), exact_ids.tolist()))
+        results.append({"nprobe": nprobe, "recall": hits / exact_ids.size, "ms_per_query": ms,
+                        "exact_ms_per_query": exact_ms})
+        print(f"nprobe {nprobe}: recall@{k} {hits / exact_ids.size:.3f}, "
+              f"{ms:.2f} ms/query (exact {exact_ms:.2f} ms/query)")
+    return results
@@ -0,0 +1,28 @@
+import os
+import numpy as np
+from numpy.lib.format import open_memmap
+
+def save_arrays(path, arrays, chunksize=100000):
+    """Saves named arrays as <path>/<name>.npy, chunksize rows at a time
+
+    Every array is written to a temporary file first and moved into place, so a
+    reader never maps a half-written file.
+    """
+    os.makedirs(path, exist_ok=True)
+    for name, array in arrays.items():
+        array = np.asanyarray(array)
+        tmp_path = f"{path}/{name}.tmp.npy"
+        if array.dtype.hasobject or array.ndim == 0:
+            np.save(tmp_path, array)
+        else:
+            out = open_memmap(tmp_path, mode="w+", dtype=array.dtype, shape=array.shape)
+            for start in range(0, len(array), chunksize):
+                out[start:start + chunksize] = array[start:start + chunksize]
+            out.flush()
+            del out
+    for name in arrays:
+        os.replace(f"{path}/{name}.tmp.npy", f"{path}/{name}.npy")
+
+def load_arrays(path, names, mmap=True):
+    """Loads <path>/<name>.npy for every name, memory-mapped unless mmap is False"""
+    return [np.load(f"{path}/{name}.npy", mmap_mode="r" if mmap else None) for name in names]
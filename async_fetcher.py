@@ -0,0 +1,525 @@
+import asyncio
+import inspect
+import json
+import os
+import random
+import time
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from functools import partial
+import aiohttp
+
+from instrumentation import metrics
+from queries import (
+    books_query, authors_query, tags_query,
+    books_by_id_query, authors_by_id_query, id_fields, fetch_profiles
+    )
+from raw_store import append_rows, iter_raw, raw_filename
+
+################
+# Rate Limiter #
+################
+class TokenBucket:
+    """Token bucket shared by all workers so the whole crawl stays within the API quota"""
+    def __init__(self, rate, capacity=None):
+        # rate is tokens (requests) per second, capacity is the allowed burst
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(1, rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self.lock = asyncio.Lock()
+
+    def pause(self, seconds):
+        """Hands out no tokens for seconds, e.g. after the API answered 429"""
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+    async def acquire(self):
+        """Waits until a token is available and takes it"""
+        # Holding the lock while sleeping hands out tokens in arrival order
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                if now < self.paused_until:
+                    await asyncio.sleep(self.paused_until - now)
+                    continue
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+#############
+# Page Size #
+#############
+class PageSize:
+    """Limit of one paged query, halved on timeouts and oversized responses and grown while pages are fast
+
+    The limit stays between min_limit and max_limit; it grows by half after grow_after
+    consecutive responses faster than fast_seconds.
+    """
+    def __init__(self, limit, min_limit=None, max_limit=None, fast_seconds=1.0,
+                 max_bytes=4 * 2**20, grow_after=3):
+        self.limit = limit
+        self.min_limit = min(min_limit or max(1, limit // 10), limit)
+        self.max_limit = max(max_limit or limit, limit)
+        self.fast_seconds = fast_seconds
+        self.max_bytes = max_bytes
+        self.grow_after = grow_after
+        self.fast_pages = 0
+
+    def shrink(self):
+        self.fast_pages = 0
+        limit = max(self.min_limit, self.limit // 2)
+        if limit < self.limit:
+            metrics.count("fetch.limit_shrinks")
+        self.limit = limit
+
+    def observe(self, seconds, size):
+        """Adapts the limit to the time and size in bytes of a successful response"""
+        if size > self.max_bytes:
+            self.shrink()
+            return
+        if seconds >= self.fast_seconds:
+            self.fast_pages = 0
+            return
+        self.fast_pages += 1
+        if self.fast_pages >= self.grow_after and self.limit < self.max_limit:
+            self.fast_pages = 0
+            self.limit = min(self.max_limit, max(self.limit + 1, int(self.limit * 1.5)))
+            metrics.count("fetch.limit_grows")
+
+###########
+# Retries #
+###########
+# Rate limited, or the server or a proxy in front of it failing
+retry_statuses = {429, 500, 502, 503, 504}
+
+# GraphQL errors that mean "try again later" rather than a bad query
+transient_errors = ("throttl", "rate limit", "too many requests", "timeout", "timed out",
+                    "try again", "temporarily")
+
+def is_transient_error(errors):
+    return any(
+        part in f"{error.get('message', '')} {error.get('extensions', {})}".lower()
+        for error in errors for part in transient_errors
+        )
+
+def retry_after(value):
+    """Seconds to wait from a Retry-After header, given in seconds or as an HTTP date"""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        when = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if when.tzinfo is None:
+        when = when.replace(tzinfo=timezone.utc)
+    return max(0.0, (when - datetime.now(timezone.utc)).total_seconds())
+
+###########
+# Fetcher #
+###########
+class AsyncFetcher:
+    """Pooled HTTP session with a shared rate limit, bounded concurrency and retries
+
+    Retries back off exponentially from backoff seconds up to max_backoff, with jitter
+    so concurrent workers do not retry in lockstep. min_limit, max_limit, fast_seconds
+    and max_response_bytes bound the page size of every paged query.
+    """
+    def __init__(self, url, headers, rate=1.0, burst=None, max_concurrency=8,
+                 timeout=30, max_retries=5, backoff=1.0, max_backoff=60.0,
+                 min_limit=None, max_limit=None, fast_seconds=1.0, max_response_bytes=4 * 2**20):
+        self.url = url
+        self.headers = headers
+        self.bucket = TokenBucket(rate, burst)
+        self.max_concurrency = max_concurrency
+        self.semaphore = asyncio.Semaphore(max_concurrency)
+        self.timeout = aiohttp.ClientTimeout(total=timeout)
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.fast_seconds = fast_seconds
+        self.max_response_bytes = max_response_bytes
+        self.session = None
+
+    async def __aenter__(self):
+        # One connection pool for every request in the crawl
+        connector = aiohttp.TCPConnector(limit=self.max_concurrency)
+        self.session = aiohttp.ClientSession(headers=self.headers, connector=connector,
+                                             timeout=self.timeout)
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.session.close()
+
+    def page_size(self, limit):
+        return PageSize(limit, self.min_limit, self.max_limit, self.fast_seconds,
+                        self.max_response_bytes)
+
+    def backoff_delay(self, attempt):
+        """Exponential backoff with equal jitter: between half and all of the capped delay"""
+        delay = min(self.max_backoff, self.backoff * 2 ** attempt)
+        return delay / 2 + random.uniform(0, delay / 2)
+
+    async def make_request(self, query, variables=None, page_size=None):
+        """Posts a query, retrying timeouts, dropped connections, 429s, 5xx and throttling errors
+
+        A retry waits at least as long as Retry-After asks, and after a 429 the whole
+        crawl waits. With page_size the limit variable is taken from it, halved after a
+        timeout and adapted to every response.
+        Returns the response body, or None if no attempt returned one.
+        """
+        data = None
+        for attempt in range(self.max_retries + 1):
+            if page_size is not None:
+                variables = {**(variables or {}), "limit": page_size.limit}
+            status = None
+            wait = None
+            with metrics.timer("fetch.rate_limit_wait"):
+                await self.bucket.acquire()
+            try:
+                async with self.semaphore:
+                    metrics.count("fetch.requests")
+                    start = time.perf_counter()
+                    with metrics.timer("fetch.request"):
+                        async with self.session.post(self.url, json={"query": query, "variables": variables}) as response:
+                            status = response.status
+                            wait = retry_after(response.headers.get("Retry-After"))
+                            body = await response.read()
+                    seconds = time.perf_counter() - start
+            except asyncio.TimeoutError:
+                reason = "timeout"
+                # A smaller page is more likely to come back in time
+                if page_size is not None:
+                    page_size.shrink()
+            except aiohttp.ClientError as e:
+                reason = "connection"
+                print("Connection error:", e)
+            except Exception as e:
+                print("An error occurred:", e)
+                break
+            else:
+                if status in retry_statuses:
+                    reason = f"status_{status}"
+                else:
+                    try:
+                        data = json.loads(body)
+                    except ValueError:
+                        if status >= 400:
+                            print(f"Request failed with status {status}")
+                            break
+                        reason = "invalid_json"
+                    else:
+                        errors = data.get("errors") if isinstance(data, dict) else None
+                        if not (errors and is_transient_error(errors)):
+                            if page_size is not None and not errors:
+                                page_size.observe(seconds, len(body))
+                            return data
+                        reason = "throttled"
+
+            if attempt == self.max_retries:
+                break
+            delay = max(self.backoff_delay(attempt), wait or 0)
+            if status == 429:
+                self.bucket.pause(delay)
+            metrics.count("fetch.retries")
+            metrics.count(f"fetch.retries.{reason}")
+            print(f"Request failed ({reason}). Retry {attempt + 1}/{self.max_retries} in {delay:.1f}s")
+            with metrics.timer("fetch.backoff"):
+                await asyncio.sleep(delay)
+        metrics.count("fetch.failed_requests")
+        # The last throttling errors, if any, so the caller can report them
+        return data
+
+##############
+# Pagination #
+##############
+async def deliver(sink, page):
+    """Hands a page to sink, waiting for it if it is a coroutine so a slow consumer holds the fetcher back"""
+    result = sink(page)
+    if inspect.isawaitable(result):
+        await result
+
+def is_keyset_error(errors):
+    """Checks if GraphQL errors concern the keyset filter or ordering"""
+    for error in errors:
+        text = f"{error.get('message', '')} {error.get('extensions', {})}"
+        if any(part in text for part in ("last_id", "_gt", "order_by", ".where.id")):
+            return True
+    return False
+
+async def fetch_all(fetcher, build_query, root, sink, variables=None, limit=100, label="",
+                    pagination="keyset", journal=None, key=None):
+    """Pages through one query, handing every page to sink, until the API returns no more rows"""
+    last_id = 0
+    offset = 0
+
+    # Resuming from the last page recorded in the journal
+    state = journal.get(key) if journal is not None else None
+    if state is not None:
+        if state["done"]:
+            print(f"{label} already fetched; skipping.")
+            return
+        pagination = state["pagination"] or pagination
+        last_id = state["last_id"]
+        offset = state["offset"]
+
+    query = build_query(pagination)
+    # The limit of every page is set by make_request
+    page_size = fetcher.page_size(limit)
+    while True:
+        page_variables = dict(variables or {})
+        if pagination == "keyset":
+            page_variables["last_id"] = last_id
+            position = f"last_id {last_id}"
+        else:
+            page_variables["offset"] = offset
+            position = f"offset {offset}"
+        data = await fetcher.make_request(query, variables=page_variables, page_size=page_size)
+        if data is None:
+            print(f"{label} request failed at {position}.")
+            return
+
+        errors = data.get("errors")
+        if errors:
+            metrics.count("fetch.graphql_errors")
+            messages = "; ".join(error.get("message", str(error)) for error in errors)
+            # Falling back to offset paging only if the API rejects the keyset filter itself
+            first_page = last_id == 0 and offset == 0
+            if pagination == "keyset" and first_page and is_keyset_error(errors):
+                print(f"Keyset pagination rejected for {label} ({messages}); falling back to offset paging.")
+                pagination = "offset"
+                query = build_query(pagination)
+                continue
+            print(f"{label} request returned errors at {position}: {messages}")
+            return
+
+        result = (data.get("data") or {}).get(root)
+        if not result:
+            print(f"No more {label} returned at {position}.")
+            break
+
+        # The page is on disk before the journal moves past it
+        metrics.count(f"fetch.rows.{root}", len(result))
+        with metrics.timer("fetch.deliver"):
+            await deliver(sink, result)
+        last_id = result[-1]["id"]
+        offset += len(result)
+        if journal is not None:
+            journal.record_page(key, pagination, last_id, offset)
+        if pagination == "keyset":
+            print(f"{label} last_id:", last_id)
+        else:
+            print(f"{label} offset:", offset)
+
+    # Only a query that ran out of rows counts as complete
+    if journal is not None:
+        journal.mark_done(key)
+
+async def fetch_by_ids(fetcher, query, root, ids, sink, limit=100, label="",
+                       journal=None, key=None):
+    """Downloads the records for a sorted list of ids in chunks, each id exactly once
+
+    Chunks are cut at the adaptive page size. A response cut short because the limit
+    shrank during its retries has the rest of its chunk requested before moving on.
+    """
+    last_id = 0
+    state = journal.get(key) if journal is not None else None
+    if state is not None:
+        if state["done"]:
+            print(f"{label} already fetched; skipping.")
+            return
+        last_id = state["last_id"]
+
+    ids = [i for i in ids if i > last_id]
+    page_size = fetcher.page_size(limit)
+
+    def request(chunk):
+        return fetcher.make_request(query, variables={"ids": chunk}, page_size=page_size)
+
+    # A window of chunks is requested concurrently but written and journalled in order
+    window = fetcher.max_concurrency
+    position = 0
+    while position < len(ids):
+        batch = []
+        while len(batch) < window and position < len(ids):
+            batch.append(ids[position:position + page_size.limit])
+            position += len(batch[-1])
+        responses = await asyncio.gather(*[request(chunk) for chunk in batch])
+        for chunk, data in zip(batch, responses):
+            while True:
+                if data is None or data.get("errors"):
+                    if data is not None:
+                        metrics.count("fetch.graphql_errors")
+                    print(f"{label} request failed at last_id {last_id}.")
+                    return
+                result = (data.get("data") or {}).get(root) or []
+                if result:
+                    metrics.count(f"fetch.rows.{root}", len(result))
+                    with metrics.timer("fetch.deliver"):
+                        await deliver(sink, result)
+                # Records come back in id order, so a short page ends at its last record
+                remaining = [i for i in chunk if i > result[-1]["id"]] if result else []
+                last_id = result[-1]["id"] if remaining else chunk[-1]
+                if journal is not None:
+                    journal.record_page(key, "ids", last_id, 0)
+                print(f"{label} last_id:", last_id)
+                if not remaining:
+                    break
+                chunk = remaining
+                data = await request(chunk)
+
+    if journal is not None:
+        journal.mark_done(key)
+
+async def fetch_single_pass(fetcher, genres, entity, genre_query, lookup_query, limit=100,
+                            pagination="keyset", store_path=None, journal=None, since=None,
+                            profile="full"):
+    """Collects ids per genre, then downloads each record once
+
+    Returns records per genre when kept in memory; with store_path the records go to
+    <entity>.jsonl and the genre membership to <singular>_genres.jsonl, named after
+    the fetch profile unless it is "full".
+    """
+    singular = entity[:-1]
+    memberships = {genre: [] for genre in genres}
+    records_path = f"{store_path}/{raw_filename(f'{entity}.jsonl', profile)}"
+    genres_path = f"{store_path}/{raw_filename(f'{singular}_genres.jsonl', profile)}"
+
+    # An incremental run appends to the memberships of earlier runs, so only the rows
+    # after this offset name records to download
+    if store_path is not None:
+        if journal is not None:
+            genres_offset = journal.file_start(f"{singular}_genres", genres_path)
+        else:
+            genres_offset = os.path.getsize(genres_path) if os.path.exists(genres_path) else 0
+
+    def id_sink(genre):
+        if store_path is None:
+            return lambda page: memberships[genre].extend(row["id"] for row in page)
+        return lambda page: append_rows(
+            genres_path, [{f"{singular}_id": row["id"], "genre": genre} for row in page]
+            )
+
+    await asyncio.gather(*[
+        fetch_all(fetcher, partial(genre_query, since=since, fields=id_fields), entity,
+                  id_sink(genre), {"genre": genre}, limit, f"{genre} {singular} ids",
+                  pagination, journal, f"{singular}_ids|{genre}")
+        for genre in genres
+        ])
+
+    # Payloads are only downloaded once every genre's ids are known
+    if journal is not None and not all(
+            (journal.get(f"{singular}_ids|{genre}") or {}).get("done") for genre in genres
+            ):
+        print(f"Some {singular} ids are missing; skipping the {entity} download.")
+        return {}
+
+    if store_path is not None:
+        ids = sorted({
+            row[f"{singular}_id"] for chunk in iter_raw(genres_path, offset=genres_offset) for row in chunk
+            })
+        sink = lambda page: append_rows(records_path, page, None, singular)
+    else:
+        ids = sorted({i for genre_ids in memberships.values() for i in genre_ids})
+        by_id = {}
+        sink = lambda page: by_id.update((row["id"], row) for row in page)
+
+    print(f"Downloading {len(ids)} unique {entity}")
+    await fetch_by_ids(fetcher, lookup_query(), entity, ids, sink, limit, entity.capitalize(),
+                       journal, entity)
+
+    if store_path is not None:
+        return {}
+    # The same record object is shared by every genre it belongs to
+    return {
+        genre: [by_id[i] for i in genre_ids if i in by_id]
+        for genre, genre_ids in memberships.items()
+        }
+
+#########
+# Crawl #
+#########
+async def crawl(url, headers, genres, rate=1.0, burst=None, max_concurrency=8, limit=100,
+                pagination="keyset", store_path=None, journal=None, since=None,
+                single_pass=False, on_page=None, profile="full", **fetcher_options):
+    """Fetches books and authors for every genre plus all tags concurrently
+
+    With store_path every page is appended to the raw files as it arrives and the
+    returned collections stay empty; otherwise the rows are collected in memory.
+    With since only books and authors created or changed after it are fetched.
+    With single_pass a book or author in several genres is downloaded only once.
+    With on_page every per-genre and tags page is passed to on_page(entity, genre, page)
+    instead; if it is a coroutine function the crawl waits for it before requesting
+    more pages. Single-pass downloads are not genre pages, so on_page and single_pass
+    raise ValueError together.
+    profile names the fields fetched per entity in fetch_profiles; entities it leaves
+    out are skipped, and its raw files are kept apart from a full crawl's.
+    fetcher_options, such as max_retries or max_limit, are passed to AsyncFetcher.
+    """
+    if on_page is not None and single_pass:
+        raise ValueError("on_page cannot be combined with single_pass")
+    fields = fetch_profiles[profile]
+    all_books = {genre: [] for genre in genres}
+    all_authors = {genre: [] for genre in genres}
+    all_tags = []
+    entities = {
+        "books": (books_query, books_by_id_query, all_books),
+        "authors": (authors_query, authors_by_id_query, all_authors)
+        }
+
+    def sink(collected, filename, genre=None, column=None):
+        if on_page is not None:
+            return partial(on_page, filename.split(".")[0], genre)
+        if store_path is None:
+            return collected.extend
+        return lambda page: append_rows(f"{store_path}/{raw_filename(filename, profile)}", page, genre, column)
+
+    async def collect(collected, records):
+        collected.update(await records)
+
+    tasks = []
+    keys = []
+    async with AsyncFetcher(url, headers, rate=rate, burst=burst, max_concurrency=max_concurrency,
+                            **fetcher_options) as fetcher:
+        for entity, (genre_query, lookup_query, collected) in entities.items():
+            if entity not in fields:
+                continue
+            singular = entity[:-1]
+            # Ids are all an ids-only crawl needs, so there is nothing to download once
+            if single_pass and fields[entity] != id_fields:
+                tasks.append(collect(collected, fetch_single_pass(
+                    fetcher, genres, entity, genre_query, partial(lookup_query, fields[entity]),
+                    limit, pagination, store_path, journal, since, profile
+                    )))
+                keys += [f"{singular}_ids|{genre}" for genre in genres] + [entity]
+            else:
+                tasks += [
+                    fetch_all(fetcher, partial(genre_query, since=since, fields=fields[entity]), entity,
+                              sink(collected[genre], f"{entity}.jsonl", genre, singular),
+                              {"genre": genre}, limit, f"{genre} {entity}", pagination,
+                              journal, f"{entity}|{genre}")
+                    for genre in genres
+                    ]
+                keys += [f"{entity}|{genre}" for genre in genres]
+
+        if "tags" in fields:
+            tasks.append(fetch_all(fetcher, partial(tags_query, fields=fields["tags"]), "tags",
+                                   sink(all_tags, "tags.jsonl"), limit=limit, label="Tags",
+                                   pagination=pagination, journal=journal, key="tags"))
+            keys.append("tags")
+        await asyncio.gather(*tasks)
+
+    # A run where every query completed starts from scratch next time
+    if journal is not None and all((journal.get(key) or {}).get("done") for key in keys):
+        journal.mark_finished()
+
+    return all_books, all_authors, all_tags
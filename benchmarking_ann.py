@@ -0,0 +1,23 @@
+import os
+import numpy as np
+
+from ann_index import IvfIndex, recall_at_k
+from description_vectors import DescriptionVectors
+
+data_path = os.environ["BOOK_RECOMMENDATION_DATA_PATH"]
+
+# Books used as queries, and the nprobe values compared
+n_queries = int(os.environ.get("ANN_BENCHMARK_QUERIES", "200"))
+nprobes = [int(nprobe) for nprobe in os.environ.get("ANN_BENCHMARK_NPROBES", "1,2,4,8,16,32").split(",")]
+
+vectors = DescriptionVectors.load(f"{data_path}/description_vectors")
+ann = IvfIndex.load(f"{data_path}/ann_index")
+
+#############
+# Recall@10 #
+#############
+# The same random books every run, so results of different builds compare
+rng = np.random.default_rng(0)
+queries = np.asarray(vectors.vectors[rng.choice(len(vectors.book_ids), min(n_queries, len(vectors.book_ids)),
+                                                replace=False)])
+recall_at_k(ann, vectors.book_ids, vectors.vectors, queries, k=10, nprobes=nprobes)
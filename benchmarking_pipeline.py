@@ -0,0 +1,184 @@
+import asyncio
+import json
+import os
+import re
+import subprocess
+import tempfile
+from datetime import datetime, timezone
+import pandas as pd
+import psycopg2
+from aiohttp.test_utils import TestServer
+
+from aggregates import capture_changes, refresh_aggregates
+from async_fetcher import crawl
+from cleaning_pre_postgresql import (
+    read_books_raw, read_tags,
+    clean_books_merged,
+    clean_authors_merged, clean_tags
+    )
+from instrumentation import compare_reports, metrics
+from language_filter import detect_english_titles
+from loading import load_tables
+from schema import book_frames, create_schema, tables
+from synthetic_data import generate_catalogue, stub_app, write_raw_store
+
+data_path = os.environ["BOOK_RECOMMENDATION_DATA_PATH"]
+
+# Books per run; authors are a third of the books
+sizes = [int(size) for size in os.environ.get("BENCHMARK_BOOKS", "1000,10000").split(",")]
+
+# Average number of extra genres a book is in, and the number of tags
+genre_overlap = float(os.environ.get("BENCHMARK_GENRE_OVERLAP", "0.5"))
+n_tags = int(os.environ.get("BENCHMARK_TAGS", "2000"))
+
+# "1" also crawls a local stub of the API, to time fetching and writing the raw files
+benchmark_fetch = os.environ.get("BENCHMARK_FETCH", "0") == "1"
+
+# Comma-separated stages run under cProfile ("all" for every stage), and "1" to trace
+# each stage's peak memory; both slow the stages down, so timings are only compared
+# between runs measured alike
+profile = os.environ.get("PIPELINE_PROFILE", "")
+trace_memory = os.environ.get("PIPELINE_TRACE_MEMORY", "0") == "1"
+metrics.configure(profile=profile, trace_memory=trace_memory,
+                  profile_path=f"{data_path}/run_reports/profiles")
+
+# Every run is appended here and compared with the previous run of the same size
+results_path = f"{data_path}/benchmark_results.jsonl"
+
+# Connection parameters; the benchmark database is dropped and recreated for every size
+conn_params = {
+    "host": "localhost",
+    "dbname": os.environ.get("BENCHMARK_DBNAME", "book_benchmark"),
+    "user": "postgres",
+    "password": os.environ["POSTGRESQL_PW"],
+    "port": 5432
+    }
+
+###########
+# Helpers #
+###########
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def reset_database():
+    admin = psycopg2.connect(**{**conn_params, "dbname": "postgres"})
+    admin.autocommit = True
+    with admin.cursor() as cur:
+        cur.execute(f'DROP DATABASE IF EXISTS "{conn_params["dbname"]}"')
+        cur.execute(f'CREATE DATABASE "{conn_params["dbname"]}"')
+    admin.close()
+
+def previous_run(n_books):
+    if not os.path.exists(results_path):
+        return None
+    with open(results_path) as f:
+        runs = [json.loads(line) for line in f if line.strip()]
+    runs = [
+        run for run in runs
+        if run["books"] == n_books and run["genre_overlap"] == genre_overlap
+        and run.get("profile", "") == profile and run.get("trace_memory", False) == trace_memory
+        ]
+    return runs[-1] if runs else None
+
+##########
+# Stages #
+##########
+async def fetch_from_stub(catalogue, genres, store_path):
+    server = TestServer(stub_app(catalogue))
+    await server.start_server()
+    try:
+        await crawl(str(server.make_url("/graphql")), {}, genres, rate=10000, burst=1000,
+                    store_path=store_path)
+    finally:
+        await server.close()
+
+def load(frames):
+    conn = psycopg2.connect(**conn_params)
+    with conn.cursor() as cur:
+        create_schema(cur)
+    conn.commit()
+    conn.close()
+    load_tables(conn_params, tables, frames,
+                before_merge=[capture_changes], after_merge=[refresh_aggregates])
+
+def benchmark(n_books):
+    check_letters = re.compile(r"[A-Za-z]")
+    with tempfile.TemporaryDirectory() as raw_path:
+        with metrics.stage("generate", rows=n_books):
+            catalogue = generate_catalogue(n_books, n_tags=n_tags, genre_overlap=genre_overlap)
+        genres = sorted(set().union(*catalogue["book_genres"].values()))
+        if benchmark_fetch:
+            with metrics.stage("fetch", rows=n_books):
+                asyncio.run(fetch_from_stub(catalogue, genres, raw_path))
+        else:
+            with metrics.stage("write_raw", rows=n_books):
+                write_raw_store(raw_path, catalogue)
+        del catalogue
+
+        with metrics.stage("parse") as stage:
+            books_raw = read_books_raw(raw_path)
+            stage["rows"] = sum(len(rows) for rows in books_raw.values())
+
+        # A fresh cache, so the filter stage detects every title and flattening reuses it
+        language_cache = f"{raw_path}/language_cache.sqlite"
+        titles = {
+            (book["id"], book["title"].strip())
+            for rows in books_raw.values() for book in rows
+            if isinstance(book.get("title"), str) and check_letters.search(book["title"])
+            }
+        with metrics.stage("language_filter", rows=len(titles)):
+            detect_english_titles(titles, language_cache)
+
+        with metrics.stage("flatten") as stage:
+            cleaned = clean_books_merged(books_raw, language_cache=language_cache)
+            stage["rows"] = len(cleaned["books"])
+        del books_raw
+        with metrics.stage("authors") as stage:
+            authors = clean_authors_merged(raw_path, cleaned["book_authors"])
+            stage["rows"] = len(authors)
+        with metrics.stage("tags") as stage:
+            tags_raw = read_tags(raw_path)
+            tags = clean_tags(tags_raw)
+            stage["rows"] = len(tags_raw)
+
+    frames = {
+        **book_frames(cleaned),
+        "authors": authors,
+        "tags": pd.concat(tags.values(), ignore_index=True)
+        }
+    reset_database()
+    with metrics.stage("load", rows=sum(len(df) for df in frames.values())):
+        load(frames)
+
+#######
+# Run #
+#######
+for n_books in sizes:
+    print(f"Benchmarking {n_books} books, genre overlap {genre_overlap}")
+    metrics.reset()
+    benchmark(n_books)
+    run = {
+        "run_at": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "commit": git_commit(),
+        "books": n_books,
+        "genre_overlap": genre_overlap,
+        "tags": n_tags,
+        "profile": profile,
+        "trace_memory": trace_memory,
+        **metrics.report()
+        }
+
+    # Regressions show up as stages slower than the last run of the same size
+    previous = previous_run(n_books)
+    if previous is not None:
+        print(f"Compared with {previous['run_at']} ({previous['commit']}):")
+        for name, change in compare_reports(previous, run).items():
+            if name.startswith("stages.") or abs(change) >= 0.1:
+                print(f"{name:>40}: {change:+.0%}")
+
+    with open(results_path, "a") as f:
+        f.write(json.dumps(run) + "\n")
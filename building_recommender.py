@@ -0,0 +1,73 @@
+import os
+import numpy as np
+import psycopg2
+
+from ann_index import IvfIndex
+from description_vectors import DescriptionVectors, read_descriptions
+from popularity import BookScores, read_score_inputs, score_books, write_scores
+from recommender import SimilarityIndex, read_edges
+
+data_path = os.environ["BOOK_RECOMMENDATION_DATA_PATH"]
+
+# Neighbours kept per book; recommendations for a reading list are drawn from these
+top_k = int(os.environ.get("RECOMMENDER_TOP_K", "50"))
+
+# Dimensions of the description vectors
+description_dim = int(os.environ.get("RECOMMENDER_DESCRIPTION_DIM", "128"))
+
+# "full" refits the description vectors and the ANN index, "incremental" only adds
+# books that have no vector yet, keeping the vocabulary and the index centroids
+update_mode = os.environ.get("RECOMMENDER_UPDATE", "full")
+
+vectors_path = f"{data_path}/description_vectors"
+ann_path = f"{data_path}/ann_index"
+
+# Connection parameters
+conn_params = {
+    "host": "localhost",
+    "dbname": "postgres",
+    "user": "postgres",
+    "password": os.environ["POSTGRESQL_PW"],
+    "port": 5432
+    }
+
+conn = psycopg2.connect(**conn_params)
+cur = conn.cursor()
+
+#########
+# Index #
+#########
+book_ids, edges = read_edges(cur)
+
+# Books are compared on their shared tags, authors and series
+index = SimilarityIndex.build(book_ids, edges, k=top_k)
+index.save(f"{data_path}/similarity_index")
+
+#######################
+# Description Vectors #
+#######################
+# Memory-mapped by every reader, so the text is vectorized once per build
+if update_mode == "incremental" and os.path.exists(f"{ann_path}/ids.npy"):
+    vectors = DescriptionVectors.load(vectors_path)
+    ann = IvfIndex.load(ann_path)
+    new_ids, new_descriptions = read_descriptions(cur, np.setdiff1d(book_ids, vectors.book_ids))
+    print(f"Adding {len(new_ids)} new books to the description vectors and the ANN index")
+    vectors, new_vectors = vectors.add(new_ids, new_descriptions)
+    ann = ann.add(new_ids, new_vectors)
+else:
+    description_ids, descriptions = read_descriptions(cur)
+    vectors = DescriptionVectors.build(description_ids, descriptions, dim=description_dim)
+    ann = IvfIndex.build(vectors.book_ids, vectors.vectors)
+
+vectors.save(vectors_path)
+ann.save(ann_path)
+
+##############
+# Popularity #
+##############
+# Bayesian ratings and popularity priors per book, genre and author, in the
+# database for dashboards and on disk for blending into recommendations
+scores = score_books(*read_score_inputs(cur))
+write_scores(conn, scores)
+BookScores.from_frame(scores["book_scores"]).save(f"{data_path}/book_scores")
+conn.close()
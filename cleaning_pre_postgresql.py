@@ -1,62 +1,62 @@
-import csv
 import pandas as pd
-import sys
-import ast
 import re
-from langdetect import detect, LangDetectException
-from collections import defaultdict
 
-def is_english(title_text):
-    """Checks if title is in English"""
-    try:
-        return detect(title_text) == "en"
-    except LangDetectException:
-        return False
+from raw_store import read_by_genre, iter_raw, raw_filename
+from language_filter import detect_english_titles
+from schema import book_stats_columns
+
+##########
+# Dtypes #
+##########
+# Cleaned tables are held in compact columns: 32-bit numbers, ids in 32 bits while
+# they fit, categorical labels and datetime64 dates. COPY writes them as they are.
+def id_column(values):
+    """Ids as int32, or int64 once one of them no longer fits"""
+    values = pd.to_numeric(values)
+    if len(values) and values.max() >= 2**31:
+        return values.astype("int64")
+    return values.astype("int32")
+
+def int32_column(values):
+    # non-numbers to NaN and NaN to NA
+    return pd.to_numeric(values, errors="coerce").astype("Int32")
+
+def rating_column(values):
+    # Rounded before narrowing, so float32 doesn't shift the rounding
+    return pd.to_numeric(values, errors="coerce").astype("Float64").round(1).astype("Float32")
+
+def date_column(values):
+    # Dates of the UTC timestamps as datetime64 instead of date objects
+    return pd.to_datetime(values, utc=True, format="ISO8601").dt.tz_localize(None).dt.normalize()
 
 #############
 # Books Raw #
 #############
 def read_books_raw(filepath):
-    # Increasing the CSV field size limit
-    max_int = sys.maxsize
-    while True:
-        try:
-            csv.field_size_limit(max_int)
-            break
-        except OverflowError:
-            max_int = int(max_int / 10)
-            
-    books_raw = []
-    with open(f"{filepath}/books.csv", "r", encoding="utf-8") as f:
-        reader = csv.reader(f)
-        next(reader)
-        for row in reader:
-            if row: # Ensuring row is not empty
-                genre = row[1]
-                book_str = row[2]
-                try:
-                    # Saved the CSV file where the second column was JSON and became a string
-                    book_info = ast.literal_eval(book_str)
-                except Exception as e:
-                    print(f"Error parsing books for {genre}: {e}")
-                    book_info = []
-                books_raw.append({
-                    "genre": genre,
-                    "info": book_info
-                    })
-    
-    # Returning [] instead of KeyError if a genre doesn't exist yet
-    books_by_genre = defaultdict(list)
-    for book in books_raw:
-        books_by_genre[book["genre"]].append(book["info"])
-    books_by_genre = dict(books_by_genre)
+    # books.jsonl is parsed in chunks with the JSON parser
+    books_by_genre = read_by_genre(filepath, "books", "book")
         
     return books_by_genre
 
 ################################################
 # Books, Book Authors, Book Tags & Book Series #
 ################################################
-def clean_books_tags_series(books):
+def explode_edges(df, column, fields):
+    """Flattens a column of lists of dicts into a long table with one row per (book_id, element)"""
+    exploded = df[["id", column]].explode(column, ignore_index=True)
+    exploded = exploded[exploded[column].notna()].reset_index(drop=True)
+    
+    # json_normalize flattens nested dicts into dotted columns such as "series.id"
+    values = pd.json_normalize(exploded[column].tolist())
+    edges = values.reindex(columns=list(fields)).rename(columns=fields)
+    edges.insert(0, "book_id", exploded["id"])
+    id_columns = [name for name in fields.values() if name.endswith("_id")]
+    edges = edges.dropna(subset=id_columns).drop_duplicates()
+    for name in ["book_id", *id_columns]:
+        edges[name] = id_column(edges[name])
+    return edges
+
+def clean_books_tags_series(books, language_cache=None, workers=None):
     books_cleaned = {}
     book_author_cleaned = {}
     book_tags_cleaned = {}
@@ -65,6 +65,14 @@ def clean_books_tags_series(books):
     # Used for finding letters in the English alphabet
     check_letters = re.compile(r"[A-Za-z]")
     
+    # Detecting the language of every title once across genres, in a process pool and cached on disk
+    titles = {
+        (book["id"], book["title"].strip())
+        for vals in books.values() for book in vals
+        if isinstance(book.get("title"), str) and check_letters.search(book["title"])
+        }
+    language = detect_english_titles(titles, language_cache, workers)
+    
     for key, vals in books.items():
         df = pd.DataFrame(vals)
         
@@ -81,13 +89,17 @@ def clean_books_tags_series(books):
         # is_english on titles with English letters and numerical titles
         detect_titles = (~is_digit) & has_letter
         english_titles = pd.Series(False, index=df.index)
-        english_titles[detect_titles] = df.loc[detect_titles, "title"].apply(is_english)
+        english_titles[detect_titles] = pd.Series(
+            [language[pair] for pair in zip(df.loc[detect_titles, "id"], df.loc[detect_titles, "title"])],
+            index=df.index[detect_titles], dtype=bool
+            )
         
         # Keep either numerical titles or English titles
         keep = is_digit | english_titles
         df = df[keep]
         
-        df = df.drop_duplicates("id")
+        # Incremental syncs append newer versions of a book, so the last one wins
+        df = df.drop_duplicates("id", keep="last")
         
         #########
         # Books #
@@ -97,57 +109,43 @@ def clean_books_tags_series(books):
             "created_at", "ratings_count", "reviews_count", "editions_count",
             "lists_count", "users_read_count"
             ]].copy()
-        df_books["pages"] = (
-            # non-numbers to NaN and NaN to NA
-            pd.to_numeric(df_books["pages"], errors="coerce").astype("Int64") 
-            )
-        df_books["rating"] = (
-            pd.to_numeric(df_books["rating"], errors="coerce").astype("Float64").round(1)
-            )
-        df_books["created_at"] = pd.to_datetime(df_books["created_at"]).dt.date
-        df_books["book_image"] = df["image"].apply(
-            lambda img: img.get("url") if isinstance(img, dict) else None
-            )
+        df_books["id"] = id_column(df_books["id"])
+        for column in ["pages", "release_year", "ratings_count", "reviews_count",
+                       "editions_count", "lists_count", "users_read_count"]:
+            df_books[column] = int32_column(df_books[column])
+        df_books["rating"] = rating_column(df_books["rating"])
+        df_books["created_at"] = date_column(df_books["created_at"])
+        # .str.get reads the key from dict cells and gives None for missing images
+        df_books["book_image"] = df["image"].str.get("url").astype("string")
         
         books_cleaned[key] = df_books
         
         ##################
         # Book Author #
         ##################
-        df_book_authors = df[["id"]].copy()
-        df_book_authors["book_author_id"] = df["contributions"].apply(
-            lambda author_list: [author_dict["author_id"] for author_dict in author_list]
-            if isinstance(author_list, list) else []
-            )
+        # One row per (book_id, author_id)
+        df_book_authors = explode_edges(df, "contributions", {"author_id": "author_id"})
         
         book_author_cleaned[key] = df_book_authors
         
         #############
         # Book Tags #
         #############
-        df_book_tags = df[["id"]].copy()
-        df_book_tags["tag_id"] = df["taggings"].apply(
-            lambda tag_list: [tag_dict["tag_id"] for tag_dict in tag_list]
-            if isinstance(tag_list, list) else []
-            )
+        # One row per (book_id, tag_id)
+        df_book_tags = explode_edges(df, "taggings", {"tag_id": "tag_id"})
         
         book_tags_cleaned[key] = df_book_tags
         
         ###############
         # Book Series #
         ###############
-        df_temp = df[df["book_series"].apply(lambda series_list: len(series_list) > 0)]
-        df_book_series = df_temp[["id"]].rename(columns={"id": "book_id"})
-        
-        # Raw position
-        raw_pos = df_temp["book_series"].apply(lambda series_list: series_list[0]["position"])
+        # One row per (book_id, series_id, position) for every series a book is in
+        df_book_series = explode_edges(df, "book_series", {"series.id": "series_id", "position": "position"})
         df_book_series["position"] = (
             # Coerce to numeric (if a book has a position with a decimal it gets treated as NaN)
-            pd.to_numeric(raw_pos, errors="coerce").round(0).astype("Int64")
+            pd.to_numeric(df_book_series["position"], errors="coerce").round(0).astype("Int32")
             )
         
-        df_book_series["related_book_id"] = df_temp["book_series"].apply(lambda series_list: series_list[0]["series"]["id"])
-        
         book_series_cleaned[key] = df_book_series
         
     return {
@@ -157,64 +155,100 @@ def clean_books_tags_series(books):
         "book_series": book_series_cleaned
         }
 
+#################
+# Merged Genres #
+#################
+def clean_books_merged(books, language_cache=None, workers=None):
+    """Cleans every book once across genres
+
+    Returns one table per entity plus book_genres with a row per (book_id, genre).
+    """
+    unique_books = {}
+    genre_rows = []
+    for genre, vals in books.items():
+        for book in vals:
+            # Incremental syncs append newer versions of a book, so the last one wins
+            unique_books[book["id"]] = book
+            genre_rows.append((book["id"], genre))
+    
+    cleaned = clean_books_tags_series({"all": list(unique_books.values())}, language_cache, workers)
+    tables = {name: frames["all"] for name, frames in cleaned.items()}
+    
+    # Only genres of books that survived cleaning
+    df_book_genres = pd.DataFrame(genre_rows, columns=["book_id", "genre"]).drop_duplicates()
+    df_book_genres = df_book_genres[df_book_genres["book_id"].isin(tables["books"]["id"])]
+    # A handful of genres repeated on every row, stored once as categories
+    tables["book_genres"] = df_book_genres.astype({"book_id": tables["books"]["id"].dtype, "genre": "category"})
+    return tables
+
 ###########    
 # Authors #
 ###########
+def match_authors(author_genre, book_author_ids):
+    """Keeps the authors of cleaned books, or every author if book_author_ids is None"""
+    author_list = []
+    for temp_dict in author_genre:
+        temp_author = {
+            "author_id": temp_dict["id"],
+            "name": temp_dict["name"],
+            "author_bio": temp_dict["bio"],
+            "born_year": temp_dict["born_year"],
+            "author_image": temp_dict["image"]["url"] if temp_dict["image"] is not None and "url" in temp_dict["image"] else None
+            }     
+        author_list.append(temp_author)
+    
+    # Incremental syncs append newer versions of an author, so the last one wins
+    df_temp = pd.DataFrame(author_list).drop_duplicates("author_id", keep="last")
+    
+    if book_author_ids is not None:
+        df_temp = df_temp[df_temp["author_id"].isin(book_author_ids)]
+    
+    df_matched_temp = df_temp.copy()
+    
+    df_matched_temp["author_id"] = id_column(df_temp["author_id"])
+    df_matched_temp["born_year"] = int32_column(df_temp["born_year"])
+    return df_matched_temp
+
 def clean_authors(filepath, book_author_cleaned):
     authors_cleaned = {}
-    df_authors = pd.read_csv(f"{filepath}/authors.csv", usecols=["genre", "author"])
+    authors_by_genre = read_by_genre(filepath, "authors", "author")
     
-    for genre in df_authors["genre"].unique():
-        author_genre = df_authors[df_authors["genre"] == genre]["author"].tolist()
-        author_list = []
-        for author in author_genre:
-            temp_dict = ast.literal_eval(author)
-            temp_author = {
-                "author_id": temp_dict["id"],
-                "name": temp_dict["name"],
-                "author_bio": temp_dict["bio"],
-                "born_year": temp_dict["born_year"],
-                "author_image": temp_dict["image"]["url"] if temp_dict["image"] is not None and "url" in temp_dict["image"] else None
-                }     
-            author_list.append(temp_author)
-        
-        df_temp = pd.DataFrame(author_list).drop_duplicates()
-        
+    for genre, author_genre in authors_by_genre.items():
         #### Matching author_id with cleaned books
         df_book_author_cleaned = book_author_cleaned[genre]
         
-        # Explode into one row per book
-        exploded = df_book_author_cleaned.explode("book_author_id")
-        
         # Unique IDs
-        book_author_ids = exploded["book_author_id"].unique()
+        book_author_ids = df_book_author_cleaned["author_id"].unique()
         
-        mask = df_temp["author_id"].isin(book_author_ids)
-        
-        df_matched_temp = df_temp[mask].copy()
-        
-        df_matched_temp["born_year"] = (
-            pd.to_numeric(df_temp["born_year"], errors="coerce").astype("Int64")
-            )
-        authors_cleaned[genre] = df_matched_temp
+        authors_cleaned[genre] = match_authors(author_genre, book_author_ids)
     return authors_cleaned
 
+def clean_authors_merged(filepath, book_authors):
+    """Cleans every author once across genres, given the merged book_authors table"""
+    authors_by_genre = read_by_genre(filepath, "authors", "author")
+    unique_authors = {author["id"]: author for vals in authors_by_genre.values() for author in vals}
+    return match_authors(unique_authors.values(), book_authors["author_id"].unique())
+
 ############
 # Tags Raw #
 ############
+def flatten_tags(rows):
+    """Flattens raw tag records into tag rows with their category"""
+    tags_raw = []
+    for row in rows:
+        category = row["tag_category"] or {}
+        tags_raw.append({
+            "tag_id": row["id"], 
+            "tag_name": row["tag"], 
+            "category": category.get("category"), 
+            "category_id": category.get("id")
+        })
+    return tags_raw
+
 def read_tags(filepath):
     tags_raw = []
-    with open(f"{filepath}/tags.csv", "r", encoding="utf-8") as f:
-        reader = csv.reader(f)
-        next(reader)
-        for row in reader:
-            row_3 = ast.literal_eval(row[3])
-            tags_raw.append({
-                "tag_id": row[1], 
-                "tag_name": row[2], 
-                "category": row_3["category"], 
-                "category_id": row_3["id"]
-            })
+    for chunk in iter_raw(f"{filepath}/tags.jsonl"):
+        tags_raw.extend(flatten_tags(chunk))
     return tags_raw
 
 ################
@@ -222,10 +256,34 @@ def read_tags(filepath):
 ################
 def clean_tags(tags_raw):
     df_raw = pd.DataFrame(tags_raw)
+    df_raw["tag_id"] = id_column(df_raw["tag_id"])
+    df_raw["category_id"] = int32_column(df_raw["category_id"])
+    # Every tag repeats one of a few category names
+    df_raw["category"] = df_raw["category"].astype("category")
     tags = {}
     for c in df_raw["category"].unique():
         if c in ("Easiness", "Member", "Pace", "Queer", "note", "quote"):
             continue
         df_temp = df_raw[df_raw["category"] == c].copy()
         tags[c] = df_temp[["tag_id", "tag_name", "category", "category_id"]]
-    return tags
\ No newline at end of file
+    return tags
+
+##############
+# Book Stats #
+##############
+def read_book_stats(filepath):
+    """Latest ratings and counts per book from a stats-refresh crawl"""
+    stats = {}
+    for chunk in iter_raw(f"{filepath}/{raw_filename('books.jsonl', 'stats-refresh')}"):
+        for row in chunk:
+            # A book in several genres comes back once per genre
+            stats[row["book"]["id"]] = row["book"]
+    return list(stats.values())
+
+def clean_book_stats(stats_raw):
+    df = pd.DataFrame(stats_raw, columns=["id", *book_stats_columns]).rename(columns={"id": "book_id"})
+    df["book_id"] = id_column(df["book_id"])
+    df["rating"] = rating_column(df["rating"])
+    for column in book_stats_columns[1:]:
+        df[column] = int32_column(df[column])
+    return df
\ No newline at end of file
@@ -0,0 +1,8 @@
+import os
+
+from raw_store import convert_csv_store
+
+data_path = os.environ["BOOK_RECOMMENDATION_DATA_PATH"]
+
+# One-off rewrite of books.csv, authors.csv and tags.csv from older crawls into JSONL
+convert_csv_store(data_path)
@@ -0,0 +1,202 @@
+import re
+import time
+from collections import Counter
+import numpy as np
+from scipy import sparse
+from scipy.sparse.linalg import svds
+
+from array_store import load_arrays, save_arrays
+from language_filter import english_words
+from recommender import book_rows
+
+# Words kept in the vocabulary: at least min_df books, at most max_df of them
+min_df = 2
+max_df = 0.5
+max_features = 50000
+
+# Files of saved vectors, one .npy array each; the vocabulary, idf and components
+# project descriptions of books added later into the same space
+vector_files = ["book_ids", "vectors", "vocabulary", "idf", "components"]
+
+##########
+# TF-IDF #
+##########
+def tokenize(text):
+    if not isinstance(text, str):
+        return []
+    return [word for word in re.findall(r"[a-z][a-z']+", text.lower()) if word not in english_words]
+
+def read_descriptions(cur, book_ids=None):
+    """Reads the descriptions of every book, or of book_ids, ordered by book_id"""
+    if book_ids is None:
+        cur.execute("SELECT book_id, description FROM books ORDER BY book_id")
+    else:
+        cur.execute("SELECT book_id, description FROM books WHERE book_id = ANY(%s) ORDER BY book_id",
+                    ([int(book_id) for book_id in book_ids],))
+    rows = cur.fetchall()
+    return np.array([row[0] for row in rows], dtype=np.int64), [row[1] for row in rows]
+
+def tfidf_matrix(descriptions, min_df=min_df, max_df=max_df, max_features=max_features):
+    """Fits a vocabulary to the descriptions and returns their TF-IDF matrix, vocabulary and idf"""
+    tokens = [Counter(tokenize(text)) for text in descriptions]
+    n = len(tokens)
+    document_counts = Counter(word for counts in tokens for word in counts)
+    vocabulary = [
+        word for word, count in document_counts.most_common()
+        if min_df <= count <= max_df * n
+        ][:max_features]
+    idf = np.log((1 + n) / (1 + np.array([document_counts[word] for word in vocabulary]))) + 1
+    return transform_tfidf(tokens, vocabulary, idf), vocabulary, idf.astype(np.float32)
+
+def transform_tfidf(tokens, vocabulary, idf):
+    """Sparse TF-IDF matrix with one L2-normalized row per tokenized description
+
+    Term counts are dampened (1 + log tf) so a word repeated in a long blurb does not
+    outweigh the rest of it.
+    """
+    columns = {word: i for i, word in enumerate(vocabulary)}
+    rows, cols, values = [], [], []
+    for row, counts in enumerate(tokens):
+        for word, count in counts.items():
+            col = columns.get(word)
+            if col is not None:
+                rows.append(row)
+                cols.append(col)
+                values.append(1 + np.log(count))
+    matrix = sparse.csr_matrix((np.array(values, dtype=np.float32), (rows, cols)),
+                               shape=(len(tokens), len(vocabulary)))
+    return normalize_rows(matrix @ sparse.diags(np.asarray(idf, dtype=np.float32)))
+
+def normalize_rows(matrix):
+    if sparse.issparse(matrix):
+        norms = np.sqrt(np.asarray(matrix.multiply(matrix).sum(axis=1)).ravel())
+        norms[norms == 0] = 1
+        return sparse.diags(1 / norms) @ matrix
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1
+    return matrix / norms
+
+###########
+# Vectors #
+###########
+class DescriptionVectors:
+    """Dense float32 description vectors, one row per book in book_id order
+
+    The TF-IDF matrix is reduced to dim dimensions with a truncated SVD (latent
+    semantic analysis), so books whose blurbs use related words end up close even
+    without a word in common. Saved as .npy files and loaded memory-mapped, so every
+    process reading them shares the same pages instead of re-vectorizing the text.
+    """
+    def __init__(self, book_ids, vectors, vocabulary, idf, components):
+        self.book_ids = book_ids
+        self.vectors = vectors
+        self.vocabulary = vocabulary
+        self.idf = idf
+        self.components = components
+
+    @classmethod
+    def build(cls, book_ids, descriptions, dim=128):
+        start = time.perf_counter()
+        book_ids = np.asarray(book_ids, dtype=np.int64)
+        order = np.argsort(book_ids, kind="stable")
+        book_ids = book_ids[order]
+        matrix, vocabulary, idf = tfidf_matrix([descriptions[i] for i in order])
+
+        dim = min(dim, min(matrix.shape) - 1)
+        if dim < 1:
+            components = np.zeros((0, len(vocabulary)), dtype=np.float32)
+        else:
+            # A fixed starting vector keeps the decomposition the same from run to run
+            v0 = np.random.default_rng(0).standard_normal(min(matrix.shape))
+            _, _, vt = svds(matrix.astype(np.float64), k=dim, v0=v0)
+            # Largest singular value first
+            components = vt[::-1].astype(np.float32)
+        vectors = normalize_rows(np.asarray(matrix @ components.T, dtype=np.float32))
+        print(f"Description vectors: {len(book_ids)} books, {len(vocabulary)} words, "
+              f"{vectors.shape[1]} dimensions in {time.perf_counter() - start:.2f}s")
+        return cls(book_ids, vectors, np.array(vocabulary, dtype=str), idf, components)
+
+    @classmethod
+    def load(cls, path, mmap=True):
+        return cls(*load_arrays(path, vector_files, mmap))
+
+    def save(self, path):
+        save_arrays(path, {name: getattr(self, name) for name in vector_files})
+
+    def transform(self, descriptions):
+        """Projects descriptions into the space of the saved vectors"""
+        tokens = [Counter(tokenize(text)) for text in descriptions]
+        matrix = transform_tfidf(tokens, list(self.vocabulary), self.idf)
+        return normalize_rows(np.asarray(matrix @ np.asarray(self.components).T, dtype=np.float32))
+
+    def add(self, book_ids, descriptions):
+        """Vectors with books added or replaced, without refitting the vocabulary or SVD
+
+        Returns a new DescriptionVectors; the vectors of the new books are returned too,
+        e.g. to insert them into an ANN index.
+        """
+        book_ids = np.asarray(book_ids, dtype=np.int64)
+        vectors = self.transform(descriptions)
+        keep = ~np.isin(self.book_ids, book_ids)
+        all_ids = np.concatenate([np.asarray(self.book_ids)[keep], book_ids])
+        all_vectors = np.concatenate([np.asarray(self.vectors)[keep], vectors])
+        order = np.argsort(all_ids, kind="stable")
+        added = DescriptionVectors(all_ids[order], all_vectors[order], self.vocabulary,
+                                   self.idf, self.components)
+        return added, vectors
+
+    def vectors_of(self, book_ids):
+        """Vectors of the known ids among book_ids, with the ids they belong to"""
+        rows = book_rows(self.book_ids, book_ids)
+        rows = rows[rows >= 0]
+        return np.asarray(self.book_ids[rows]), np.asarray(self.vectors[rows])
+
+    def query_vector(self, book_ids):
+        """Normalized mean vector of the known ids among book_ids, None if there are none"""
+        known, vectors = self.vectors_of(book_ids)
+        if len(known) == 0:
+            return None
+        return normalize_rows(vectors.mean(axis=0, keepdims=True))[0]
+
+    def similar(self, book_ids, k=10, index=None, nprobe=None):
+        """Books whose descriptions are closest to the mean of book_ids'
+
+        Exact cosine search over every book, or an approximate one through an
+        IvfIndex over these vectors when index is given.
+        """
+        query = self.query_vector(book_ids)
+        if query is None:
+            return []
+        exclude = set(int(book_id) for book_id in book_ids)
+        if index is not None:
+            ids, scores = index.search(query[None], k + len(exclude), nprobe)
+            ids, scores = ids[0], scores[0]
+        else:
+            ids, scores = exact_search(self.book_ids, self.vectors, query[None], k + len(exclude))
+            ids, scores = ids[0], scores[0]
+        return [
+            (int(book_id), float(score)) for book_id, score in zip(ids, scores)
+            if book_id >= 0 and int(book_id) not in exclude
+            ][:k]
+
+def exact_search(ids, vectors, queries, k=10, chunksize=100000):
+    """Top k ids by inner product for every query, scanning vectors chunksize rows at a time"""
+    queries = np.asarray(queries, dtype=np.float32)
+    best_ids = np.full((len(queries), 0), -1, dtype=np.int64)
+    best_scores = np.full((len(queries), 0), -np.inf, dtype=np.float32)
+    for start in range(0, len(vectors), chunksize):
+        scores = queries @ np.asarray(vectors[start:start + chunksize]).T
+        chunk_ids = np.broadcast_to(np.asarray(ids[start:start + chunksize]), scores.shape)
+        best_ids, best_scores = top_k_columns(
+            np.hstack([best_ids, chunk_ids]), np.hstack([best_scores, scores]), k
+            )
+    return best_ids, best_scores
+
+def top_k_columns(ids, scores, k):
+    """Keeps the k highest scores of every row, highest first"""
+    if scores.shape[1] > k:
+        top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+        ids = np.take_along_axis(ids, top, axis=1)
+        scores = np.take_along_axis(scores, top, axis=1)
+    order = np.argsort(-scores, axis=1, kind="stable")
+    return np.take_along_axis(ids, order, axis=1), np.take_along_axis(scores, order, axis=1)
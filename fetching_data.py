@@ -1,14 +1,20 @@
+import asyncio
 import requests
-import pandas as pd
-import time
 import os
-import csv
+
+from async_fetcher import crawl
+from instrumentation import metrics
+from queries import genres
+from raw_store import (
+    CrawlJournal, clear_raw_files, load_sync_state, save_sync_state, max_raw_id
+    )
 
 data_path = os.environ["BOOK_RECOMMENDATION_DATA_PATH"]
 
 os.chdir(data_path)
 
-url = "https://api.hardcover.app/v1/graphql"
+# Overridable so the crawl can be pointed at a local stub server
+url = os.environ.get("HARDCOVER_URL", "https://api.hardcover.app/v1/graphql")
 
 headers = {
     "Content-Type": "application/json",
@@ -16,196 +22,78 @@ headers = {
     "User-Agent": requests.utils.default_user_agent()
     }
 
-genres = [
-    "Biography", "Nonfiction", "General", "Biography & Autobiography", 
-    "Science", "Philosophy", "Business & Economics", "Mathematics", 
-    "Psychology", "Politics", "Computers", "Education", "Self-Help", 
-    "Health & Fitness", "Technology & Engineering", "Finance"
-]
-
-def make_request(query, variables=None, max_retries=5, timeout=30):
-    """Function to handle timeouts and exceptions"""
-    retries = 0
-    success = False
-    while retries < max_retries and not success:
-        try:
-            response = requests.post(url, json={"query": query, "variables": variables},
-                                     headers=headers, timeout=timeout)
-            data = response.json()
-            success = True
-            return data
-        except requests.exceptions.Timeout:
-            retries += 1
-            print(f"Request timed out. Retry {retries}/{max_retries}")
-            time.sleep(5)
-        except Exception as e:
-            print("An error occurred:", e)
-            break
-    return None
-
-###################
-# Books & Authors # 
-###################
-
-# Store results by genre
-all_books = {}
-all_authors = {}
-
-for genre in genres:
-    print(f"Processing genre: {genre}")
-    offset = 0
-    limit = 100
-    books = []
-    
-    # Books
-    while True:
-        query_books = f"""
-        query Books($offset: Int, $limit: Int) {{
-          books(
-            where: {{taggings: {{tag: {{tag: {{_eq: "{genre}"}}}}}}}},
-            order_by: {{title: asc}},
-            offset: $offset,
-            limit: $limit
-          ) {{
-            pages
-            title
-            id
-            rating
-            release_year
-            description
-            created_at
-            ratings_count
-            reviews_count
-            editions_count
-            lists_count
-            users_read_count
-            contributions {{
-                author_id
-                }}
-            book_series {{
-              book_id
-              featured
-              position
-              series {{
-                id
-                name
-              }}
-            }}
-            image {{
-              url
-            }}
-            taggings {{
-              tag_id
-            }}
-          }}
-        }}
-        """
-        variables = {"offset": offset, "limit": limit}
-        data = make_request(query_books, variables=variables)
-        if data is None:
-            print("Request failed; exiting books loop for this genre.")
-            break
-
-        result = data.get("data", {}).get("books")
-        if not result:
-            print(f"No more books returned for genre {genre} at offset {offset}.")
-            break
-
-        books.extend(result)
-        offset += limit
-        print("Books offset:", offset)
-        time.sleep(1)
-
-    all_books[genre] = books
-
-    # Authors
-    offset_authors = 0
-    limit_authors = 100
-    authors = []
-    
-    while True:
-        query_authors = f"""
-        query Authors($offset: Int, $limit: Int) {{
-          authors(
-            where: {{contributions: {{book: {{taggings: {{tag: {{tag: {{_eq: "{genre}"}}}}}}}}}}}},
-            order_by: {{name: asc}},
-            offset: $offset,
-            limit: $limit
-          ) {{
-            id
-            name
-            bio
-            born_year
-            image {{
-              url
-            }}
-          }}
-        }}
-        """
-        variables = {"offset": offset_authors, "limit": limit_authors}
-        data = make_request(query_authors, variables=variables)
-        if data is None:
-            print("Authors request failed for genre:", genre)
-            break
-    
-        result = data.get("data", {}).get("authors")
-        if not result:
-            print(f"No more authors returned for genre {genre} at offset {offset_authors}.")
-            break
-    
-        authors.extend(result)
-        offset_authors += limit_authors
-        print("Authors offset:", offset_authors)
-        time.sleep(1)
-    
-    all_authors[genre] = authors
-
-df_books = pd.DataFrame([(genre, book) for genre, books in all_books.items() for book in books],
-                        columns=["genre", "book"])
-df_authors = pd.DataFrame([(genre, author) for genre, authors in all_authors.items() for author in authors],
-                          columns=["genre", "author"])
-
-df_books.to_csv("books.csv")
-df_authors.to_csv("authors.csv")
-
-########
-# Tags #
-########
-all_tags = []
-offset_tags = 0
-limit_tags = 100  
-
-while True:
-    query_tags = """
-    query Tags($offset: Int, $limit: Int) {
-      tags(
-        offset: $offset,
-        limit: $limit
-      ) {
-        id
-        tag
-        tag_category {
-            category
-            id
-            }
-      }
-    }
-    """
-    variables = {"offset": offset_tags, "limit": limit_tags}
-    data = make_request(query_tags, variables=variables)
-    if data is None:
-        print(f"Tags request failed for {offset_tags}")
-        break
-    
-    result = data.get("data", {}).get("tags")
-    if not result:
-        print(f"No more tags returned at offset {offset_tags}.")
-        break
-    
-    all_tags.extend(result)
-    offset_tags += limit_tags
-    print("Tags offset:", offset_tags)
-    time.sleep(1)
-
-df_tags = pd.DataFrame(all_tags)
-df_tags.to_csv("tags.csv")
+# Requests per second and burst shared by all workers, and max requests in flight
+rate = float(os.environ.get("HARDCOVER_RATE", "1"))
+burst = int(os.environ.get("HARDCOVER_BURST", "1"))
+max_concurrency = int(os.environ.get("HARDCOVER_CONCURRENCY", "8"))
+
+# Retries of a failed request, backing off exponentially from HARDCOVER_BACKOFF seconds
+max_retries = int(os.environ.get("HARDCOVER_MAX_RETRIES", "5"))
+backoff = float(os.environ.get("HARDCOVER_BACKOFF", "1"))
+
+# Rows per page to start with; pages shrink on timeouts and oversized responses down
+# to HARDCOVER_MIN_LIMIT, and grow while responses are fast up to HARDCOVER_MAX_LIMIT
+limit = int(os.environ.get("HARDCOVER_LIMIT", "100"))
+min_limit = int(os.environ.get("HARDCOVER_MIN_LIMIT", "10"))
+max_limit = int(os.environ.get("HARDCOVER_MAX_LIMIT", str(limit)))
+
+# "keyset" walks id > last seen id, "offset" is the old offset/limit paging
+pagination = os.environ.get("HARDCOVER_PAGINATION", "keyset")
+
+# "full" re-crawls everything, "incremental" only fetches what changed since the last sync
+sync_mode = os.environ.get("HARDCOVER_SYNC", "full")
+
+# "per-genre" downloads a book once per genre it is tagged with, "single-pass" collects
+# ids per genre first, downloads each book once and keeps membership in book_genres.jsonl
+fetch_mode = os.environ.get("HARDCOVER_FETCH_MODE", "per-genre")
+
+# Fields fetched: "full" records, "ids-only" genre membership, or "stats-refresh" for
+# ratings and read counts only, applied to loaded books by refreshing_stats.py. Partial
+# profiles ignore HARDCOVER_SYNC=incremental and always crawl in full, into their own
+# raw files and journal
+fetch_profile = os.environ.get("HARDCOVER_FETCH_PROFILE", "full")
+raw_suffix = "" if fetch_profile == "full" else f".{fetch_profile}"
+journal_path = f"crawl_journal{raw_suffix}.json"
+
+# Comma-separated stages run under cProfile ("all" for every stage), and "1" to trace
+# each stage's peak memory; the run report goes to data_path/run_reports
+metrics.configure(profile=os.environ.get("PIPELINE_PROFILE", ""),
+                  trace_memory=os.environ.get("PIPELINE_TRACE_MEMORY", "0") == "1",
+                  profile_path=f"{data_path}/run_reports/profiles")
+
+#########################
+# Books, Authors & Tags #
+#########################
+# An unfinished journal means the last run stopped early, so it is resumed
+journal = CrawlJournal(journal_path)
+if journal.finished or not journal.state["pages"]:
+    sync_state = load_sync_state("sync_state.json")
+    since = sync_state.get("watermark") if sync_mode == "incremental" and fetch_profile == "full" else None
+    if since is None:
+        clear_raw_files(".", fetch_profile)
+    journal.reset(since)
+    if since is not None:
+        # New tags get new ids, so the tags query carries on after the highest one stored
+        journal.record_page("tags", "keyset", max_raw_id("tags.jsonl"), 0)
+        print(f"Incremental sync of books and authors changed since {since}")
+else:
+    since = journal.state.get("since")
+    print(f"Resuming the previous crawl from {journal_path}")
+
+# Every genre's books and authors plus the tags are paged concurrently,
+# and each page is appended to the raw files as it arrives
+with metrics.stage("fetch"):
+    asyncio.run(
+        crawl(url, headers, genres, rate=rate, burst=burst, max_concurrency=max_concurrency,
+              limit=limit, pagination=pagination, store_path=".", journal=journal, since=since,
+              single_pass=fetch_mode == "single-pass", max_retries=max_retries, backoff=backoff,
+              min_limit=min_limit, max_limit=max_limit, profile=fetch_profile)
+        )
+
+if not journal.finished:
+    print(f"Some pages failed; run again to resume from {journal_path}")
+elif fetch_profile == "full":
+    # The next incremental run asks for everything changed since this one started
+    save_sync_state("sync_state.json", {"watermark": journal.state["started_at"]})
+
+metrics.write_report(f"{data_path}/run_reports", f"fetch{raw_suffix}", finished=journal.finished)
@@ -1,6 +1,5 @@
 import os
 import psycopg2
-from psycopg2.extras import execute_values
 import pandas as pd
 
 module_path = os.environ["BOOK_RECOMMENDATION_PATH"]
@@ -10,17 +9,38 @@ os.chdir(module_path)
 
 from cleaning_pre_postgresql import (
     read_books_raw, read_tags, 
-    clean_books_tags_series,
-    clean_authors, clean_tags
+    clean_books_merged,
+    clean_authors_merged, clean_tags
     )
-
-books_raw = read_books_raw(data_path)
-books_tags_series = clean_books_tags_series(books_raw)
-
-authors = clean_authors(data_path, books_tags_series["book_authors"])
-
-tags_raw = read_tags(data_path)
-tags = clean_tags(tags_raw)
+from aggregates import capture_changes, refresh_aggregates
+from instrumentation import metrics
+from loading import load_tables
+from schema import book_frames, create_schema, tables
+
+# Comma-separated stages run under cProfile ("all" for every stage), and "1" to trace
+# each stage's peak memory; the run report goes to data_path/run_reports
+metrics.configure(profile=os.environ.get("PIPELINE_PROFILE", ""),
+                  trace_memory=os.environ.get("PIPELINE_TRACE_MEMORY", "0") == "1",
+                  profile_path=f"{data_path}/run_reports/profiles")
+
+with metrics.stage("parse") as stage:
+    books_raw = read_books_raw(data_path)
+    stage["rows"] = sum(len(rows) for rows in books_raw.values())
+
+# One deduplicated table per entity across genres, plus the book_genres mapping
+# Language detection results are cached next to the raw data, so re-runs skip the detector
+with metrics.stage("clean_books") as stage:
+    books_tags_series = clean_books_merged(books_raw, language_cache=f"{data_path}/language_cache.sqlite")
+    stage["rows"] = len(books_tags_series["books"])
+
+with metrics.stage("clean_authors") as stage:
+    authors = clean_authors_merged(data_path, books_tags_series["book_authors"])
+    stage["rows"] = len(authors)
+
+with metrics.stage("clean_tags") as stage:
+    tags_raw = read_tags(data_path)
+    tags = clean_tags(tags_raw)
+    stage["rows"] = len(tags_raw)
 
 # Connection parameters
 conn_params = {
@@ -31,206 +51,28 @@ conn_params = {
     "port": 5432
     }
 
-# Connection to postgresql server
-conn = psycopg2.connect(**conn_params)
-
-# Execute commands
-cur = conn.cursor()
-
-#########
-# Books #
-#########
-query_table_books = """
-CREATE TABLE IF NOT EXISTS books (
-    id SERIAL PRIMARY KEY,
-    pages INT,
-    title TEXT,
-    book_id BIGINT,
-    rating NUMERIC(2,1),
-    release_year INT,
-    description TEXT,
-    created_at DATE,
-    ratings_count INT,
-    reviews_count INT,
-    editions_count INT,
-    lists_count INT,
-    users_read_count INT,
-    book_image TEXT
-    );
-"""
-
-cur.execute(query_table_books)
-
-book_rows = []
-for df in books_tags_series["books"].values():
-    # Setting plain python objects & converting NA into None if present
-    df_clean = df.astype(object).where(pd.notna(df), None)
-    
-    # List of tuples for each row in the dataframes
-    book_rows += df_clean.itertuples(index=False, name=None)
-    
-# INSERT all tuples 
-execute_values(
-    cur,
-    """
-    INSERT INTO books
-      (pages, title, book_id, rating, release_year, description, created_at,
-       ratings_count, reviews_count, editions_count, lists_count, users_read_count, book_image)
-    VALUES %s
-    """,
-    book_rows
-)
-
-# Commit changes
-conn.commit()
-
-################
-# Book Authors #
-################
-query_table_book_authors = """
-CREATE TABLE IF NOT EXISTS book_authors (
-    id SERIAL PRIMARY KEY,
-    book_id BIGINT,
-    author_id BIGINT[]
-    );
-"""
-
-cur.execute(query_table_book_authors)
-
-book_authors_rows = []
-for df in books_tags_series["book_authors"].values():
-    df_clean = df.copy()
-    book_authors_rows += df_clean.itertuples(index=False, name=None)
-
-execute_values(
-    cur,
-    """
-    INSERT INTO book_authors (book_id, author_id)
-    VALUES %s
-    """,
-    book_authors_rows
-    )
-
-conn.commit()
-
-#############
-# Book Tags #
-#############
-query_table_book_tags = """
-CREATE TABLE IF NOT EXISTS book_tags (
-    id SERIAL PRIMARY KEY,
-    book_id BIGINT,
-    tag_id INT[]
-    );
-"""
-
-cur.execute(query_table_book_tags)
-
-book_tags_rows = []
-for df in books_tags_series["book_tags"].values():
-    df_clean = df.copy()
-    book_tags_rows += df_clean.itertuples(index=False, name=None)
-
-execute_values(
-    cur,
-    """
-    INSERT INTO book_tags (book_id, tag_id)
-    VALUES %s
-    """,
-    book_tags_rows
-    )
-
-conn.commit()
-
-###############
-# Book Series #
-###############
-query_table_book_series = """
-CREATE TABLE IF NOT EXISTS book_series (
-    id SERIAL PRIMARY KEY,
-    book_id BIGINT,
-    position INT,
-    related_book_id BIGINT
-    );
-"""
-
-cur.execute(query_table_book_series)
-
-book_series_rows = []
-for df in books_tags_series["book_series"].values():
-    df_clean = df.astype(object).where(pd.notna(df), None)
-    book_series_rows += df_clean.itertuples(index=False, name=None)
-
-execute_values(
-    cur,
-    """
-    INSERT INTO book_series (book_id, position, related_book_id)
-    VALUES %s
-    """,
-    book_series_rows
-    )
-
-conn.commit()
-
-###########
-# Authors #
-###########
-query_table_authors = """
-CREATE TABLE IF NOT EXISTS authors (
-    id SERIAL PRIMARY KEY,
-    author_id BIGINT,
-    name TEXT,
-    author_bio TEXT,
-    born_year INT,
-    author_image TEXT
-    );
-"""
-
-cur.execute(query_table_authors)
-
-authors_rows = []
-for df in authors.values():
-    df_clean = df.astype(object).where(pd.notna(df), None)
-    authors_rows += df_clean.itertuples(index=False, name=None)
-
-execute_values(
-    cur,
-    """
-    INSERT INTO authors (author_id, name, author_bio, born_year, author_image)
-    VALUES %s
-    """,
-    authors_rows
-    )
-
-conn.commit()
-            
 ########
-# Tags #
+# Load #
 ########
-query_table_tags = """
-CREATE TABLE IF NOT EXISTS tags (
-    id SERIAL PRIMARY KEY,
-    tag_id INT,
-    tag_name TEXT,
-    category TEXT,
-    category_id INT
-    );
-"""
-
-cur.execute(query_table_tags)
-
-tags_rows = []
-for key, df in tags.items():
-    df_clean = df.copy()
-    tags_rows += df_clean.itertuples(index=False, name=None)
+# Creating or migrating the tables before anything is staged against them
+with metrics.stage("schema"):
+    conn = psycopg2.connect(**conn_params)
+    with conn.cursor() as cur:
+        create_schema(cur)
+    conn.commit()
+    conn.close()
+
+frames = {
+    **book_frames(books_tags_series),
+    "authors": authors,
+    "tags": pd.concat(tags.values(), ignore_index=True)
+    }
 
-execute_values(
-    cur,
-    """
-    INSERT INTO tags (tag_id, tag_name, category, category_id)
-    VALUES %s
-    """,
-    tags_rows
-    )
+# Every table is staged concurrently, then all are merged in one transaction
+# so readers never see a partially loaded database; the read aggregates of the
+# affected books are refreshed in that same transaction
+with metrics.stage("load", rows=sum(len(df) for df in frames.values())):
+    load_tables(conn_params, tables, frames,
+                before_merge=[capture_changes], after_merge=[refresh_aggregates])
 
-conn.commit()
+metrics.write_report(f"{data_path}/run_reports", "ingest")
@@ -0,0 +1,209 @@
+import cProfile
+import json
+import os
+import pstats
+import resource
+import threading
+import time
+import tracemalloc
+from collections import deque
+from contextlib import contextmanager
+from datetime import datetime, timezone
+import numpy as np
+
+# Latencies kept per timer for its percentiles
+timer_window = 10000
+
+# Functions listed per profiled stage in the report, by cumulative time
+profile_top = 25
+
+##########
+# Timers #
+##########
+class Timer:
+    """Count, total and percentiles of the durations recorded under one name"""
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.samples = deque(maxlen=timer_window)
+
+    def add(self, seconds):
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+        self.samples.append(seconds)
+
+    def report(self):
+        samples = np.array(self.samples) * 1000
+        return {
+            "count": self.count,
+            "total_seconds": round(self.total, 4),
+            "mean_ms": round(self.total * 1000 / self.count, 3) if self.count else None,
+            "max_ms": round(self.max * 1000, 3),
+            **{f"p{p}_ms": round(float(np.percentile(samples, p)), 3) for p in (50, 90, 99)}
+            }
+
+###################
+# Instrumentation #
+###################
+class Instrumentation:
+    """Stages, timers and counters of one run, written out as a JSON report
+
+    A stage is a top-level step of a script, such as fetch, parse or load; it records
+    its wall time, rows per second and the process's peak memory. Stages named in
+    profile run under cProfile, and with trace_memory their own peak allocations are
+    traced. Timers and counters are recorded by the modules, from any thread.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.configure()
+        self.reset()
+
+    def configure(self, profile=(), trace_memory=False, profile_path=None):
+        """profile is a list or comma-separated string of stage names, or "all"
+
+        With profile_path each profiled stage's stats are also dumped to
+        <profile_path>/<stage>.prof for snakeviz or pstats.
+        """
+        if isinstance(profile, str):
+            profile = [name.strip() for name in profile.split(",") if name.strip()]
+        self.profile = set(profile)
+        self.trace_memory = trace_memory
+        self.profile_path = profile_path
+
+    def reset(self):
+        with self.lock:
+            self.started_at = datetime.now(timezone.utc)
+            self.stages = {}
+            self.timers = {}
+            self.counters = {}
+            self.profiling = False
+
+    ############
+    # Counters #
+    ############
+    def count(self, name, n=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def record(self, name, seconds):
+        with self.lock:
+            if name not in self.timers:
+                self.timers[name] = Timer()
+            self.timers[name].add(seconds)
+
+    @contextmanager
+    def timer(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - start)
+
+    ##########
+    # Stages #
+    ##########
+    @contextmanager
+    def stage(self, name, rows=None):
+        """Times a stage; rows, or info["rows"] set inside the block, gives its throughput
+
+            with metrics.stage("parse") as info:
+                books = read_books_raw(path)
+                info["rows"] = len(books)
+        """
+        info = {"rows": rows}
+        # cProfile and tracemalloc only cover the outermost stage using them
+        profiler = None
+        if (name in self.profile or "all" in self.profile) and not self.profiling:
+            self.profiling = True
+            profiler = cProfile.Profile()
+        tracing = self.trace_memory and not tracemalloc.is_tracing()
+        if tracing:
+            tracemalloc.start()
+        if profiler is not None:
+            profiler.enable()
+        start = time.perf_counter()
+        try:
+            yield info
+        finally:
+            seconds = time.perf_counter() - start
+            if profiler is not None:
+                profiler.disable()
+                self.profiling = False
+            result = {
+                "seconds": round(seconds, 4),
+                "rows": info["rows"],
+                "rows_per_second": round(info["rows"] / seconds) if info["rows"] and seconds else None,
+                "max_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+                }
+            if tracing:
+                result["peak_mb"] = round(tracemalloc.get_traced_memory()[1] / 2**20, 2)
+                tracemalloc.stop()
+            if profiler is not None:
+                result["profile"] = self.profile_stats(name, profiler)
+            with self.lock:
+                self.stages[name] = result
+            print(f"{name}: {seconds:.2f}s"
+                  + (f", {result['rows_per_second']:,} rows/s" if result["rows_per_second"] else "")
+                  + (f", {result['peak_mb']} MB peak" if tracing else ""))
+
+    def profile_stats(self, name, profiler):
+        """The stage's most expensive functions by cumulative time"""
+        stats = pstats.Stats(profiler)
+        if self.profile_path is not None:
+            os.makedirs(self.profile_path, exist_ok=True)
+            stats.dump_stats(f"{self.profile_path}/{name}.prof")
+        functions = sorted(stats.stats.items(), key=lambda item: item[1][3], reverse=True)
+        return [
+            {"function": f"{filename}:{line}({function})", "calls": calls,
+             "total_seconds": round(total, 4), "cumulative_seconds": round(cumulative, 4)}
+            for (filename, line, function), (_, calls, total, cumulative, _) in functions[:profile_top]
+            ]
+
+    ##########
+    # Report #
+    ##########
+    def report(self):
+        with self.lock:
+            return {
+                "started_at": self.started_at.isoformat(timespec="seconds"),
+                "seconds": round((datetime.now(timezone.utc) - self.started_at).total_seconds(), 3),
+                "stages": dict(self.stages),
+                "timers": {name: timer.report() for name, timer in sorted(self.timers.items())},
+                "counters": dict(sorted(self.counters.items()))
+                }
+
+    def write_report(self, path, name, **extra):
+        """Writes the report to <path>/<name>_<start time>.json and returns the file name"""
+        os.makedirs(path, exist_ok=True)
+        filename = f"{path}/{name}_{self.started_at:%Y%m%dT%H%M%S}.json"
+        tmp_path = f"{filename}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"name": name, **extra, **self.report()}, f, indent=2)
+        os.replace(tmp_path, filename)
+        print(f"Run report written to {filename}")
+        return filename
+
+def compare_reports(previous, current):
+    """Relative change of every stage's and timer's time between two reports"""
+    changes = {}
+    for section, field in (("stages", "seconds"), ("timers", "total_seconds")):
+        for name, result in current[section].items():
+            before = previous[section].get(name)
+            if before and before[field]:
+                changes[f"{section}.{name}"] = (result[field] - before[field]) / before[field]
+    return changes
+
+def latest_report(path, name):
+    """The most recent report of a script, or None"""
+    if not os.path.isdir(path):
+        return None
+    reports = sorted(f for f in os.listdir(path) if f.startswith(f"{name}_") and f.endswith(".json"))
+    if not reports:
+        return None
+    with open(f"{path}/{reports[-1]}", encoding="utf-8") as f:
+        return json.load(f)
+
+# Shared by every module of a run
+metrics = Instrumentation()
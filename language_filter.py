@@ -0,0 +1,136 @@
+import hashlib
+import re
+import sqlite3
+from concurrent.futures import ProcessPoolExecutor
+from langdetect import DetectorFactory, detect, LangDetectException
+
+from instrumentation import metrics
+
+# Fixed seed so a title always gets the same answer and cached results stay valid
+DetectorFactory.seed = 0
+
+# Common English words; two of them in an all-ASCII title is enough to skip the detector
+english_words = {
+    "the", "of", "and", "to", "for", "how", "why", "what", "with", "your",
+    "my", "from", "you", "is", "are", "this", "that", "when", "who"
+    }
+
+# Below this many titles a process pool costs more than it saves
+min_pool_titles = 2000
+
+# Book ids per cache lookup, below SQLite's bound parameter limit
+lookup_chunk = 500
+
+def is_english(title_text):
+    """Checks if title is in English"""
+    try:
+        return detect(title_text) == "en"
+    except LangDetectException:
+        return False
+
+def normalize_title(title):
+    return re.sub(r"\s+", " ", title).strip().casefold()
+
+def title_hash(title):
+    return hashlib.sha1(normalize_title(title).encode("utf-8")).hexdigest()
+
+def prefilter(title, ascii_threshold=0.5):
+    """Cheap verdict for obvious titles, None when the detector is needed"""
+    letters = [c for c in title if c.isalpha()]
+    if not letters:
+        return False
+    ascii_ratio = sum(c.isascii() for c in letters) / len(letters)
+    # Mostly non-Latin script
+    if ascii_ratio < ascii_threshold:
+        return False
+    words = set(re.findall(r"[a-z]+", title.lower()))
+    if ascii_ratio == 1 and len(words & english_words) >= 2:
+        return True
+    return None
+
+#########
+# Cache #
+#########
+def open_cache(cache_path):
+    conn = sqlite3.connect(cache_path)
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS language (
+        book_id INTEGER,
+        title_hash TEXT,
+        is_english INTEGER,
+        PRIMARY KEY (book_id, title_hash)
+        )
+    """)
+    return conn
+
+##########
+# Filter #
+##########
+def detect_english_titles(pairs, cache_path=None, workers=None, use_prefilter=True):
+    """Maps (book_id, title) pairs to whether the title is English
+
+    Results are looked up in and written to the on-disk cache keyed by book id and
+    title hash; each distinct normalized title is detected at most once per run.
+    """
+    pairs = set(pairs)
+    keys = {pair: (pair[0], title_hash(pair[1])) for pair in pairs}
+
+    cached = {}
+    conn = open_cache(cache_path) if cache_path is not None else None
+    if conn is not None:
+        # Only the rows of the requested books, so a small batch never reads the whole cache
+        book_ids = sorted({pair[0] for pair in pairs})
+        with metrics.timer("language.cache_lookup"):
+            for start in range(0, len(book_ids), lookup_chunk):
+                chunk = book_ids[start:start + lookup_chunk]
+                rows = conn.execute(
+                    f"SELECT book_id, title_hash, is_english FROM language "
+                    f"WHERE book_id IN ({', '.join('?' * len(chunk))})",
+                    chunk
+                    )
+                for book_id, hashed, english in rows:
+                    cached[(book_id, hashed)] = bool(english)
+
+    results = {}
+    n_cached = 0
+    n_prefiltered = 0
+    # One representative title per normalized title still needing a verdict
+    pending = {}
+    for pair in pairs:
+        key = keys[pair]
+        if key in cached:
+            results[pair] = cached[key]
+            n_cached += 1
+            continue
+        verdict = prefilter(pair[1]) if use_prefilter else None
+        if verdict is not None:
+            results[pair] = verdict
+            n_prefiltered += 1
+        else:
+            pending.setdefault(normalize_title(pair[1]), pair[1])
+
+    titles = list(pending.values())
+    with metrics.timer("language.detect"):
+        if len(titles) >= min_pool_titles and workers != 1:
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                detected = list(executor.map(is_english, titles, chunksize=500))
+        else:
+            detected = [is_english(title) for title in titles]
+    by_title = dict(zip(pending.keys(), detected))
+
+    for pair in pairs:
+        if pair not in results:
+            results[pair] = by_title[normalize_title(pair[1])]
+
+    if conn is not None:
+        new_rows = [(*keys[pair], int(results[pair])) for pair in pairs if keys[pair] not in cached]
+        conn.executemany("INSERT OR REPLACE INTO language VALUES (?, ?, ?)", new_rows)
+        conn.commit()
+        conn.close()
+    metrics.count("language.titles", len(pairs))
+    metrics.count("language.cached", n_cached)
+    metrics.count("language.prefiltered", n_prefiltered)
+    metrics.count("language.detected", len(titles))
+    print(f"Language filter: {len(pairs)} titles, {n_cached} cached, "
+          f"{n_prefiltered} pre-filtered, {len(titles)} detected")
+    return results
@@ -0,0 +1,246 @@
+import io
+import time
+from concurrent.futures import ThreadPoolExecutor
+from psycopg2.pool import ThreadedConnectionPool
+
+from instrumentation import metrics
+
+# Written for missing values, so empty strings stay empty strings
+null_marker = "\\N"
+
+def copy_table(cur, table, columns, df, chunksize=50000):
+    """Streams a DataFrame into a table with COPY ... FROM STDIN, chunksize rows at a time"""
+    start = time.perf_counter()
+    query = (
+        f"COPY {table} ({', '.join(columns)}) FROM STDIN "
+        f"WITH (FORMAT csv, NULL '{null_marker}')"
+        )
+    for offset in range(0, len(df), chunksize):
+        chunk = df.iloc[offset:offset + chunksize][list(columns)]
+
+        # Only one chunk is held as CSV text at a time
+        buffer = io.StringIO()
+        chunk.to_csv(buffer, index=False, header=False, na_rep=null_marker)
+        buffer.seek(0)
+        cur.copy_expert(query, buffer)
+
+    elapsed = time.perf_counter() - start
+    metrics.record(f"load.copy.{table}", elapsed)
+    metrics.count(f"load.rows.{table}", len(df))
+    rows_per_second = len(df) / elapsed if elapsed > 0 else float("inf")
+    print(f"{table}: {len(df)} rows in {elapsed:.2f}s ({rows_per_second:.0f} rows/s)")
+    return {"table": table, "rows": len(df), "seconds": elapsed, "rows_per_second": rows_per_second}
+
+##########
+# Upsert #
+##########
+def add_natural_key(cur, table, key):
+    """Declares the natural key of a table, first removing duplicates older loads left behind
+
+    Once the unique index exists there can be no duplicates, so later calls do nothing.
+    """
+    index = f"{table}_natural_key"
+    cur.execute(
+        "SELECT 1 FROM pg_indexes WHERE schemaname = current_schema() AND tablename = %s AND indexname = %s",
+        (table, index)
+        )
+    if cur.fetchone() is not None:
+        return
+    key_list = ", ".join(key)
+    # The newest row of every key is kept; keys with NULLs never conflict in the index
+    cur.execute(f"""
+    DELETE FROM {table}
+    WHERE id IN (
+        SELECT id FROM (
+            SELECT id, ROW_NUMBER() OVER (PARTITION BY {key_list} ORDER BY id DESC) AS n
+            FROM {table}
+            WHERE {" AND ".join(f"{column} IS NOT NULL" for column in key)}
+            ) AS ranked
+        WHERE n > 1
+        )
+    """)
+    cur.execute(f"CREATE UNIQUE INDEX IF NOT EXISTS {index} ON {table} ({key_list})")
+
+def merge_table(cur, table, columns, key, stage, prune_by=None):
+    """Merges a staged table into table on its natural key
+
+    Rows whose values did not change are left untouched, so repeated loads neither add
+    rows nor rewrite them. With prune_by, rows of the incoming prune_by values that are
+    no longer in the data (e.g. a tag removed from a book) are deleted.
+    """
+    column_list = ", ".join(columns)
+    key_list = ", ".join(key)
+    if prune_by is not None:
+        # Plain equality, as in the unique index, so the anti-join can hash or use the index
+        matches = " AND ".join(f"s.{column} = t.{column}" for column in key)
+        cur.execute(f"""
+        DELETE FROM {table} AS t
+        WHERE t.{prune_by} IN (SELECT {prune_by} FROM {stage})
+          AND NOT EXISTS (SELECT 1 FROM {stage} AS s WHERE {matches})
+        """)
+
+    updates = [column for column in columns if column not in key]
+    if updates:
+        current = ", ".join(f"{table}.{column}" for column in updates)
+        incoming = ", ".join(f"EXCLUDED.{column}" for column in updates)
+        set_clause = ", ".join(f"{column} = EXCLUDED.{column}" for column in updates)
+        conflict = f"DO UPDATE SET {set_clause} WHERE ({current}) IS DISTINCT FROM ({incoming})"
+    else:
+        conflict = "DO NOTHING"
+    cur.execute(f"""
+    INSERT INTO {table} ({column_list})
+    SELECT DISTINCT ON ({key_list}) {column_list} FROM {stage}
+    ORDER BY {key_list}
+    ON CONFLICT ({key_list}) {conflict}
+    """)
+
+def upsert_table(cur, table, columns, key, df, prune_by=None, chunksize=50000):
+    """Loads a DataFrame into a temporary staging table and merges it into table"""
+    stage = f"stage_{table}"
+    cur.execute(f"DROP TABLE IF EXISTS {stage}")
+    cur.execute(f"CREATE TEMP TABLE {stage} AS SELECT {', '.join(columns)} FROM {table} WITH NO DATA")
+    stats = copy_table(cur, stage, columns, df, chunksize)
+    merge_table(cur, table, columns, key, stage, prune_by)
+    cur.execute(f"DROP TABLE {stage}")
+    return stats
+
+def update_table(cur, table, columns, key, df, chunksize=50000):
+    """Updates columns of rows already in table from a DataFrame matched on key
+
+    Rows whose values did not change are not rewritten and unknown keys are ignored.
+    Returns the keys of the updated rows.
+    """
+    stage = f"stage_{table}"
+    key_list = ", ".join(key)
+    cur.execute(f"DROP TABLE IF EXISTS {stage}")
+    cur.execute(f"CREATE TEMP TABLE {stage} AS SELECT {', '.join([*key, *columns])} FROM {table} WITH NO DATA")
+    copy_table(cur, stage, [*key, *columns], df, chunksize)
+    current = ", ".join(f"t.{column}" for column in columns)
+    incoming = ", ".join(f"s.{column}" for column in columns)
+    cur.execute(f"""
+    UPDATE {table} AS t
+    SET {", ".join(f"{column} = s.{column}" for column in columns)}
+    FROM (SELECT DISTINCT ON ({key_list}) * FROM {stage} ORDER BY {key_list}) AS s
+    WHERE {" AND ".join(f"t.{column} = s.{column}" for column in key)}
+      AND ({current}) IS DISTINCT FROM ({incoming})
+    RETURNING {", ".join(f"t.{column}" for column in key)}
+    """)
+    updated = cur.fetchall()
+    cur.execute(f"DROP TABLE {stage}")
+    return updated
+
+###################
+# Parallel Loader #
+###################
+def create_stage(cur, table, columns, stage):
+    """Creates an empty unlogged copy of a table's columns to COPY into"""
+    # Unlogged, since the staged rows are thrown away after the merge
+    cur.execute(f"DROP TABLE IF EXISTS {stage}")
+    cur.execute(f"CREATE UNLOGGED TABLE {stage} AS SELECT {', '.join(columns)} FROM {table} WITH NO DATA")
+
+def merge_tables(conn, tables, staging_schema="staging", before_merge=(), after_merge=()):
+    """Merges every staged table in order and commits once
+
+    One transaction, so readers see either the old or the new data in every table.
+    The before_merge and after_merge functions are called with the cursor in the same
+    transaction, e.g. to filter staged rows or refresh derived tables.
+    """
+    start = time.perf_counter()
+    try:
+        with conn.cursor() as cur:
+            for hook in before_merge:
+                with metrics.timer(f"load.hook.{hook_name(hook)}"):
+                    hook(cur)
+            for table, spec in tables.items():
+                with metrics.timer(f"load.merge.{table}"):
+                    merge_table(cur, table, spec["columns"], spec["key"],
+                                f"{staging_schema}.{table}", spec.get("prune_by"))
+            for hook in after_merge:
+                with metrics.timer(f"load.hook.{hook_name(hook)}"):
+                    hook(cur)
+        with metrics.timer("load.commit"):
+            conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    metrics.record("load.merge", time.perf_counter() - start)
+    print(f"Merged {len(tables)} tables in {time.perf_counter() - start:.2f}s")
+
+def hook_name(hook):
+    # partial objects only carry the name of the function they wrap
+    return getattr(getattr(hook, "func", hook), "__name__", "hook")
+
+def drop_stages(conn, tables, staging_schema="staging"):
+    with conn.cursor() as cur:
+        for table in tables:
+            cur.execute(f"DROP TABLE IF EXISTS {staging_schema}.{table}")
+    conn.commit()
+
+def load_tables(conn_params, tables, frames, workers=4, staging_schema="staging",
+                before_merge=(), after_merge=()):
+    """Stages every table concurrently over a connection pool, then merges them in one transaction
+
+    tables maps each table to its columns, key and optional prune_by, in merge order,
+    and frames maps it to its DataFrame. A failure anywhere leaves the tables untouched.
+    """
+    pool = ThreadedConnectionPool(1, workers, **conn_params)
+    conn = pool.getconn()
+    with conn.cursor() as cur:
+        cur.execute(f"CREATE SCHEMA IF NOT EXISTS {staging_schema}")
+    conn.commit()
+    pool.putconn(conn)
+
+    def stage(table):
+        spec = tables[table]
+        stage_name = f"{staging_schema}.{table}"
+        conn = pool.getconn()
+        try:
+            with conn.cursor() as cur:
+                create_stage(cur, table, spec["columns"], stage_name)
+                stats = copy_table(cur, stage_name, spec["columns"], frames[table])
+            conn.commit()
+            return stats
+        finally:
+            pool.putconn(conn)
+
+    conn = None
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            stats = list(executor.map(stage, tables))
+        conn = pool.getconn()
+        merge_tables(conn, tables, staging_schema, before_merge, after_merge)
+    finally:
+        conn = conn or pool.getconn()
+        drop_stages(conn, tables, staging_schema)
+        pool.putconn(conn)
+        pool.closeall()
+    return stats
+
+#############
+# Migration #
+#############
+def migrate_array_table(cur, table, column, create_query):
+    """Rebuilds a (book_id, <column>[]) table from older loads as a junction table"""
+    cur.execute(
+        "SELECT data_type FROM information_schema.columns WHERE table_name = %s AND column_name = %s",
+        (table, column)
+        )
+    row = cur.fetchone()
+    if row is None or row[0] != "ARRAY":
+        return
+    print(f"Migrating {table}.{column} from an array column to a junction table")
+    cur.execute(f"""
+    CREATE TEMP TABLE {table}_edges AS
+    SELECT DISTINCT book_id, UNNEST({column}) AS {column} FROM {table}
+    """)
+    cur.execute(f"DROP TABLE {table}")
+    cur.execute(create_query)
+    # Edges of books that are no longer in books would break the foreign key
+    cur.execute(f"""
+    INSERT INTO {table} (book_id, {column})
+    SELECT e.book_id, e.{column}
+    FROM {table}_edges AS e
+    WHERE e.{column} IS NOT NULL AND e.book_id IN (SELECT book_id FROM books)
+    ON CONFLICT DO NOTHING
+    """)
+    cur.execute(f"DROP TABLE {table}_edges")
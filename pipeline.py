@@ -0,0 +1,145 @@
+import asyncio
+from functools import partial
+import pandas as pd
+import psycopg2
+
+from aggregates import capture_changes, refresh_aggregates
+from async_fetcher import crawl
+from cleaning_pre_postgresql import clean_books_merged, match_authors, flatten_tags, clean_tags
+from instrumentation import metrics
+from loading import copy_table, create_stage, merge_tables, drop_stages
+from schema import book_frames, create_schema, tables
+
+# Put on the page queue once the crawl is over
+end_of_crawl = None
+
+################
+# Batch Loader #
+################
+class BatchLoader:
+    """Buffers fetched pages and cleans and stages them batch_size rows at a time
+
+    Only the current batch is held in memory; everything cleaned so far lives in the
+    staging tables until the final merge.
+    """
+    def __init__(self, conn, batch_size=1000, language_cache=None, staging_schema="staging"):
+        self.conn = conn
+        self.batch_size = batch_size
+        self.language_cache = language_cache
+        self.staging_schema = staging_schema
+        self.pending = {"books": {}, "authors": [], "tags": []}
+        self.counts = {"books": 0, "authors": 0, "tags": 0}
+        self.staged = {table: 0 for table in tables}
+
+    def add(self, entity, genre, page):
+        if entity == "books":
+            self.pending["books"].setdefault(genre, []).extend(page)
+        else:
+            self.pending[entity].extend(page)
+        self.counts[entity] += len(page)
+        if self.counts[entity] >= self.batch_size:
+            self.flush(entity)
+
+    def clean(self, entity, rows):
+        if entity == "books":
+            # Books in several genres are deduplicated within the batch here and across
+            # batches by the merge, which keeps one row per natural key
+            return book_frames(clean_books_merged(rows, self.language_cache))
+        if entity == "authors":
+            # Whether an author wrote a kept book is only known once every book is staged
+            return {"authors": match_authors(rows, None)}
+        tags = clean_tags(flatten_tags(rows))
+        return {"tags": pd.concat(tags.values(), ignore_index=True)} if tags else {}
+
+    def flush(self, entity):
+        rows = self.pending[entity]
+        if not rows:
+            return
+        self.pending[entity] = {} if entity == "books" else []
+        self.counts[entity] = 0
+
+        with metrics.timer(f"pipeline.clean.{entity}"):
+            frames = self.clean(entity, rows)
+        metrics.count("pipeline.batches")
+        with self.conn.cursor() as cur:
+            for table, df in frames.items():
+                copy_table(cur, f"{self.staging_schema}.{table}", tables[table]["columns"], df)
+                self.staged[table] += len(df)
+        self.conn.commit()
+
+    def flush_all(self):
+        for entity in self.pending:
+            self.flush(entity)
+
+def drop_unmatched_authors(cur, staging_schema="staging"):
+    """Removes staged authors without a book, staged or already loaded"""
+    cur.execute(f"""
+    DELETE FROM {staging_schema}.authors AS a
+    WHERE NOT EXISTS (SELECT 1 FROM {staging_schema}.book_authors AS b WHERE b.author_id = a.author_id)
+      AND NOT EXISTS (SELECT 1 FROM book_authors AS b WHERE b.author_id = a.author_id)
+    """)
+
+############
+# Pipeline #
+############
+async def consume(queue, loader):
+    """Feeds queued pages to the loader until the end of the crawl"""
+    while True:
+        item = await queue.get()
+        if item is end_of_crawl:
+            break
+        # Cleaning and COPY block, so they run in a thread while the crawl goes on
+        await asyncio.to_thread(loader.add, *item)
+    await asyncio.to_thread(loader.flush_all)
+
+async def run_pipeline(url, headers, genres, conn_params, batch_size=1000, queue_size=8,
+                       language_cache=None, staging_schema="staging", **crawl_options):
+    """Crawls, cleans and loads in one pass with memory bounded by the batch and queue sizes
+
+    Pages go from the fetcher to a queue of at most queue_size pages; when the loader
+    falls behind the queue fills up and the fetcher waits. Cleaned batches are staged,
+    and every table is merged in one transaction after the crawl.
+    crawl_options are passed to crawl, which fetches books and authors per genre;
+    single_pass is not supported, since its records do not arrive as genre pages.
+    """
+    conn = psycopg2.connect(**conn_params)
+    try:
+        with conn.cursor() as cur:
+            create_schema(cur)
+            cur.execute(f"CREATE SCHEMA IF NOT EXISTS {staging_schema}")
+            for table, spec in tables.items():
+                create_stage(cur, table, spec["columns"], f"{staging_schema}.{table}")
+        conn.commit()
+
+        loader = BatchLoader(conn, batch_size, language_cache, staging_schema)
+        queue = asyncio.Queue(maxsize=queue_size)
+        consumer = asyncio.create_task(consume(queue, loader))
+
+        async def on_page(entity, genre, page):
+            put = asyncio.ensure_future(queue.put((entity, genre, page)))
+            # A failed loader would otherwise leave the fetcher waiting on a full queue
+            with metrics.timer("pipeline.queue_wait"):
+                await asyncio.wait({put, consumer}, return_when=asyncio.FIRST_COMPLETED)
+            if not put.done():
+                put.cancel()
+                consumer.result()
+                raise RuntimeError("The loader stopped before the end of the crawl")
+
+        try:
+            await crawl(url, headers, genres, on_page=on_page, **crawl_options)
+        finally:
+            if not consumer.done():
+                await queue.put(end_of_crawl)
+        await consumer
+
+        # The read aggregates of the affected books are refreshed in the same transaction
+        merge_tables(conn, tables, staging_schema,
+                     before_merge=[partial(drop_unmatched_authors, staging_schema=staging_schema),
+                                   partial(capture_changes, staging_schema=staging_schema)],
+                     after_merge=[refresh_aggregates])
+        print("Staged rows:", loader.staged)
+        return loader.staged
+    finally:
+        conn.rollback()
+        drop_stages(conn, tables, staging_schema)
+        conn.close()
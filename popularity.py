@@ -0,0 +1,200 @@
+import time
+import numpy as np
+import pandas as pd
+
+from array_store import load_arrays, save_arrays
+from loading import copy_table
+from recommender import book_rows
+
+# Weight of each count in the popularity prior, which averages their percentile ranks
+popularity_weights = {"users_read_count": 0.5, "lists_count": 0.3, "reviews_count": 0.2}
+
+# Share of the score that comes from the Bayesian rating, the rest from popularity
+rating_weight = 0.6
+
+# Ratings are out of 5
+max_rating = 5
+
+# Files of saved book scores, one .npy array each
+score_files = ["book_ids", "scores"]
+
+##########
+# Tables #
+##########
+query_table_book_scores = """
+CREATE TABLE IF NOT EXISTS book_scores (
+    book_id BIGINT PRIMARY KEY,
+    bayes_rating REAL,
+    popularity REAL,
+    score REAL
+    );
+CREATE INDEX IF NOT EXISTS book_scores_score_idx ON book_scores (score DESC);
+"""
+
+query_table_genre_book_scores = """
+CREATE TABLE IF NOT EXISTS genre_book_scores (
+    genre TEXT NOT NULL,
+    book_id BIGINT NOT NULL,
+    bayes_rating REAL,
+    popularity REAL,
+    score REAL,
+    rank INT,
+    PRIMARY KEY (genre, book_id)
+    );
+CREATE INDEX IF NOT EXISTS genre_book_scores_rank_idx ON genre_book_scores (genre, rank);
+"""
+
+query_table_author_scores = """
+CREATE TABLE IF NOT EXISTS author_scores (
+    author_id BIGINT PRIMARY KEY,
+    bayes_rating REAL,
+    popularity REAL,
+    score REAL
+    );
+CREATE INDEX IF NOT EXISTS author_scores_score_idx ON author_scores (score DESC);
+"""
+
+score_tables = {
+    "book_scores": ["book_id", "bayes_rating", "popularity", "score"],
+    "genre_book_scores": ["genre", "book_id", "bayes_rating", "popularity", "score", "rank"],
+    "author_scores": ["author_id", "bayes_rating", "popularity", "score"]
+    }
+
+###########
+# Scoring #
+###########
+def read_score_inputs(cur):
+    """Reads the rating and count columns of every book, with its genres and authors"""
+    columns = ["book_id", "rating", "ratings_count", *popularity_weights]
+    cur.execute(f"SELECT {', '.join(columns)} FROM books")
+    books = pd.DataFrame(cur.fetchall(), columns=columns)
+    cur.execute("SELECT book_id, genre FROM book_genres")
+    book_genres = pd.DataFrame(cur.fetchall(), columns=["book_id", "genre"])
+    cur.execute("SELECT book_id, author_id FROM book_authors")
+    book_authors = pd.DataFrame(cur.fetchall(), columns=["book_id", "author_id"])
+    return books, book_genres, book_authors
+
+def bayes_rating(rating_sum, count, prior_mean, prior_weight):
+    """Rating shrunk towards prior_mean, as if every book had prior_weight extra ratings of it"""
+    return (prior_weight * prior_mean + rating_sum) / (prior_weight + count)
+
+def popularity(counts, groups=None):
+    """Weighted mean of the percentile ranks of the counts, within groups if given"""
+    total = 0
+    for column, weight in popularity_weights.items():
+        values = counts[column]
+        ranks = values.groupby(groups).rank(pct=True) if groups is not None else values.rank(pct=True)
+        total = total + weight * ranks.fillna(0)
+    return total / sum(popularity_weights.values())
+
+def combined_score(rating, popular):
+    return rating_weight * rating / max_rating + (1 - rating_weight) * popular
+
+def score_books(books, book_genres, book_authors, prior_weight=None):
+    """Bayesian ratings, popularity priors and scores per book, per (genre, book) and per author
+
+    Each is a vectorized pass over the columns. The prior weight defaults to the
+    median number of ratings of rated books, so a book needs about as many ratings
+    as a typical book before its own average outweighs the prior.
+    """
+    start = time.perf_counter()
+    books = books.copy()
+    for column in ["ratings_count", *popularity_weights]:
+        books[column] = pd.to_numeric(books[column], errors="coerce").fillna(0).astype("float64")
+    books["rating"] = pd.to_numeric(books["rating"], errors="coerce").astype("float64")
+    # Books without a rating count as having no ratings
+    books.loc[books["rating"].isna(), "ratings_count"] = 0
+    books["rating_sum"] = books["rating"].fillna(0) * books["ratings_count"]
+
+    rated = books["ratings_count"] > 0
+    prior_mean = books["rating_sum"].sum() / max(books["ratings_count"].sum(), 1)
+    if prior_weight is None:
+        prior_weight = books.loc[rated, "ratings_count"].median() if rated.any() else 1
+
+    #########
+    # Books #
+    #########
+    book_scores = books[["book_id"]].copy()
+    book_scores["bayes_rating"] = bayes_rating(books["rating_sum"], books["ratings_count"],
+                                               prior_mean, prior_weight)
+    book_scores["popularity"] = popularity(books)
+    book_scores["score"] = combined_score(book_scores["bayes_rating"], book_scores["popularity"])
+
+    ##########
+    # Genres #
+    ##########
+    # Shrunk towards the genre's own mean, and popular relative to the genre
+    genre_books = book_genres.drop_duplicates().merge(books, on="book_id")
+    grouped = genre_books.groupby("genre")
+    genre_mean = (grouped["rating_sum"].transform("sum")
+                  / grouped["ratings_count"].transform("sum").clip(lower=1))
+    genre_mean = genre_mean.where(grouped["ratings_count"].transform("sum") > 0, prior_mean)
+    genre_scores = genre_books[["genre", "book_id"]].copy()
+    genre_scores["bayes_rating"] = bayes_rating(genre_books["rating_sum"], genre_books["ratings_count"],
+                                                genre_mean, prior_weight)
+    genre_scores["popularity"] = popularity(genre_books, genre_books["genre"])
+    genre_scores["score"] = combined_score(genre_scores["bayes_rating"], genre_scores["popularity"])
+    genre_scores["rank"] = (
+        genre_scores.groupby("genre")["score"].rank(method="first", ascending=False).astype("int64")
+        )
+
+    ###########
+    # Authors #
+    ###########
+    author_books = book_authors.drop_duplicates().merge(books, on="book_id")
+    authors = author_books.groupby("author_id")[
+        ["rating_sum", "ratings_count", *popularity_weights]
+        ].sum().reset_index()
+    author_scores = authors[["author_id"]].copy()
+    author_scores["bayes_rating"] = bayes_rating(authors["rating_sum"], authors["ratings_count"],
+                                                 prior_mean, prior_weight)
+    author_scores["popularity"] = popularity(authors)
+    author_scores["score"] = combined_score(author_scores["bayes_rating"], author_scores["popularity"])
+
+    print(f"Scored {len(book_scores)} books, {len(genre_scores)} genre books and "
+          f"{len(author_scores)} authors in {time.perf_counter() - start:.2f}s "
+          f"(prior mean {prior_mean:.2f}, prior weight {prior_weight:.0f})")
+    return {"book_scores": book_scores, "genre_book_scores": genre_scores, "author_scores": author_scores}
+
+def write_scores(conn, scores):
+    """Replaces the score tables in one transaction"""
+    try:
+        with conn.cursor() as cur:
+            cur.execute(query_table_book_scores)
+            cur.execute(query_table_genre_book_scores)
+            cur.execute(query_table_author_scores)
+            cur.execute(f"TRUNCATE {', '.join(score_tables)}")
+            for table, columns in score_tables.items():
+                copy_table(cur, table, columns, scores[table])
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+
+#################
+# Book Rankings #
+#################
+class BookScores:
+    """Book scores sorted by book_id, saved as .npy files for blending into recommendations"""
+    def __init__(self, book_ids, scores):
+        self.book_ids = book_ids
+        self.scores = scores
+
+    @classmethod
+    def from_frame(cls, book_scores):
+        book_scores = book_scores.sort_values("book_id")
+        return cls(book_scores["book_id"].to_numpy(np.int64), book_scores["score"].to_numpy(np.float32))
+
+    @classmethod
+    def load(cls, path, mmap=True):
+        return cls(*load_arrays(path, score_files, mmap))
+
+    def save(self, path):
+        save_arrays(path, {name: getattr(self, name) for name in score_files})
+
+    def score_of(self, book_ids):
+        """Scores of book_ids, 0 for unknown ids"""
+        if len(self.book_ids) == 0:
+            return np.zeros(len(book_ids), dtype=np.float32)
+        rows = book_rows(self.book_ids, book_ids)
+        return np.where(rows >= 0, np.asarray(self.scores)[np.maximum(rows, 0)], 0).astype(np.float32)
@@ -0,0 +1,164 @@
+##########
+# Fields #
+##########
+books_fields = """
+    pages
+    title
+    id
+    rating
+    release_year
+    description
+    created_at
+    ratings_count
+    reviews_count
+    editions_count
+    lists_count
+    users_read_count
+    contributions {
+        author_id
+        }
+    book_series {
+      book_id
+      featured
+      position
+      series {
+        id
+        name
+      }
+    }
+    image {
+      url
+    }
+    taggings {
+      tag_id
+    }
+"""
+
+authors_fields = """
+    id
+    name
+    bio
+    born_year
+    image {
+      url
+    }
+"""
+
+# Enough to collect ids and genre membership before downloading payloads once
+id_fields = """
+    id
+"""
+
+tags_fields = """
+    id
+    tag
+    tag_category {
+        category
+        id
+        }
+"""
+
+# The numbers that change between full crawls, for frequent refreshes
+stats_fields = """
+    id
+    rating
+    ratings_count
+    reviews_count
+    editions_count
+    lists_count
+    users_read_count
+"""
+
+############
+# Profiles #
+############
+# Fields fetched per entity by each fetch profile; entities a profile leaves out are
+# not fetched at all
+fetch_profiles = {
+    "full": {"books": books_fields, "authors": authors_fields, "tags": tags_fields},
+    # Genre membership only, e.g. to size a full crawl before running it
+    "ids-only": {"books": id_fields, "authors": id_fields},
+    # Ratings and read counts of books, to refresh books that are already loaded
+    "stats-refresh": {"books": stats_fields}
+    }
+
+##########
+# Genres #
+##########
+genres = [
+    "Biography", "Nonfiction", "General", "Biography & Autobiography", 
+    "Science", "Philosophy", "Business & Economics", "Mathematics", 
+    "Psychology", "Politics", "Computers", "Education", "Self-Help", 
+    "Health & Fitness", "Technology & Engineering", "Finance"
+]
+
+###########
+# Filters #
+###########
+# Genre is passed as a GraphQL variable so one query string serves every genre
+books_filter = "taggings: {tag: {tag: {_eq: $genre}}}"
+authors_filter = "contributions: {book: {taggings: {tag: {tag: {_eq: $genre}}}}}"
+
+def since_filter(since):
+    """Records created or changed after the sync watermark"""
+    # Inlined as a literal so Hasura coerces it to whichever timestamp type the column has
+    return f'_or: [{{created_at: {{_gt: "{since}"}}}}, {{updated_at: {{_gt: "{since}"}}}}]'
+
+#################
+# Query Builder #
+#################
+def build_query(root, fields, where=None, variables=None, order_field="id", pagination="keyset"):
+    """Builds a paginated query, either keyset (id > $last_id) or offset based"""
+    declared = dict(variables or {})
+    conditions = [where] if where else []
+    if pagination == "keyset":
+        # Walking the primary key keeps every page an index range scan
+        declared["last_id"] = "Int"
+        conditions.append("id: {_gt: $last_id}")
+        order_by = "{id: asc}"
+        paging = "limit: $limit"
+    else:
+        declared["offset"] = "Int"
+        order_by = f"{{{order_field}: asc}}"
+        paging = "offset: $offset,\n    limit: $limit"
+    declared["limit"] = "Int"
+
+    signature = ", ".join(f"${name}: {kind}" for name, kind in declared.items())
+    where_clause = f"where: {{{', '.join(conditions)}}},\n    " if conditions else ""
+    return f"""
+query {root.capitalize()}({signature}) {{
+  {root}(
+    {where_clause}order_by: {order_by},
+    {paging}
+  ) {{{fields}  }}
+}}
+"""
+
+def build_lookup_query(root, fields):
+    """Builds a query fetching the records for a batch of known ids, the lowest $limit of them"""
+    return f"""
+query {root.capitalize()}ById($ids: [Int!], $limit: Int) {{
+  {root}(
+    where: {{id: {{_in: $ids}}}},
+    order_by: {{id: asc}},
+    limit: $limit
+  ) {{{fields}  }}
+}}
+"""
+
+def books_query(pagination="keyset", since=None, fields=books_fields):
+    where = books_filter if since is None else f"{books_filter}, {since_filter(since)}"
+    return build_query("books", fields, where, {"genre": "String"}, "title", pagination)
+
+def authors_query(pagination="keyset", since=None, fields=authors_fields):
+    where = authors_filter if since is None else f"{authors_filter}, {since_filter(since)}"
+    return build_query("authors", fields, where, {"genre": "String"}, "name", pagination)
+
+def books_by_id_query(fields=books_fields):
+    return build_lookup_query("books", fields)
+
+def authors_by_id_query(fields=authors_fields):
+    return build_lookup_query("authors", fields)
+
+def tags_query(pagination="keyset", fields=tags_fields):
+    return build_query("tags", fields, pagination=pagination)
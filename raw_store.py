@@ -0,0 +1,232 @@
+import ast
+import csv
+import json
+import os
+import sys
+import time
+from collections import defaultdict
+from datetime import datetime, timezone
+
+from instrumentation import metrics
+
+# Newline-delimited JSON, one record per line, appended page by page
+raw_files = ["books.jsonl", "authors.jsonl", "tags.jsonl", "book_genres.jsonl", "author_genres.jsonl"]
+
+def raw_filename(filename, profile="full"):
+    """Name of a raw file for a fetch profile; partial profiles never overwrite a full crawl's files"""
+    if profile == "full":
+        return filename
+    name, extension = filename.rsplit(".", 1)
+    return f"{name}.{profile}.{extension}"
+
+###########
+# Journal #
+###########
+class CrawlJournal:
+    """On-disk record of the last completed page per (entity, genre)"""
+    def __init__(self, path):
+        self.path = path
+        self.state = {"finished": False, "pages": {}}
+        if os.path.exists(path):
+            with open(path, "r", encoding="utf-8") as f:
+                self.state = json.load(f)
+
+    @property
+    def finished(self):
+        return self.state["finished"]
+
+    def get(self, key):
+        return self.state["pages"].get(key)
+
+    def record_page(self, key, pagination, last_id, offset):
+        """Saves the position after a page has been written to disk"""
+        self.state["pages"][key] = {
+            "pagination": pagination,
+            "last_id": last_id,
+            "offset": offset,
+            "done": False
+            }
+        self.save()
+
+    def mark_done(self, key):
+        state = self.state["pages"].setdefault(
+            key, {"pagination": None, "last_id": 0, "offset": 0}
+            )
+        state["done"] = True
+        self.save()
+
+    def file_start(self, key, filepath):
+        """Size of filepath when this run first needed it, kept across resumes
+
+        Rows after it were appended by this run, even if earlier runs appended to the
+        same file.
+        """
+        starts = self.state.setdefault("file_starts", {})
+        if key not in starts:
+            starts[key] = os.path.getsize(filepath) if os.path.exists(filepath) else 0
+            self.save()
+        return starts[key]
+
+    def mark_finished(self):
+        self.state["finished"] = True
+        self.save()
+
+    def reset(self, since=None):
+        """Starts a new run, remembering when it started and its sync watermark"""
+        self.state = {
+            "finished": False,
+            "pages": {},
+            "since": since,
+            "started_at": datetime.now(timezone.utc).isoformat()
+            }
+        self.save()
+
+    def save(self):
+        # Writing to a temporary file first so a crash never leaves a half-written journal
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(self.state, f)
+        os.replace(tmp_path, self.path)
+
+##############
+# Sync State #
+##############
+def load_sync_state(path):
+    """Reads the watermark of the last successful sync"""
+    if not os.path.exists(path):
+        return {}
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+def save_sync_state(path, state):
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(state, f)
+    os.replace(tmp_path, path)
+
+#############
+# Raw Pages #
+#############
+def append_rows(filepath, rows, genre=None, column=None):
+    """Appends one page to a raw JSONL file, wrapping rows as {"genre", column} if column is set"""
+    if column is not None:
+        rows = [{"genre": genre, column: row} for row in rows]
+    with open(filepath, "a", encoding="utf-8") as f:
+        f.write("".join(json.dumps(row) + "\n" for row in rows))
+
+def iter_raw(filepath, chunksize=10000, offset=0):
+    """Yields the records of a raw JSONL file in lists of at most chunksize, from byte offset"""
+    if not os.path.exists(filepath):
+        return
+    chunk = []
+    # Only the reading and parsing is timed, not what the caller does with a chunk
+    start = time.perf_counter()
+    with open(filepath, "r", encoding="utf-8") as f:
+        f.seek(offset)
+        for line in f:
+            if line.strip():
+                chunk.append(json.loads(line))
+            if len(chunk) >= chunksize:
+                metrics.record("raw.parse_chunk", time.perf_counter() - start)
+                metrics.count("raw.rows", len(chunk))
+                yield chunk
+                chunk = []
+                start = time.perf_counter()
+    if chunk:
+        metrics.record("raw.parse_chunk", time.perf_counter() - start)
+        metrics.count("raw.rows", len(chunk))
+        yield chunk
+
+def read_by_genre(filepath, entity, column, chunksize=10000):
+    """Groups the records of <entity>.jsonl by genre
+
+    Single-pass records have no genre and are placed through <column>_genres.jsonl,
+    with one shared dict per record across its genres.
+    """
+    # Returning [] instead of KeyError if a genre doesn't exist yet
+    by_genre = defaultdict(list)
+    single_pass = {}
+    for chunk in iter_raw(f"{filepath}/{entity}.jsonl", chunksize):
+        for row in chunk:
+            if row["genre"]:
+                by_genre[row["genre"]].append(row[column])
+            else:
+                # Incremental syncs append newer versions, so the last one wins
+                single_pass[row[column]["id"]] = row[column]
+
+    if single_pass:
+        seen = set()
+        for chunk in iter_raw(f"{filepath}/{column}_genres.jsonl", chunksize):
+            for row in chunk:
+                key = (row[f"{column}_id"], row["genre"])
+                if key not in seen and key[0] in single_pass:
+                    seen.add(key)
+                    by_genre[row["genre"]].append(single_pass[key[0]])
+    return dict(by_genre)
+
+def max_raw_id(filepath):
+    """Highest id in a raw JSONL file of plain records, 0 if there is none"""
+    return max((row["id"] for chunk in iter_raw(filepath) for row in chunk), default=0)
+
+def clear_raw_files(filepath, profile="full"):
+    """Removes the raw files of a previous crawl with the same fetch profile before starting a new one"""
+    for filename in raw_files:
+        filename = raw_filename(filename, profile)
+        if os.path.exists(f"{filepath}/{filename}"):
+            os.remove(f"{filepath}/{filename}")
+
+#####################
+# CSV Store Convert #
+#####################
+def convert_csv_store(filepath, chunksize=10000):
+    """Rewrites books.csv, authors.csv, tags.csv and the genre mappings as JSONL"""
+    # The old files hold whole payloads in single CSV fields
+    max_int = sys.maxsize
+    while True:
+        try:
+            csv.field_size_limit(max_int)
+            break
+        except OverflowError:
+            max_int = int(max_int / 10)
+
+    def convert(name, to_row):
+        src = f"{filepath}/{name}.csv"
+        dst = f"{filepath}/{name}.jsonl"
+        if not os.path.exists(src):
+            return
+        if os.path.exists(dst):
+            os.remove(dst)
+        rows = []
+        count = 0
+        parse_seconds = 0.0
+        with open(src, "r", encoding="utf-8") as f:
+            reader = csv.reader(f)
+            next(reader)
+            for row in reader:
+                if not row:
+                    continue
+                start = time.perf_counter()
+                try:
+                    rows.append(to_row(row))
+                except Exception as e:
+                    metrics.count(f"convert.{name}.errors")
+                    print(f"Error converting {name} row {row[0]}: {e}")
+                parse_seconds += time.perf_counter() - start
+                if len(rows) >= chunksize:
+                    append_rows(dst, rows)
+                    count += len(rows)
+                    rows = []
+        append_rows(dst, rows)
+        # Mostly ast.literal_eval of the payload columns
+        metrics.record(f"convert.{name}.parse", parse_seconds)
+        metrics.count(f"convert.{name}.rows", count + len(rows))
+        print(f"Converted {count + len(rows)} rows from {src} to {dst}")
+
+    # Saved CSV files where the payload columns were Python reprs
+    convert("books", lambda row: {"genre": row[1] or None, "book": ast.literal_eval(row[2])})
+    convert("authors", lambda row: {"genre": row[1] or None, "author": ast.literal_eval(row[2])})
+    convert("tags", lambda row: {
+        "id": int(row[1]), "tag": row[2], "tag_category": ast.literal_eval(row[3]) if row[3] else None
+        })
+    convert("book_genres", lambda row: {"book_id": int(row[1]), "genre": row[2]})
+    convert("author_genres", lambda row: {"author_id": int(row[1]), "genre": row[2]})
@@ -0,0 +1,187 @@
+import asyncio
+import time
+from collections import OrderedDict, deque
+import numpy as np
+from aiohttp import web
+
+#########
+# Cache #
+#########
+class TtlLruCache:
+    """Least-recently-used cache whose entries also expire ttl seconds after being stored"""
+    def __init__(self, max_size=1024, ttl=300):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is None or time.monotonic() - entry[0] > self.ttl:
+            self.entries.pop(key, None)
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    def put(self, key, value):
+        self.entries[key] = (time.monotonic(), value)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def clear(self):
+        self.entries.clear()
+
+###########
+# Metrics #
+###########
+class LatencyMetrics:
+    """Request counts and latency percentiles over the last window requests"""
+    def __init__(self, window=10000):
+        self.latencies = deque(maxlen=window)
+        self.requests = 0
+        self.errors = 0
+
+    def record(self, seconds, error=False):
+        self.latencies.append(seconds * 1000)
+        self.requests += 1
+        self.errors += error
+
+    def report(self):
+        latencies = np.array(self.latencies)
+        percentiles = (
+            {f"p{p}_ms": float(np.percentile(latencies, p)) for p in (50, 90, 99)}
+            if len(latencies) else {"p50_ms": None, "p90_ms": None, "p99_ms": None}
+            )
+        return {"requests": self.requests, "errors": self.errors, **percentiles}
+
+################
+# Explanations #
+################
+# What each suggestion shares with the reading list
+explanation_queries = {
+    "shared_tags": """
+    SELECT DISTINCT c.book_id, t.tag_name
+    FROM book_tags AS c
+    JOIN book_tags AS r
+        ON r.tag_id = c.tag_id
+    JOIN tags AS t
+        ON t.tag_id = c.tag_id
+    WHERE c.book_id = ANY(%(candidates)s) AND r.book_id = ANY(%(read)s)
+    """,
+    "shared_authors": """
+    SELECT DISTINCT c.book_id, a.name
+    FROM book_authors AS c
+    JOIN book_authors AS r
+        ON r.author_id = c.author_id
+    JOIN authors AS a
+        ON a.author_id = c.author_id
+    WHERE c.book_id = ANY(%(candidates)s) AND r.book_id = ANY(%(read)s)
+    """,
+    "shared_series": """
+    SELECT DISTINCT c.book_id, c.related_book_id
+    FROM book_series AS c
+    JOIN book_series AS r
+        ON r.related_book_id = c.related_book_id
+    WHERE c.book_id = ANY(%(candidates)s) AND r.book_id = ANY(%(read)s)
+    """
+    }
+
+def describe(pool, read_ids, candidate_ids):
+    """Titles of the candidates and what they share with the read books, on a pooled connection"""
+    params = {"read": list(read_ids), "candidates": list(candidate_ids)}
+    details = {book_id: {"title": None, **{name: [] for name in explanation_queries}}
+               for book_id in candidate_ids}
+    conn = pool.getconn()
+    try:
+        with conn.cursor() as cur:
+            cur.execute("SELECT book_id, title FROM books WHERE book_id = ANY(%(candidates)s)", params)
+            for book_id, title in cur.fetchall():
+                details[book_id]["title"] = title
+            for name, query in explanation_queries.items():
+                cur.execute(query, params)
+                for book_id, value in cur.fetchall():
+                    details[book_id][name].append(value)
+        conn.rollback()
+    finally:
+        pool.putconn(conn)
+    return details
+
+###########
+# Service #
+###########
+def normalize_request(body, max_k=100):
+    """Read book ids as a sorted tuple without duplicates, and k, from a request body"""
+    if not isinstance(body, dict) or not isinstance(body.get("book_ids"), list):
+        raise ValueError("Expected a JSON object with a list of book_ids")
+    try:
+        book_ids = tuple(sorted({int(book_id) for book_id in body["book_ids"]}))
+        k = int(body.get("k", 10))
+    except (TypeError, ValueError):
+        raise ValueError("book_ids and k must be integers")
+    if not 1 <= k <= max_k:
+        raise ValueError(f"k must be between 1 and {max_k}")
+    return book_ids, k
+
+class RecommendationService:
+    """Reading-list recommendations over a SimilarityIndex, cached on the normalized list
+
+    With a connection pool, every suggestion carries its title and the tags, authors
+    and series it shares with the reading list.
+    """
+    def __init__(self, index, popularity=None, pool=None, cache_size=1024, ttl=300,
+                 popularity_weight=0.2):
+        self.index = index
+        self.popularity = popularity
+        self.pool = pool
+        self.popularity_weight = popularity_weight
+        self.cache = TtlLruCache(cache_size, ttl)
+        self.metrics = LatencyMetrics()
+
+    async def recommend(self, book_ids, k):
+        key = (book_ids, k)
+        cached = self.cache.get(key)
+        if cached is not None:
+            return cached
+        suggestions = self.index.recommend(book_ids, k, self.popularity, self.popularity_weight)
+        results = [{"book_id": book_id, "score": round(score, 4)} for book_id, score in suggestions]
+        if self.pool is not None and results:
+            # psycopg2 blocks, so the lookup runs in a thread
+            details = await asyncio.to_thread(describe, self.pool, book_ids, [r["book_id"] for r in results])
+            for result in results:
+                result.update(details[result["book_id"]])
+        self.cache.put(key, results)
+        return results
+
+    async def handle_recommend(self, request):
+        start = time.perf_counter()
+        try:
+            book_ids, k = normalize_request(await request.json())
+        except ValueError as e:
+            self.metrics.record(time.perf_counter() - start, error=True)
+            return web.json_response({"error": str(e)}, status=400)
+        try:
+            results = await self.recommend(book_ids, k)
+        except Exception as e:
+            self.metrics.record(time.perf_counter() - start, error=True)
+            print("Recommendation failed:", e)
+            return web.json_response({"error": "Recommendation failed"}, status=500)
+        self.metrics.record(time.perf_counter() - start)
+        return web.json_response({"book_ids": list(book_ids), "recommendations": results})
+
+    async def handle_metrics(self, request):
+        cache = {"size": len(self.cache.entries), "hits": self.cache.hits, "misses": self.cache.misses}
+        return web.json_response({**self.metrics.report(), "cache": cache})
+
+    async def handle_health(self, request):
+        return web.json_response({"status": "ok", "books": int(len(self.index.book_ids))})
+
+    def app(self):
+        app = web.Application()
+        app.router.add_post("/recommend", self.handle_recommend)
+        app.router.add_get("/metrics", self.handle_metrics)
+        app.router.add_get("/health", self.handle_health)
+        return app
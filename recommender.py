@@ -0,0 +1,152 @@
+import time
+import numpy as np
+from scipy import sparse
+
+from array_store import load_arrays, save_arrays
+
+# Relative weight of each kind of shared feature in the similarity
+feature_weights = {"tag": 1.0, "author": 1.0, "series": 1.0}
+
+# (book_id, feature) pairs per kind of feature
+edge_queries = {
+    "tag": "SELECT book_id, tag_id FROM book_tags",
+    "author": "SELECT book_id, author_id FROM book_authors",
+    "series": "SELECT book_id, related_book_id FROM book_series WHERE related_book_id IS NOT NULL"
+    }
+
+# Files of a saved index, one .npy array each
+index_files = ["book_ids", "neighbours", "scores"]
+
+############
+# Features #
+############
+def read_edges(cur):
+    """Reads the sorted book ids and the (book_id, feature) pairs of every kind"""
+    cur.execute("SELECT book_id FROM books ORDER BY book_id")
+    book_ids = np.array([row[0] for row in cur.fetchall()], dtype=np.int64)
+    edges = {}
+    for kind, query in edge_queries.items():
+        cur.execute(query)
+        pairs = np.array(cur.fetchall(), dtype=np.int64).reshape(-1, 2)
+        edges[kind] = (pairs[:, 0], pairs[:, 1])
+    return book_ids, edges
+
+def book_rows(book_ids, ids):
+    """Positions of ids in the sorted book_ids, -1 for unknown ids"""
+    ids = np.asarray(ids, dtype=np.int64)
+    if len(book_ids) == 0:
+        return np.full(len(ids), -1)
+    rows = np.minimum(np.searchsorted(book_ids, ids), len(book_ids) - 1)
+    return np.where(book_ids[rows] == ids, rows, -1)
+
+def feature_matrix(book_ids, edges, weights=feature_weights, max_df=0.5):
+    """Sparse matrix with one L2-normalized row of weighted features per book
+
+    Each feature is weighted by its inverse document frequency, so a tag that most
+    books carry counts for less than one shared by a handful of books. Features of
+    more than max_df of the books are dropped: they say little about a book and would
+    make almost every pair of books a candidate.
+    """
+    n = len(book_ids)
+    blocks = []
+    for kind, (edge_books, values) in edges.items():
+        rows = book_rows(book_ids, edge_books)
+        known = rows >= 0
+        features, cols = np.unique(values[known], return_inverse=True)
+        block = sparse.csr_matrix(
+            (np.ones(known.sum(), dtype=np.float32), (rows[known], cols)), shape=(n, len(features))
+            )
+        # Duplicate pairs count once
+        block.sum_duplicates()
+        block.data[:] = 1
+        counts = block.getnnz(axis=0)
+        idf = np.log((1 + n) / (1 + counts)) + 1
+        idf[counts > max_df * n] = 0
+        block = block @ sparse.diags((idf * weights.get(kind, 1.0)).astype(np.float32))
+        block.eliminate_zeros()
+        blocks.append(block)
+
+    matrix = sparse.hstack(blocks, format="csr", dtype=np.float32) if blocks else sparse.csr_matrix((n, 0))
+    norms = np.sqrt(np.asarray(matrix.multiply(matrix).sum(axis=1)).ravel())
+    norms[norms == 0] = 1
+    return sparse.diags(1 / norms) @ matrix
+
+##############
+# Neighbours #
+##############
+def top_k_neighbours(matrix, k=50, block_size=1024):
+    """Top k cosine neighbours of every row, -1 where a book has fewer than k
+
+    Similarities are computed block_size rows at a time, so only one sparse block
+    of the similarity matrix is in memory.
+    """
+    n = matrix.shape[0]
+    neighbours = np.full((n, k), -1, dtype=np.int32)
+    scores = np.zeros((n, k), dtype=np.float32)
+    transposed = matrix.T.tocsc()
+    for start in range(0, n, block_size):
+        similarities = (matrix[start:start + block_size] @ transposed).tocsr()
+        for offset in range(similarities.shape[0]):
+            row = start + offset
+            cols = similarities.indices[similarities.indptr[offset]:similarities.indptr[offset + 1]]
+            values = similarities.data[similarities.indptr[offset]:similarities.indptr[offset + 1]]
+            keep = (cols != row) & (values > 0)
+            cols, values = cols[keep], values[keep]
+            if len(cols) > k:
+                top = np.argpartition(-values, k)[:k]
+                cols, values = cols[top], values[top]
+            order = np.argsort(-values, kind="stable")
+            neighbours[row, :len(order)] = cols[order]
+            scores[row, :len(order)] = values[order]
+    return neighbours, scores
+
+#########
+# Index #
+#########
+class SimilarityIndex:
+    """Precomputed top-k similar books per book, saved as .npy files
+
+    Loaded memory-mapped, so answering a query only touches the rows of the books
+    asked about rather than the whole catalogue.
+    """
+    def __init__(self, book_ids, neighbours, scores):
+        self.book_ids = book_ids
+        self.neighbours = neighbours
+        self.scores = scores
+
+    @classmethod
+    def build(cls, book_ids, edges, k=50, weights=feature_weights, max_df=0.5):
+        start = time.perf_counter()
+        book_ids = np.asarray(book_ids, dtype=np.int64)
+        neighbours, scores = top_k_neighbours(feature_matrix(book_ids, edges, weights, max_df), k)
+        print(f"Similarity index: {len(book_ids)} books, top {k} in {time.perf_counter() - start:.2f}s")
+        return cls(book_ids, neighbours, scores)
+
+    @classmethod
+    def load(cls, path, mmap=True):
+        return cls(*load_arrays(path, index_files, mmap))
+
+    def save(self, path):
+        save_arrays(path, {name: getattr(self, name) for name in index_files})
+
+    def recommend(self, book_ids, k=10, popularity=None, popularity_weight=0.2):
+        """Books most similar to a reading list, as (book_id, score) pairs
+
+        Each candidate scores the sum of its similarities to the books in the list;
+        books in the list and unknown ids are left out. With popularity (BookScores),
+        the mean similarity is blended with the candidate's precomputed score.
+        """
+        rows = book_rows(self.book_ids, book_ids)
+        rows = np.unique(rows[rows >= 0])
+        if len(rows) == 0:
+            return []
+        candidates = np.asarray(self.neighbours[rows]).ravel()
+        similarities = np.asarray(self.scores[rows]).ravel()
+        keep = (candidates >= 0) & ~np.isin(candidates, rows)
+        candidates, totals = np.unique(candidates[keep], return_inverse=True)
+        totals = np.bincount(totals, weights=similarities[keep])
+        if popularity is not None:
+            totals = ((1 - popularity_weight) * totals / len(rows)
+                      + popularity_weight * popularity.score_of(self.book_ids[candidates]))
+        top = np.argsort(-totals, kind="stable")[:k]
+        return [(int(self.book_ids[candidates[i]]), float(totals[i])) for i in top]
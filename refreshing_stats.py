@@ -0,0 +1,43 @@
+import os
+import psycopg2
+
+from aggregates import capture_books, refresh_aggregates
+from cleaning_pre_postgresql import read_book_stats, clean_book_stats
+from instrumentation import metrics
+from loading import update_table
+from schema import book_stats_columns
+
+data_path = os.environ["BOOK_RECOMMENDATION_DATA_PATH"]
+
+# Connection parameters
+conn_params = {
+    "host": "localhost",
+    "dbname": "postgres",
+    "user": "postgres",
+    "password": os.environ["POSTGRESQL_PW"],
+    "port": 5432
+    }
+
+##############
+# Book Stats #
+##############
+# Fetched by fetching_data.py with HARDCOVER_FETCH_PROFILE=stats-refresh
+with metrics.stage("clean_stats") as stage:
+    stats = clean_book_stats(read_book_stats(data_path))
+    stage["rows"] = len(stats)
+
+# Only the counts of books already loaded change, and the read aggregates of the
+# changed books are refreshed in the same transaction
+conn = psycopg2.connect(**conn_params)
+try:
+    with metrics.stage("update", rows=len(stats)):
+        with conn.cursor() as cur:
+            updated = update_table(cur, "books", book_stats_columns, ["book_id"], stats)
+            capture_books(cur, [book_id for book_id, in updated])
+            refresh_aggregates(cur)
+        conn.commit()
+finally:
+    conn.close()
+print(f"Updated the stats of {len(updated)} of {len(stats)} books")
+
+metrics.write_report(f"{data_path}/run_reports", "refresh_stats", updated=len(updated))
@@ -0,0 +1,69 @@
+import asyncio
+import requests
+import os
+
+from instrumentation import metrics
+from pipeline import run_pipeline
+from queries import genres
+
+data_path = os.environ["BOOK_RECOMMENDATION_DATA_PATH"]
+
+# Overridable so the pipeline can be pointed at a local stub server
+url = os.environ.get("HARDCOVER_URL", "https://api.hardcover.app/v1/graphql")
+
+headers = {
+    "Content-Type": "application/json",
+    "authorization": os.environ["HARDCOVER_AUTH"],
+    "User-Agent": requests.utils.default_user_agent()
+    }
+
+# Requests per second and burst shared by all workers, and max requests in flight
+rate = float(os.environ.get("HARDCOVER_RATE", "1"))
+burst = int(os.environ.get("HARDCOVER_BURST", "1"))
+max_concurrency = int(os.environ.get("HARDCOVER_CONCURRENCY", "8"))
+
+# Retries of a failed request, backing off exponentially from HARDCOVER_BACKOFF seconds
+max_retries = int(os.environ.get("HARDCOVER_MAX_RETRIES", "5"))
+backoff = float(os.environ.get("HARDCOVER_BACKOFF", "1"))
+
+# Rows per page to start with; pages shrink on timeouts and oversized responses down
+# to HARDCOVER_MIN_LIMIT, and grow while responses are fast up to HARDCOVER_MAX_LIMIT
+limit = int(os.environ.get("HARDCOVER_LIMIT", "100"))
+min_limit = int(os.environ.get("HARDCOVER_MIN_LIMIT", "10"))
+max_limit = int(os.environ.get("HARDCOVER_MAX_LIMIT", str(limit)))
+pagination = os.environ.get("HARDCOVER_PAGINATION", "keyset")
+
+# Rows cleaned and staged at a time, and pages waiting between the fetcher and the loader;
+# together they bound the memory used, whatever the size of the catalogue
+batch_size = int(os.environ.get("PIPELINE_BATCH_SIZE", "1000"))
+queue_size = int(os.environ.get("PIPELINE_QUEUE_SIZE", "8"))
+
+# Comma-separated stages run under cProfile ("all" for every stage), and "1" to trace
+# each stage's peak memory; the run report goes to data_path/run_reports
+metrics.configure(profile=os.environ.get("PIPELINE_PROFILE", ""),
+                  trace_memory=os.environ.get("PIPELINE_TRACE_MEMORY", "0") == "1",
+                  profile_path=f"{data_path}/run_reports/profiles")
+
+# Connection parameters
+conn_params = {
+    "host": "localhost",
+    "dbname": "postgres",
+    "user": "postgres",
+    "password": os.environ["POSTGRESQL_PW"],
+    "port": 5432
+    }
+
+############
+# Pipeline #
+############
+# Fetching, cleaning and loading in one process, without the raw files
+with metrics.stage("pipeline") as stage:
+    staged = asyncio.run(
+        run_pipeline(url, headers, genres, conn_params, batch_size=batch_size, queue_size=queue_size,
+                     language_cache=f"{data_path}/language_cache.sqlite", rate=rate, burst=burst,
+                     max_concurrency=max_concurrency, limit=limit, pagination=pagination,
+                     max_retries=max_retries, backoff=backoff, min_limit=min_limit, max_limit=max_limit)
+        )
+    stage["rows"] = sum(staged.values())
+
+metrics.write_report(f"{data_path}/run_reports", "pipeline")
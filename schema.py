@@ -0,0 +1,184 @@
+from aggregates import create_aggregates
+from loading import add_natural_key, migrate_array_table
+
+#########
+# Books #
+#########
+query_table_books = """
+CREATE TABLE IF NOT EXISTS books (
+    id SERIAL PRIMARY KEY,
+    pages INT,
+    title TEXT,
+    book_id BIGINT,
+    rating NUMERIC(2,1),
+    release_year INT,
+    description TEXT,
+    created_at DATE,
+    ratings_count INT,
+    reviews_count INT,
+    editions_count INT,
+    lists_count INT,
+    users_read_count INT,
+    book_image TEXT
+    );
+"""
+
+################
+# Book Authors #
+################
+# Junction table with one row per (book_id, author_id)
+query_table_book_authors = """
+CREATE TABLE IF NOT EXISTS book_authors (
+    book_id BIGINT NOT NULL REFERENCES books (book_id) ON DELETE CASCADE,
+    author_id BIGINT NOT NULL,
+    PRIMARY KEY (book_id, author_id)
+    );
+CREATE INDEX IF NOT EXISTS book_authors_author_id_idx ON book_authors (author_id);
+"""
+
+#############
+# Book Tags #
+#############
+# Junction table with one row per (book_id, tag_id)
+query_table_book_tags = """
+CREATE TABLE IF NOT EXISTS book_tags (
+    book_id BIGINT NOT NULL REFERENCES books (book_id) ON DELETE CASCADE,
+    tag_id INT NOT NULL,
+    PRIMARY KEY (book_id, tag_id)
+    );
+CREATE INDEX IF NOT EXISTS book_tags_tag_id_idx ON book_tags (tag_id);
+"""
+
+###############
+# Book Series #
+###############
+query_table_book_series = """
+CREATE TABLE IF NOT EXISTS book_series (
+    id SERIAL PRIMARY KEY,
+    book_id BIGINT,
+    position INT,
+    related_book_id BIGINT
+    );
+"""
+
+###############
+# Book Genres #
+###############
+query_table_book_genres = """
+CREATE TABLE IF NOT EXISTS book_genres (
+    id SERIAL PRIMARY KEY,
+    book_id BIGINT,
+    genre TEXT
+    );
+"""
+
+###########
+# Authors #
+###########
+query_table_authors = """
+CREATE TABLE IF NOT EXISTS authors (
+    id SERIAL PRIMARY KEY,
+    author_id BIGINT,
+    name TEXT,
+    author_bio TEXT,
+    born_year INT,
+    author_image TEXT
+    );
+"""
+
+########
+# Tags #
+########
+query_table_tags = """
+CREATE TABLE IF NOT EXISTS tags (
+    id SERIAL PRIMARY KEY,
+    tag_id INT,
+    tag_name TEXT,
+    category TEXT,
+    category_id INT
+    );
+"""
+
+##########
+# Schema #
+##########
+def create_schema(cur):
+    """Creates the tables with their natural keys and indexes, migrating older layouts"""
+    cur.execute(query_table_books)
+    add_natural_key(cur, "books", ["book_id"])
+
+    # Older loads stored an author_id BIGINT[] and a tag_id INT[] per book
+    migrate_array_table(cur, "book_authors", "author_id", query_table_book_authors)
+    cur.execute(query_table_book_authors)
+    migrate_array_table(cur, "book_tags", "tag_id", query_table_book_tags)
+    cur.execute(query_table_book_tags)
+
+    cur.execute(query_table_book_series)
+    add_natural_key(cur, "book_series", ["book_id", "related_book_id"])
+
+    cur.execute(query_table_book_genres)
+    add_natural_key(cur, "book_genres", ["book_id", "genre"])
+
+    cur.execute(query_table_authors)
+    add_natural_key(cur, "authors", ["author_id"])
+
+    cur.execute(query_table_tags)
+    add_natural_key(cur, "tags", ["tag_id"])
+    # Genre filters look tags up by name
+    cur.execute("CREATE INDEX IF NOT EXISTS tags_tag_name_idx ON tags (tag_name)")
+
+    # Reads per genre and author, kept up to date by every load
+    create_aggregates(cur)
+
+# Columns, natural key and the column stale edges are pruned by, in merge order
+# (books first so the junction tables' foreign keys are satisfied)
+tables = {
+    "books": {
+        "columns": ["pages", "title", "book_id", "rating", "release_year", "description", "created_at",
+                    "ratings_count", "reviews_count", "editions_count", "lists_count",
+                    "users_read_count", "book_image"],
+        "key": ["book_id"]
+        },
+    "book_authors": {
+        "columns": ["book_id", "author_id"],
+        "key": ["book_id", "author_id"],
+        "prune_by": "book_id"
+        },
+    "book_tags": {
+        "columns": ["book_id", "tag_id"],
+        "key": ["book_id", "tag_id"],
+        "prune_by": "book_id"
+        },
+    "book_series": {
+        "columns": ["book_id", "position", "related_book_id"],
+        "key": ["book_id", "related_book_id"],
+        "prune_by": "book_id"
+        },
+    "book_genres": {
+        "columns": ["book_id", "genre"],
+        "key": ["book_id", "genre"],
+        "prune_by": "book_id"
+        },
+    "authors": {
+        "columns": ["author_id", "name", "author_bio", "born_year", "author_image"],
+        "key": ["author_id"]
+        },
+    "tags": {
+        "columns": ["tag_id", "tag_name", "category", "category_id"],
+        "key": ["tag_id"]
+        }
+    }
+
+# Book columns a stats-refresh crawl updates in place
+book_stats_columns = ["rating", "ratings_count", "reviews_count", "editions_count", "lists_count",
+                      "users_read_count"]
+
+def book_frames(cleaned):
+    """Maps the tables from clean_books_merged onto the columns of the book tables"""
+    return {
+        "books": cleaned["books"].rename(columns={"id": "book_id"}),
+        "book_authors": cleaned["book_authors"],
+        "book_tags": cleaned["book_tags"],
+        "book_series": cleaned["book_series"].rename(columns={"series_id": "related_book_id"}),
+        "book_genres": cleaned["book_genres"]
+        }
@@ -0,0 +1,50 @@
+import os
+from aiohttp import web
+from psycopg2.pool import ThreadedConnectionPool
+
+from popularity import BookScores
+from recommendation_service import RecommendationService
+from recommender import SimilarityIndex
+
+data_path = os.environ["BOOK_RECOMMENDATION_DATA_PATH"]
+
+# Local only unless told otherwise
+host = os.environ.get("RECOMMENDER_HOST", "127.0.0.1")
+port = int(os.environ.get("RECOMMENDER_PORT", "8080"))
+
+# Cached reading lists and how long a cached answer is served, in seconds
+cache_size = int(os.environ.get("RECOMMENDER_CACHE_SIZE", "1024"))
+cache_ttl = float(os.environ.get("RECOMMENDER_CACHE_TTL", "300"))
+
+# Share of a suggestion's score from its popularity rather than its similarity
+popularity_weight = float(os.environ.get("RECOMMENDER_POPULARITY_WEIGHT", "0.2"))
+
+# Connection parameters
+conn_params = {
+    "host": "localhost",
+    "dbname": "postgres",
+    "user": "postgres",
+    "password": os.environ["POSTGRESQL_PW"],
+    "port": 5432
+    }
+
+###########
+# Service #
+###########
+# Built by building_recommender.py and memory-mapped
+index = SimilarityIndex.load(f"{data_path}/similarity_index")
+popularity = (
+    BookScores.load(f"{data_path}/book_scores")
+    if os.path.exists(f"{data_path}/book_scores/scores.npy") else None
+    )
+
+# Titles and explanations are looked up on pooled connections
+pool = ThreadedConnectionPool(1, int(os.environ.get("RECOMMENDER_DB_POOL", "4")), **conn_params)
+
+service = RecommendationService(index, popularity, pool, cache_size=cache_size, ttl=cache_ttl,
+                                popularity_weight=popularity_weight)
+try:
+    # POST /recommend {"book_ids": [...], "k": 10}, GET /metrics, GET /health
+    web.run_app(service.app(), host=host, port=port)
+finally:
+    pool.closeall()
@@ -0,0 +1,192 @@
+import asyncio
+import bisect
+import os
+import numpy as np
+from aiohttp import web
+
+from queries import genres as default_genres
+from raw_store import append_rows, clear_raw_files
+
+# Words titles and descriptions are drawn from; the foreign ones make the language
+# filter do real work
+english_title_words = [
+    "the", "history", "of", "a", "science", "mind", "world", "money", "how", "to", "think",
+    "power", "life", "and", "art", "war", "story", "new", "economy", "brain", "why", "we",
+    "learn", "numbers", "future", "great", "ideas", "for", "everyone", "guide", "philosophy"
+    ]
+foreign_title_words = [
+    "la", "historia", "del", "mundo", "die", "geschichte", "der", "welt", "le", "monde",
+    "et", "pensée", "il", "libro", "della", "vita", "och", "världen"
+    ]
+non_latin_titles = ["Война и мир", "思考の技術", "التاريخ العالمي", "Η ιστορία του κόσμου"]
+
+tag_categories = [(1, "Genre"), (2, "Mood"), (3, "Content Warning"), (4, "Tag"), (5, "Pace")]
+
+#############
+# Catalogue #
+#############
+def generate_catalogue(n_books, n_authors=None, n_tags=2000, genres=None, genre_overlap=0.5,
+                       foreign_share=0.15, seed=0):
+    """Synthetic books, authors and tags shaped like the Hardcover API's records
+
+    Every book is in one genre plus on average genre_overlap more, and is tagged with
+    the tags of its genres. foreign_share of the titles are not English.
+    Returns the records and each book's genres.
+    """
+    rng = np.random.default_rng(seed)
+    genres = list(genres or default_genres)
+    n_authors = n_authors or max(1, n_books // 3)
+
+    # The first tags are the genres themselves, which is what the genre filter matches
+    tags = [
+        {"id": i + 1, "tag": genre, "tag_category": {"category": "Genre", "id": 1}}
+        for i, genre in enumerate(genres)
+        ]
+    for tag_id in range(len(genres) + 1, n_tags + 1):
+        category_id, category = tag_categories[rng.integers(1, len(tag_categories))]
+        tags.append({"id": tag_id, "tag": f"tag {tag_id}",
+                     "tag_category": {"category": category, "id": category_id}})
+
+    authors = [
+        {"id": author_id, "name": f"Author {author_id}",
+         "bio": " ".join(rng.choice(english_title_words, 20)),
+         "born_year": int(rng.integers(1900, 2000)) if rng.random() < 0.7 else None,
+         "image": {"url": f"https://example.com/a/{author_id}.jpg"} if rng.random() < 0.5 else None}
+        for author_id in range(1, n_authors + 1)
+        ]
+
+    books = []
+    book_genres = {}
+    extra_genres = rng.poisson(genre_overlap, n_books)
+    for book_id in range(1, n_books + 1):
+        memberships = rng.choice(len(genres), min(len(genres), 1 + extra_genres[book_id - 1]), replace=False)
+        book_genres[book_id] = [genres[i] for i in memberships]
+        tag_ids = {int(i) + 1 for i in memberships}
+        tag_ids.update(int(t) for t in rng.zipf(1.5, rng.integers(3, 15)) % (n_tags - len(genres)) + len(genres) + 1)
+        author_ids = {int(a) for a in rng.integers(1, n_authors + 1, 1 + (rng.random() < 0.2))}
+        series = []
+        if rng.random() < 0.15:
+            series_id = int(rng.integers(1, max(2, n_books // 10)))
+            series.append({"book_id": book_id, "featured": True, "position": int(rng.integers(1, 8)),
+                           "series": {"id": series_id, "name": f"Series {series_id}"}})
+        books.append({
+            "pages": int(rng.integers(80, 900)) if rng.random() < 0.9 else None,
+            "title": synthetic_title(rng, foreign_share),
+            "id": book_id,
+            "rating": float(np.round(rng.uniform(2.5, 5), 2)) if rng.random() < 0.8 else None,
+            "release_year": int(rng.integers(1950, 2025)),
+            "description": " ".join(rng.choice(english_title_words, rng.integers(20, 120))),
+            "created_at": f"20{rng.integers(18, 25)}-0{rng.integers(1, 10)}-1{rng.integers(0, 10)}T12:00:00.000000+00:00",
+            "ratings_count": int(rng.zipf(1.8)),
+            "reviews_count": int(rng.zipf(2.2)),
+            "editions_count": int(rng.integers(1, 20)),
+            "lists_count": int(rng.zipf(2.0)),
+            "users_read_count": int(rng.zipf(1.6)),
+            "contributions": [{"author_id": a} for a in sorted(author_ids)],
+            "book_series": series,
+            "image": {"url": f"https://example.com/b/{book_id}.jpg"} if rng.random() < 0.8 else None,
+            "taggings": [{"tag_id": t} for t in sorted(tag_ids)]
+            })
+    return {"books": books, "authors": authors, "tags": tags, "book_genres": book_genres}
+
+def synthetic_title(rng, foreign_share):
+    roll = rng.random()
+    if roll < foreign_share * 0.3:
+        return str(rng.choice(non_latin_titles))
+    if roll < foreign_share:
+        return " ".join(rng.choice(foreign_title_words, rng.integers(3, 7))).capitalize()
+    if roll < foreign_share + 0.02:
+        return str(rng.integers(1, 2000))
+    return " ".join(rng.choice(english_title_words, rng.integers(3, 9))).capitalize()
+
+def genre_members(catalogue):
+    """Books and authors of every genre, in id order as the API pages them"""
+    books_by_genre = {}
+    for book in catalogue["books"]:
+        for genre in catalogue["book_genres"][book["id"]]:
+            books_by_genre.setdefault(genre, []).append(book)
+    authors = {author["id"]: author for author in catalogue["authors"]}
+    authors_by_genre = {
+        genre: [authors[a] for a in sorted({c["author_id"] for book in books for c in book["contributions"]})]
+        for genre, books in books_by_genre.items()
+        }
+    return books_by_genre, authors_by_genre
+
+#############
+# Raw Store #
+#############
+def write_raw_store(filepath, catalogue, single_pass=False, limit=100):
+    """Writes the raw JSONL files exactly as fetching_data.py does, one page per append"""
+    os.makedirs(filepath, exist_ok=True)
+    clear_raw_files(filepath)
+    books_by_genre, authors_by_genre = genre_members(catalogue)
+
+    def pages(rows):
+        for start in range(0, len(rows), limit):
+            yield rows[start:start + limit]
+
+    for page in pages(catalogue["tags"]):
+        append_rows(f"{filepath}/tags.jsonl", page)
+    if single_pass:
+        for entity, singular, by_genre in (("books", "book", books_by_genre), ("authors", "author", authors_by_genre)):
+            for genre, rows in by_genre.items():
+                for page in pages(rows):
+                    append_rows(f"{filepath}/{singular}_genres.jsonl",
+                                [{f"{singular}_id": row["id"], "genre": genre} for row in page])
+            unique = sorted({row["id"]: row for rows in by_genre.values() for row in rows}.items())
+            for page in pages([row for _, row in unique]):
+                append_rows(f"{filepath}/{entity}.jsonl", page, None, singular)
+    else:
+        for genre, rows in books_by_genre.items():
+            for page in pages(rows):
+                append_rows(f"{filepath}/books.jsonl", page, genre, "book")
+        for genre, rows in authors_by_genre.items():
+            for page in pages(rows):
+                append_rows(f"{filepath}/authors.jsonl", page, genre, "author")
+
+###############
+# Stub Server #
+###############
+def stub_app(catalogue, latency=0.0):
+    """Local GraphQL stand-in answering the crawl's queries from a synthetic catalogue
+
+    Pages by genre with keyset or offset paging, and looks records up by id, so the
+    fetch stage can be benchmarked without touching the real API.
+    """
+    books_by_genre, authors_by_genre = genre_members(catalogue)
+    members = {
+        "books": books_by_genre, "authors": authors_by_genre, "tags": {None: catalogue["tags"]}
+        }
+    member_ids = {
+        root: {genre: [row["id"] for row in rows] for genre, rows in by_genre.items()}
+        for root, by_genre in members.items()
+        }
+    by_id = {root: {row["id"]: row for row in catalogue[root]} for root in ("books", "authors", "tags")}
+
+    async def handle(request):
+        body = await request.json()
+        variables = body.get("variables") or {}
+        query = body["query"]
+        root = next(name for name in ("books", "authors", "tags") if f"{name}(" in query)
+        if latency:
+            await asyncio.sleep(latency)
+        if "ids" in variables:
+            rows = [by_id[root][i] for i in variables["ids"] if i in by_id[root]]
+            return web.json_response({"data": {root: rows}})
+
+        genre = variables.get("genre")
+        rows = members[root].get(genre, [])
+        limit = variables["limit"]
+        if "last_id" in variables:
+            start = bisect.bisect_right(member_ids[root].get(genre, []), variables["last_id"])
+        else:
+            start = variables["offset"]
+        page = rows[start:start + limit]
+        # Single-pass crawls first ask for ids only
+        if "{\n    id\n  }" in query:
+            page = [{"id": row["id"]} for row in page]
+        return web.json_response({"data": {root: page}})
+
+    app = web.Application()
+    app.router.add_post("/graphql", handle)
+    return app
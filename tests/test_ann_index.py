@@ -0,0 +1,35 @@
+import numpy as np
+
+from ann_index import IvfIndex, recall_at_k
+from description_vectors import exact_search, normalize_rows
+
+def make_vectors(n=2000, dim=16, clusters=20, seed=0):
+    rng = np.random.default_rng(seed)
+    centres = rng.standard_normal((clusters, dim))
+    vectors = centres[rng.integers(0, clusters, n)] + 0.3 * rng.standard_normal((n, dim))
+    return np.arange(100, 100 + n), normalize_rows(vectors).astype(np.float32)
+
+def test_probing_every_list_matches_exact_search():
+    ids, vectors = make_vectors()
+    index = IvfIndex.build(ids, vectors, nlist=16)
+    queries = vectors[:20]
+    found, _ = index.search(queries, k=10, nprobe=16)
+    exact, _ = exact_search(ids, vectors, queries, k=10)
+    assert (found == exact).all()
+    # More lists probed never lowers recall
+    recalls = [result["recall"] for result in recall_at_k(index, ids, vectors, queries, nprobes=(1, 4, 16))]
+    assert recalls == sorted(recalls) and recalls[-1] == 1
+
+def test_add_inserts_and_replaces_without_retraining(tmp_path):
+    ids, vectors = make_vectors()
+    index = IvfIndex.build(ids[:1500], vectors[:1500], nlist=16)
+    index.save(str(tmp_path / "ann"))
+    index = IvfIndex.load(str(tmp_path / "ann"))
+
+    # 500 new books plus a changed vector for book 100
+    added = index.add(np.concatenate([ids[1500:], [100]]), np.vstack([vectors[1500:], vectors[1999:]]))
+    assert len(added.ids) == 2000 and sorted(added.ids) == list(ids)
+    assert (added.centroids == index.centroids).all()
+    assert added.offsets[-1] == 2000 and (np.diff(added.offsets) >= 0).all()
+    found, _ = added.search(vectors[1999:], k=2, nprobe=16)
+    assert set(found[0]) == {100, ids[1999]}
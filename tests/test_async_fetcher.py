@@ -0,0 +1,324 @@
+import asyncio
+import re
+import time
+import pytest
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+
+from async_fetcher import PageSize, TokenBucket, crawl, retry_after
+from raw_store import CrawlJournal, append_rows, iter_raw, max_raw_id
+
+###############
+# Stub Server #
+###############
+def make_rows(n):
+    return [{"id": i, "title": f"Book {i}", "name": f"Author {i}", "tag": f"Tag {i}"}
+            for i in range(1, n + 1)]
+
+def query_root(body):
+    return re.search(r"\{\s*(\w+)\(", body["query"]).group(1)
+
+def page_of(rows, variables):
+    """The rows a keyset or offset page asks for"""
+    if "last_id" in variables:
+        return [row for row in rows if row["id"] > variables["last_id"]][:variables["limit"]]
+    return rows[variables["offset"]:variables["offset"] + variables["limit"]]
+
+def stub_handler(rows, calls):
+    """Local GraphQL stand-in that pages the same rows for every root field"""
+    async def handle(request):
+        calls.append(time.monotonic())
+        body = await request.json()
+        return web.json_response({"data": {query_root(body): page_of(rows, body.get("variables") or {})}})
+    return handle
+
+async def run_crawl(handle, genres, rate=1000, **kwargs):
+    """Crawls a local server answering every request with handle"""
+    app = web.Application()
+    app.router.add_post("/graphql", handle)
+    server = TestServer(app)
+    await server.start_server()
+    try:
+        return await crawl(str(server.make_url("/graphql")), {}, genres, rate=rate, **kwargs)
+    finally:
+        await server.close()
+
+#########
+# Tests #
+#########
+def test_crawl_pages_every_genre():
+    for pagination in ("keyset", "offset"):
+        calls = []
+        all_books, all_authors, all_tags = asyncio.run(
+            run_crawl(stub_handler(make_rows(250), calls), ["Science", "Finance"], burst=100,
+                      pagination=pagination)
+            )
+        assert [len(books) for books in all_books.values()] == [250, 250]
+        assert [len(authors) for authors in all_authors.values()] == [250, 250]
+        assert len(all_tags) == 250
+        assert [book["id"] for book in all_books["Science"]] == list(range(1, 251))
+        # 3 full pages and one empty page per genre/entity and for tags
+        assert len(calls) == 5 * 4
+
+def test_shared_bucket_keeps_rate():
+    rate, burst = 50, 5
+    calls = []
+    asyncio.run(run_crawl(stub_handler(make_rows(250), calls), ["Science", "Finance"], rate=rate, burst=burst))
+    elapsed = calls[-1] - calls[0]
+    # Everything beyond the initial burst has to wait for refilled tokens
+    assert len(calls) - burst <= rate * elapsed + 1
+
+def test_token_bucket_refill():
+    async def take(n):
+        bucket = TokenBucket(rate=100, capacity=1)
+        start = time.monotonic()
+        for _ in range(n):
+            await bucket.acquire()
+        return time.monotonic() - start
+
+    assert asyncio.run(take(11)) >= 0.1 * 0.9
+
+def test_keyset_fallback_only_on_keyset_errors():
+    rows = make_rows(30)
+
+    def run(message):
+        async def handle(request):
+            variables = (await request.json())["variables"]
+            if "last_id" in variables:
+                return web.json_response({"errors": [{"message": message}]})
+            return web.json_response({"data": {"tags": page_of(rows, variables)}})
+        _, _, tags = asyncio.run(run_crawl(handle, [], limit=10, max_retries=1, backoff=0.01))
+        return tags
+
+    assert len(run("field '_gt' not found in type: 'Int_comparison_exp'")) == 30
+    assert run("Throttled") == []
+
+def test_crawl_resumes_from_journal(tmp_path):
+    rows = make_rows(250)
+    calls = []
+    # Every attempt of the first run, so the retries give up
+    failing = {"remaining": 3}
+
+    async def handle(request):
+        body = await request.json()
+        variables = body["variables"]
+        root = query_root(body)
+        calls.append((root, variables["last_id"]))
+        # The second books page keeps failing, as if the process had died there
+        if root == "books" and variables["last_id"] == 100 and failing["remaining"]:
+            failing["remaining"] -= 1
+            return web.Response(status=500, text="not json")
+        return web.json_response({"data": {root: page_of(rows, variables)}})
+
+    def run(journal):
+        asyncio.run(run_crawl(handle, ["Science"], store_path=str(tmp_path), journal=journal,
+                              max_retries=2, backoff=0.01))
+
+    journal = CrawlJournal(str(tmp_path / "crawl_journal.json"))
+    run(journal)
+    assert not journal.finished
+    assert journal.get("books|Science") == {"pagination": "keyset", "last_id": 100,
+                                            "offset": 100, "done": False}
+
+    calls.clear()
+    run(CrawlJournal(str(tmp_path / "crawl_journal.json")))
+    # Only the unfinished books query is fetched again, from where it stopped
+    assert calls == [("books", 100), ("books", 200), ("books", 250)]
+    assert CrawlJournal(str(tmp_path / "crawl_journal.json")).finished
+
+    books = [row for chunk in iter_raw(str(tmp_path / "books.jsonl")) for row in chunk]
+    assert [row["book"]["id"] for row in books] == list(range(1, 251))
+    assert max_raw_id(str(tmp_path / "tags.jsonl")) == 250
+
+def test_single_pass_downloads_each_record_once():
+    rows = make_rows(120)
+    genres = ["Science", "Finance"]
+    downloaded = []
+
+    async def handle(request):
+        body = await request.json()
+        variables = body["variables"]
+        root = query_root(body)
+        if "ids" in variables:
+            page = [row for row in rows if row["id"] in variables["ids"]]
+            downloaded.extend((root, row["id"]) for row in page)
+            return web.json_response({"data": {root: page}})
+        # Every third row is in Finance as well as Science
+        members = rows
+        if variables.get("genre") == "Finance":
+            members = [row for row in rows if row["id"] % 3 == 0]
+        page = page_of(members, variables)
+        if root != "tags":
+            page = [{"id": row["id"]} for row in page]
+        return web.json_response({"data": {root: page}})
+
+    all_books, all_authors, _ = asyncio.run(run_crawl(handle, genres, limit=50, single_pass=True))
+    assert sorted(downloaded) == sorted((root, i) for root in ("books", "authors") for i in range(1, 121))
+    assert len(all_books["Science"]) == 120
+    assert [book["id"] for book in all_books["Finance"]] == list(range(3, 121, 3))
+    assert all_books["Finance"][0] is all_books["Science"][2]
+
+def test_incremental_single_pass_downloads_only_this_runs_ids(tmp_path):
+    changed = make_rows(6)
+    downloaded = []
+
+    async def handle(request):
+        body = await request.json()
+        variables = body["variables"]
+        root = query_root(body)
+        if "ids" in variables:
+            downloaded.extend(variables["ids"])
+            page = [row for row in changed if row["id"] in variables["ids"]]
+            return web.json_response({"data": {root: page}})
+        return web.json_response({"data": {root: page_of(changed, variables)}})
+
+    # Memberships an earlier full run already stored
+    append_rows(str(tmp_path / "book_genres.jsonl"),
+                [{"book_id": i, "genre": "Science"} for i in range(1, 101)])
+    journal = CrawlJournal(str(tmp_path / "crawl_journal.json"))
+    journal.reset("2026-01-01T00:00:00+00:00")
+    asyncio.run(run_crawl(handle, ["Science"], store_path=str(tmp_path), journal=journal,
+                          since=journal.state["since"], single_pass=True))
+    # Books and authors each download only the 6 changed records
+    assert sorted(downloaded) == sorted(list(range(1, 7)) * 2)
+    assert sum(len(chunk) for chunk in iter_raw(str(tmp_path / "book_genres.jsonl"))) == 106
+
+def test_async_on_page_holds_the_crawl_back():
+    rows = make_rows(250)
+    received = []
+    outstanding = []
+
+    async def handle(request):
+        body = await request.json()
+        variables = body["variables"]
+        outstanding.append(len(outstanding) + 1 - len(received))
+        return web.json_response({"data": {query_root(body): page_of(rows, variables)}})
+
+    async def on_page(entity, genre, page):
+        # A slow consumer, as when a batch is being cleaned and loaded
+        await asyncio.sleep(0.05)
+        received.append((entity, genre, len(page)))
+
+    all_books, _, all_tags = asyncio.run(run_crawl(handle, ["Science"], on_page=on_page))
+    assert sorted(received) == sorted(
+        [("books", "Science", 100), ("books", "Science", 100), ("books", "Science", 50),
+         ("authors", "Science", 100), ("authors", "Science", 100), ("authors", "Science", 50),
+         ("tags", None, 100), ("tags", None, 100), ("tags", None, 50)]
+        )
+    assert all_books == {"Science": []} and all_tags == []
+    # Each of the three queries waits for its page to be consumed before asking for the next
+    assert max(outstanding) <= 3
+
+def test_on_page_rejects_single_pass():
+    async def on_page(entity, genre, page):
+        pass
+
+    with pytest.raises(ValueError):
+        asyncio.run(crawl("http://127.0.0.1:9/graphql", {}, ["Science"], on_page=on_page,
+                          single_pass=True))
+
+def test_rate_limited_and_throttled_pages_are_retried():
+    rows = make_rows(50)
+    calls = []
+    failures = {"status": 1, "throttled": 1}
+
+    async def handle(request):
+        calls.append(time.monotonic())
+        variables = (await request.json())["variables"]
+        if variables["last_id"] == 10 and failures["status"]:
+            failures["status"] -= 1
+            return web.Response(status=429, headers={"Retry-After": "0.3"}, text="Too Many Requests")
+        if variables["last_id"] == 30 and failures["throttled"]:
+            failures["throttled"] -= 1
+            return web.json_response({"errors": [{"message": "Throttled"}]})
+        return web.json_response({"data": {"tags": page_of(rows, variables)}})
+
+    _, _, tags = asyncio.run(run_crawl(handle, [], burst=100, limit=10, backoff=0.01))
+    assert [tag["id"] for tag in tags] == list(range(1, 51))
+    # The crawl waits as long as Retry-After asks
+    assert calls[2] - calls[1] >= 0.3 * 0.9
+
+def test_page_size_shrinks_on_timeouts_and_grows_when_fast():
+    rows = make_rows(100)
+    limits = []
+
+    async def handle(request):
+        variables = (await request.json())["variables"]
+        limits.append(variables["limit"])
+        # Big pages are too slow for the client's timeout
+        if variables["limit"] > 20:
+            await asyncio.sleep(1)
+        return web.json_response({"data": {"tags": page_of(rows, variables)}})
+
+    _, _, tags = asyncio.run(run_crawl(handle, [], burst=100, limit=80, min_limit=10, timeout=0.3,
+                                       backoff=0.01))
+    assert [tag["id"] for tag in tags] == list(range(1, 101))
+    assert limits[:3] == [80, 40, 20]
+
+    page_size = PageSize(100, max_limit=200, fast_seconds=1.0, max_bytes=1000)
+    for _ in range(3):
+        page_size.observe(0.1, 500)
+    assert page_size.limit == 150
+    page_size.observe(2.0, 500)
+    page_size.observe(0.1, 5000)
+    assert page_size.limit == 75
+
+def test_id_lookups_are_rechunked_when_the_page_size_shrinks():
+    rows = make_rows(120)
+    lookups = []
+    returned = []
+
+    async def handle(request):
+        body = await request.json()
+        variables = body["variables"]
+        root = query_root(body)
+        if "ids" not in variables:
+            page = page_of(rows, variables)
+            return web.json_response({"data": {root: page if root == "tags" else [{"id": row["id"]} for row in page]}})
+        lookups.append((len(variables["ids"]), variables["limit"]))
+        # Payloads of more than 20 records are too slow for the client's timeout
+        if variables["limit"] > 20:
+            await asyncio.sleep(1)
+        page = [row for row in rows if row["id"] in variables["ids"]][:variables["limit"]]
+        returned.extend((root, row["id"]) for row in page)
+        return web.json_response({"data": {root: page}})
+
+    books, _, _ = asyncio.run(run_crawl(handle, ["Science"], limit=80, min_limit=10, timeout=0.3,
+                                        backoff=0.01, single_pass=True))
+    # Every record arrives exactly once, though the first chunks came back cut short
+    assert sorted(returned) == sorted((root, i) for root in ("books", "authors") for i in range(1, 121))
+    assert [book["id"] for book in books["Science"]] == list(range(1, 121))
+    assert lookups[0] == (80, 80)
+    # Later chunks are cut at the shrunk page size
+    assert any(n < 40 for n, _ in lookups)
+
+def test_retry_after_in_seconds_or_as_a_date():
+    assert retry_after("2") == 2
+    assert retry_after(None) is None
+    assert retry_after("Wed, 21 Oct 2015 07:28:00 GMT") == 0
+    assert retry_after("soon") is None
+
+def test_profiles_fetch_only_their_fields(tmp_path):
+    rows = make_rows(30)
+    queries = []
+
+    async def handle(request):
+        body = await request.json()
+        variables = body["variables"]
+        root = query_root(body)
+        queries.append((root, body["query"]))
+        return web.json_response({"data": {root: page_of(rows, variables)}})
+
+    def run(profile, **kwargs):
+        return asyncio.run(run_crawl(handle, ["Science"], limit=10, profile=profile, **kwargs))
+
+    run("stats-refresh", store_path=str(tmp_path))
+    assert {root for root, _ in queries} == {"books"}
+    assert all("users_read_count" in query and "description" not in query for _, query in queries)
+    assert sorted(path.name for path in tmp_path.iterdir()) == ["books.stats-refresh.jsonl"]
+
+    # Ids are all there is to fetch, so single-pass still pages per genre
+    queries.clear()
+    books, authors, tags = run("ids-only", single_pass=True)
+    assert len(books["Science"]) == len(authors["Science"]) == 30 and tags == []
+    assert all(re.search(r"\{\s*id\s*\}", query) for _, query in queries)
@@ -0,0 +1,61 @@
+import re
+import pandas as pd
+
+from cleaning_pre_postgresql import (
+    clean_book_stats, clean_books_merged, clean_tags, id_column, rating_column,
+    read_books_raw, read_tags
+    )
+from loading import null_marker
+from synthetic_data import generate_catalogue, write_raw_store
+
+def book(book_id, title):
+    return {
+        "id": book_id, "title": title, "pages": 200, "rating": 4.2, "release_year": 2001,
+        "description": "", "created_at": "2020-05-01T12:00:00+00:00", "ratings_count": 3,
+        "reviews_count": 1, "editions_count": 2, "lists_count": 0, "users_read_count": 5,
+        "image": None, "contributions": [{"author_id": 7}], "taggings": [], "book_series": []
+        }
+
+def test_batch_without_titles_to_detect(tmp_path):
+    # Numeric titles are kept and non-Latin ones dropped without asking the detector
+    cleaned = clean_books_merged({"Science": [book(1, "1984"), book(2, "Война и мир")]},
+                                 language_cache=str(tmp_path / "languages.sqlite"))
+    assert cleaned["books"]["id"].tolist() == [1]
+    assert cleaned["book_authors"]["author_id"].tolist() == [7]
+    assert cleaned["book_genres"]["genre"].tolist() == ["Science"]
+
+def test_cleaned_tables_are_compact(tmp_path):
+    catalogue = generate_catalogue(300, genres=["Science", "Finance", "Politics"])
+    write_raw_store(tmp_path, catalogue)
+    cleaned = clean_books_merged(read_books_raw(tmp_path), language_cache=f"{tmp_path}/languages.sqlite")
+
+    books = cleaned["books"]
+    assert books["id"].dtype == "int32" and books["ratings_count"].dtype == "Int32"
+    assert books["rating"].dtype == "Float32" and books["created_at"].dtype.kind == "M"
+    assert all(dtype == "int32" for dtype in cleaned["book_tags"].dtypes)
+    assert cleaned["book_genres"]["genre"].dtype == "category"
+    # Ratings keep their one decimal and dates are written without a time for COPY
+    written = books[["rating", "created_at"]].dropna().to_csv(index=False, header=False).split()
+    assert all(re.fullmatch(r"\d\.\d,\d{4}-\d\d-\d\d", line) for line in written)
+
+    tags = clean_tags(read_tags(tmp_path))
+    assert all(df["category"].dtype == "category" for df in tags.values())
+
+def test_ids_widen_once_they_no_longer_fit():
+    assert id_column(pd.Series([1, 2**31 - 1])).dtype == "int32"
+    assert id_column(pd.Series([1, 2**31])).tolist() == [1, 2**31]
+    assert id_column(pd.Series([1, 2**31])).dtype == "int64"
+    # Ids flattened by json_normalize arrive as floats
+    assert id_column(pd.Series([3.0, 4.0])).dtype == "int32"
+
+def test_missing_ratings_are_written_as_null():
+    ratings = rating_column(pd.Series([4.349, None, "n/a", 5]))
+    assert ratings.dtype == "Float32"
+    assert ratings.isna().tolist() == [False, True, True, False]
+    assert pd.DataFrame({"rating": ratings}).to_csv(index=False, header=False, na_rep=null_marker).split() == [
+        "4.3", null_marker, null_marker, "5.0"
+        ]
+
+    stats = clean_book_stats([{"id": 1, "rating": None, "ratings_count": 2}])
+    assert stats["rating"].isna().all() and stats["rating"].dtype == "Float32"
+    assert stats["users_read_count"].isna().all() and stats["ratings_count"].tolist() == [2]
@@ -0,0 +1,33 @@
+import numpy as np
+
+from description_vectors import DescriptionVectors, tfidf_matrix
+
+descriptions = {
+    1: "A history of the Roman empire, its emperors, legions and provinces.",
+    2: "The Roman empire from Augustus to the fall of Rome, with its legions.",
+    3: "Emperors and provinces of the Roman empire in late antiquity.",
+    4: "An introduction to calculus, derivatives and integrals for students.",
+    5: "Calculus for students: limits, derivatives, integrals and series.",
+    6: "Derivatives and integrals explained, a calculus workbook.",
+    7: None
+    }
+
+def test_tfidf_rows_are_normalized():
+    matrix, vocabulary, _ = tfidf_matrix(list(descriptions.values()))
+    norms = np.sqrt(np.asarray(matrix.multiply(matrix).sum(axis=1)).ravel())
+    assert np.allclose(norms[:6], 1) and norms[6] == 0
+    # Words of a single description are left out
+    assert "augustus" not in vocabulary and "calculus" in vocabulary
+
+def test_vectors_are_memory_mapped_and_aligned_with_book_ids(tmp_path):
+    # Given out of order, stored in book_id order
+    book_ids = list(descriptions)[::-1]
+    vectors = DescriptionVectors.build(book_ids, [descriptions[i] for i in book_ids], dim=4)
+    vectors.save(str(tmp_path / "vectors"))
+    loaded = DescriptionVectors.load(str(tmp_path / "vectors"))
+
+    assert isinstance(loaded.vectors, np.memmap) and loaded.vectors.dtype == np.float32
+    assert list(loaded.book_ids) == sorted(descriptions)
+    assert [book_id for book_id, _ in loaded.similar([1], k=2)] == [2, 3]
+    assert {book_id for book_id, _ in loaded.similar([4, 5], k=1)} == {6}
+    assert loaded.similar([999]) == []
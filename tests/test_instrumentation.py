@@ -0,0 +1,58 @@
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from instrumentation import Instrumentation, compare_reports, latest_report
+
+def busy(n):
+    return sum(i * i for i in range(n))
+
+def test_stage_records_throughput_and_profile(tmp_path):
+    metrics = Instrumentation()
+    metrics.configure(profile="parse", trace_memory=True, profile_path=tmp_path)
+    with metrics.stage("parse") as stage:
+        busy(100000)
+        stage["rows"] = 1000
+    with metrics.stage("load", rows=10):
+        pass
+
+    parse = metrics.stages["parse"]
+    assert parse["rows"] == 1000 and parse["rows_per_second"] > 0
+    assert "peak_mb" in parse
+    assert any("busy" in entry["function"] for entry in parse["profile"])
+    assert (tmp_path / "parse.prof").exists()
+    assert "profile" not in metrics.stages["load"]
+
+def test_timers_and_counters_from_threads():
+    metrics = Instrumentation()
+
+    def work(i):
+        with metrics.timer("request"):
+            time.sleep(0.001)
+        metrics.count("rows", i)
+
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        list(executor.map(work, range(100)))
+
+    report = metrics.report()
+    assert report["counters"]["rows"] == sum(range(100))
+    assert report["timers"]["request"]["count"] == 100
+    assert report["timers"]["request"]["p50_ms"] >= 1
+
+def test_reports_compare_across_runs(tmp_path):
+    first = Instrumentation()
+    with first.stage("load"):
+        time.sleep(0.01)
+    first.write_report(tmp_path, "ingest")
+
+    second = Instrumentation()
+    second.started_at = second.started_at.replace(year=second.started_at.year + 1)
+    with second.stage("load"):
+        time.sleep(0.03)
+    filename = second.write_report(tmp_path, "ingest", books=5)
+
+    with open(filename) as f:
+        assert json.load(f)["books"] == 5
+    latest = latest_report(tmp_path, "ingest")
+    assert latest["started_at"] == second.report()["started_at"]
+    assert compare_reports(first.report(), latest)["stages.load"] > 0.5
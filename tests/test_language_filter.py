@@ -0,0 +1,40 @@
+import language_filter
+from language_filter import detect_english_titles, prefilter, title_hash
+
+def test_prefilter_decides_only_obvious_titles():
+    assert prefilter("Война и мир") is False
+    assert prefilter("1984") is False
+    assert prefilter("The History of the World") is True
+    # One common word, or a foreign title in Latin letters, needs the detector
+    assert prefilter("Thinking Fast") is None
+    assert prefilter("La historia del mundo") is None
+    assert title_hash("The  Mind ") == title_hash("the mind")
+
+def test_cache_hits_and_title_changes(tmp_path, monkeypatch):
+    detected = []
+
+    def is_english(title):
+        detected.append(title)
+        return not title.startswith("La ")
+
+    monkeypatch.setattr(language_filter, "is_english", is_english)
+    cache = str(tmp_path / "languages.sqlite")
+    pairs = {(1, "Thinking Fast"), (2, "La historia del mundo"), (3, "The History of the World")}
+    assert detect_english_titles(pairs, cache) == {
+        (1, "Thinking Fast"): True, (2, "La historia del mundo"): False,
+        (3, "The History of the World"): True
+        }
+    assert sorted(detected) == ["La historia del mundo", "Thinking Fast"]
+
+    # Every (book_id, title hash) is cached, prefiltered verdicts included
+    detected.clear()
+    assert detect_english_titles(pairs, cache)[(1, "Thinking Fast")] is True
+    assert detected == []
+
+    # A changed title is a new key and is detected again
+    results = detect_english_titles({(1, "La economía"), (2, "La historia del mundo")}, cache)
+    assert results == {(1, "La economía"): False, (2, "La historia del mundo"): False}
+    assert detected == ["La economía"]
+
+def test_nothing_to_detect():
+    assert detect_english_titles(set()) == {}
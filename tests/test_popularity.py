@@ -0,0 +1,42 @@
+import numpy as np
+import pandas as pd
+
+from popularity import BookScores, score_books
+
+def make_frames():
+    books = pd.DataFrame({
+        "book_id": [1, 2, 3, 4],
+        "rating": [5.0, 4.5, 3.0, None],
+        "ratings_count": [1, 1000, 500, 0],
+        "users_read_count": [2, 5000, 800, 10],
+        "lists_count": [0, 300, 40, None],
+        "reviews_count": [0, 200, 30, 1]
+        })
+    book_genres = pd.DataFrame({"book_id": [1, 2, 3, 3, 4], "genre": ["Science", "Science", "Science", "Finance", "Finance"]})
+    book_authors = pd.DataFrame({"book_id": [1, 2, 3, 4], "author_id": [7, 7, 8, 8]})
+    return books, book_genres, book_authors
+
+def test_bayesian_rating_needs_ratings_to_move_from_the_prior():
+    scores = score_books(*make_frames())
+    books = scores["book_scores"].set_index("book_id")
+    prior_mean = (5 * 1 + 4.5 * 1000 + 3 * 500) / 1501
+    # A single 5 star rating barely moves a book from the mean, a thousand 4.5s do
+    assert abs(books.loc[1, "bayes_rating"] - prior_mean) < 0.01
+    assert books.loc[2, "bayes_rating"] > books.loc[1, "bayes_rating"]
+    assert books.loc[4, "bayes_rating"] == prior_mean
+    assert books["score"].idxmax() == 2
+
+def test_genre_ranks_and_author_scores():
+    scores = score_books(*make_frames())
+    genres = scores["genre_book_scores"].set_index(["genre", "book_id"])
+    assert genres.loc[("Science", 2), "rank"] == 1 and genres.loc[("Finance", 3), "rank"] == 1
+    assert sorted(genres.loc["Science", "rank"]) == [1, 2, 3]
+    authors = scores["author_scores"].set_index("author_id")
+    assert authors.loc[7, "popularity"] > authors.loc[8, "popularity"]
+
+def test_book_scores_lookup(tmp_path):
+    BookScores.from_frame(score_books(*make_frames())["book_scores"]).save(str(tmp_path / "scores"))
+    scores = BookScores.load(str(tmp_path / "scores"))
+    values = scores.score_of([2, 99, 1])
+    assert values[1] == 0 and values[0] > values[2] > 0
+    assert scores.scores.dtype == np.float32
@@ -0,0 +1,50 @@
+import asyncio
+import time
+import numpy as np
+from aiohttp.test_utils import TestClient, TestServer
+
+from recommendation_service import RecommendationService, TtlLruCache, normalize_request
+from recommender import SimilarityIndex
+
+def make_index():
+    book_ids = np.array([10, 20, 30, 40, 50, 60])
+    edges = {"tag": (np.array([10, 20, 30, 10, 20, 40, 50, 60]), np.array([1, 1, 1, 2, 2, 3, 3, 4]))}
+    return SimilarityIndex.build(book_ids, edges, k=3)
+
+def test_normalize_request():
+    assert normalize_request({"book_ids": [30, "10", 30], "k": 2}) == ((10, 30), 2)
+    for body in ({"book_ids": "10"}, {"book_ids": ["x"]}, {"book_ids": [1], "k": 0}, [1, 2]):
+        try:
+            normalize_request(body)
+        except ValueError:
+            continue
+        raise AssertionError(body)
+
+def test_cache_evicts_least_recently_used_and_expired():
+    cache = TtlLruCache(max_size=2, ttl=0.05)
+    cache.put("a", 1)
+    cache.put("b", 2)
+    cache.get("a")
+    cache.put("c", 3)
+    assert cache.get("b") is None and cache.get("a") == 1
+    time.sleep(0.06)
+    assert cache.get("a") is None
+    assert (cache.hits, cache.misses) == (2, 2)
+
+def test_recommend_endpoint_caches_and_reports_latency():
+    async def run():
+        service = RecommendationService(make_index())
+        async with TestClient(TestServer(service.app())) as client:
+            first = await (await client.post("/recommend", json={"book_ids": [10], "k": 2})).json()
+            # Same list in another order and with duplicates hits the cache
+            again = await (await client.post("/recommend", json={"book_ids": [10, 10], "k": 2})).json()
+            bad = await client.post("/recommend", json={"book_ids": "10"})
+            metrics = await (await client.get("/metrics")).json()
+        return first, again, bad.status, metrics
+
+    first, again, status, metrics = asyncio.run(run())
+    assert [r["book_id"] for r in first["recommendations"]] == [20, 30]
+    assert again == first
+    assert status == 400
+    assert metrics["requests"] == 3 and metrics["errors"] == 1
+    assert metrics["cache"]["hits"] == 1 and metrics["p99_ms"] >= metrics["p50_ms"]
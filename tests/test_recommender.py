@@ -0,0 +1,46 @@
+import numpy as np
+
+from popularity import BookScores
+from recommender import SimilarityIndex, feature_matrix
+
+def make_edges():
+    # Books 10-30 share tags, books 40-60 share an author and a series; tag 1 is on every book
+    book_ids = np.array([10, 20, 30, 40, 50, 60])
+    tags = [(10, 1), (10, 2), (10, 3), (20, 1), (20, 2), (20, 3), (30, 1), (30, 2),
+            (40, 1), (50, 1), (60, 1), (60, 4)]
+    authors = [(40, 7), (50, 7), (60, 8)]
+    series = [(40, 9), (50, 9), (60, 9)]
+    edges = {
+        kind: (np.array([p[0] for p in pairs]), np.array([p[1] for p in pairs]))
+        for kind, pairs in (("tag", tags), ("author", authors), ("series", series))
+        }
+    return book_ids, edges
+
+def test_feature_rows_are_normalized_and_drop_common_features():
+    book_ids, edges = make_edges()
+    matrix = feature_matrix(book_ids, edges)
+    norms = np.sqrt(np.asarray(matrix.multiply(matrix).sum(axis=1)).ravel())
+    assert np.allclose(norms, 1)
+    # Tag 1 is on every book, so books 40 and 50 only match on author and series
+    assert matrix[3].nnz == 2
+
+def test_recommend_ranks_books_sharing_features(tmp_path):
+    book_ids, edges = make_edges()
+    SimilarityIndex.build(book_ids, edges, k=3).save(str(tmp_path / "index"))
+    index = SimilarityIndex.load(str(tmp_path / "index"))
+
+    assert [book_id for book_id, _ in index.recommend([10], k=2)] == [20, 30]
+    assert index.recommend([40], k=1)[0][0] == 50
+    # Books in the reading list are never recommended and unknown ids are ignored
+    recommended = [book_id for book_id, _ in index.recommend([10, 20, 999], k=5)]
+    assert recommended[0] == 30 and 10 not in recommended and 20 not in recommended
+    assert index.recommend([999]) == []
+
+def test_recommend_blends_popularity():
+    book_ids, edges = make_edges()
+    index = SimilarityIndex.build(book_ids, edges, k=3)
+    # 30 is less similar to 10 than 20 is, but far more popular
+    popularity = BookScores(np.array([10, 20, 30]), np.array([0.0, 0.0, 1.0], dtype=np.float32))
+    assert [book_id for book_id, _ in index.recommend([10], k=2)] == [20, 30]
+    assert [book_id for book_id, _ in index.recommend([10], k=2, popularity=popularity,
+                                                      popularity_weight=0.5)] == [30, 20]
@@ -0,0 +1,45 @@
+import asyncio
+from aiohttp.test_utils import TestServer
+
+from async_fetcher import crawl
+from cleaning_pre_postgresql import read_books_raw, read_tags
+from synthetic_data import generate_catalogue, genre_members, stub_app, write_raw_store
+
+genres = ["Science", "Finance", "Politics"]
+
+def test_raw_store_reads_back_like_a_crawl(tmp_path):
+    catalogue = generate_catalogue(300, genres=genres, genre_overlap=1.0)
+    books_by_genre, _ = genre_members(catalogue)
+    write_raw_store(tmp_path, catalogue)
+
+    books_raw = read_books_raw(tmp_path)
+    assert {genre: [book["id"] for book in rows] for genre, rows in books_raw.items()} == {
+        genre: [book["id"] for book in rows] for genre, rows in books_by_genre.items()
+        }
+    # Books in several genres are stored once per genre
+    assert sum(len(rows) for rows in books_raw.values()) > 300
+    assert len(read_tags(tmp_path)) == len(catalogue["tags"])
+
+def test_stub_serves_the_catalogue_in_both_crawl_modes():
+    catalogue = generate_catalogue(300, genres=genres)
+    books_by_genre, authors_by_genre = genre_members(catalogue)
+
+    async def run(single_pass):
+        server = TestServer(stub_app(catalogue))
+        await server.start_server()
+        try:
+            return await crawl(str(server.make_url("/graphql")), {}, genres, rate=1000, burst=100,
+                               limit=50, single_pass=single_pass)
+        finally:
+            await server.close()
+
+    for single_pass in (False, True):
+        books, authors, tags = asyncio.run(run(single_pass))
+        assert {genre: len(rows) for genre, rows in books.items()} == {
+            genre: len(rows) for genre, rows in books_by_genre.items()
+            }
+        assert {genre: len(rows) for genre, rows in authors.items()} == {
+            genre: len(rows) for genre, rows in authors_by_genre.items()
+            }
+        assert all("title" in book for rows in books.values() for book in rows)
+        assert len(tags) == len(catalogue["tags"])